@@ -0,0 +1,306 @@
+#!/usr/bin/env python3
+
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+SCRIPT_DIR = Path(__file__).resolve().parent
+
+# Setup modes to benchmark: name -> (run_setup options, ObsidianSetup options, needs copied files first)
+MODES = {
+    "default": ({}, {}, False),
+    "copy": ({"copy_files": True}, {}, False),
+    "configure": ({"configure_only": True}, {}, True),
+    "ignore-files": ({"ignore_files_only": True}, {}, True),
+    "no-backup": ({}, {"backup_existing_config": False}, False),
+    "no-overwrite": ({}, {"overwrite_existing_files": False}, False),
+}
+
+TEMPLATE_VARIABLES = {"GEMINI_API_KEY": "benchmark-gemini-key", "CONTEXT7_API_KEY": "benchmark-context7-key", "SMITHERY_API_KEY": "benchmark-smithery-key", "SMITHERY_PROFILE": "benchmark"}
+
+
+class VaultGenerator:
+    """Builds synthetic source trees and target vaults at a configurable scale"""
+
+    def __init__(self, scripts=2000, commands=500, css_files=200, css_depth=6, plugins=100, data_json_entries=5000):
+        self.scripts = scripts
+        self.commands = commands
+        self.css_files = css_files
+        self.css_depth = css_depth
+        self.plugins = plugins
+        self.data_json_entries = data_json_entries
+
+    def scale(self):
+        return {
+            "scripts": self.scripts,
+            "commands": self.commands,
+            "css_files": self.css_files,
+            "css_depth": self.css_depth,
+            "plugins": self.plugins,
+            "data_json_entries": self.data_json_entries,
+        }
+
+    @staticmethod
+    def _write(path, content):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(content, encoding="utf-8")
+
+    def generate_source(self, source_path):
+        """Create a source checkout with config.json, Templater, CssSnippets, .gemini and agent files"""
+        source = Path(source_path)
+        config = {
+            "required_plugins": ["templater-obsidian"],
+            "paths": {
+                "note_directories": ["Notes", "Archives", "Daily Notes"] + [f"Projects/Project {index}/Notes" for index in range(50)],
+                "clipping_directories": ["Clippings"],
+                "daily_note_directories": ["Daily Notes"],
+                "templates_folder": "Templater",
+                "user_scripts_folder": "Templater/Scripts",
+                "commands_folder": "Templater/Commands",
+                "new_note_template": "Templater/New Note.md",
+                "startup_template": "Templater/Startup Scripts.md",
+                "daily_note_template": "Templater/Daily Note.md",
+                "sensitive": ["Secret/", "Templater/Scripts/", ".obsidian-setup/", ".env"] + [f"Private/Area {index}/" for index in range(20)],
+            },
+            "ai": {"gemini_api_key": "${GEMINI_API_KEY}"},
+        }
+        self._write(source / "config.json", json.dumps(config, indent=2) + "\n")
+
+        for index in range(self.scripts):
+            body = "\n".join(f"  const value{line} = input.replace(/pattern{line}/g, 'replacement');" for line in range(40))
+            self._write(source / "Templater" / "Scripts" / f"script{index:05d}.js", f"async function script{index}(input) {{\n{body}\n  return input;\n}}\n\nmodule.exports = script{index};\n")
+        for index in range(self.commands):
+            self._write(source / "Templater" / "Commands" / f"Command {index:04d}.md", f"<%*\nconst result = await tp.user.script{index % max(self.scripts, 1):05d}(tp.file.selection());\ntR += result;\n_%>\n")
+        for name in ("New Note.md", "Daily Note.md", "Startup Scripts.md"):
+            self._write(source / "Templater" / name, "<%* /* generated by benchmark */ _%>\n")
+
+        for index in range(self.css_files):
+            depth = index % (self.css_depth + 1)
+            folder = source.joinpath("CssSnippets", *[f"level{level}" for level in range(depth)])
+            self._write(folder / f"snippet{index:04d}.css", "".join(f".rule-{index}-{rule} {{ color: #{rule:06x}; }}\n" for rule in range(50)))
+
+        settings = {"mcpServers": {f"server{index}": {"command": "npx", "args": ["-y", f"server-{index}", "--key", "$CONTEXT7_API_KEY", "--profile", "${SMITHERY_PROFILE}"]} for index in range(20)}}
+        self._write(source / ".gemini" / "settings.json", json.dumps(settings, indent=2) + "\n")
+        self._write(source / ".gemini" / "system.md", "**Current Vault Path:** `$VAULT_PATH`\n\n" + "Instructions line.\n" * 200)
+        self._write(source / "gemini.sh", "#!/bin/bash\n\nGEMINI_SYSTEM_MD=.gemini/system.md gemini\n")
+        self._write(source / "AGENTS.md.example", "# AGENTS\n\n" + "Vault conventions line.\n" * 500)
+        return source
+
+    def generate_vault(self, vault_path):
+        """Create a target vault with many installed plugins and a large Templater data.json"""
+        vault = Path(vault_path)
+        plugins = vault / ".obsidian" / "plugins"
+        for index in range(self.plugins):
+            plugin_id = "templater-obsidian" if index == 0 else f"plugin-{index:04d}"
+            manifest = {"id": plugin_id, "name": plugin_id, "version": f"1.{index}.0", "minAppVersion": "1.0.0"}
+            self._write(plugins / plugin_id / "manifest.json", json.dumps(manifest, indent=2) + "\n")
+            self._write(plugins / plugin_id / "main.js", f"module.exports = {{ id: '{plugin_id}' }};\n")
+
+        data = {
+            "command_timeout": 5,
+            "templates_folder": "Templater",
+            "folder_templates": [{"folder": f"Existing/Folder {index}", "template": "Templater/New Note.md"} for index in range(self.data_json_entries)],
+            "enabled_templates_hotkeys": [f"Templater/Commands/Old {index}.md" for index in range(self.data_json_entries // 10)],
+            "syntax_highlighting": True,
+        }
+        self._write(plugins / "templater-obsidian" / "data.json", json.dumps(data, indent=2) + "\n")
+
+        for folder in ("Notes", "Archives", "Daily Notes", "Clippings"):
+            for index in range(20):
+                self._write(vault / folder / f"Note {index}.md", f"---\ntags: [benchmark]\n---\n\n# Note {index}\n\nBody text.\n")
+        return vault
+
+
+def measure(vault_path, source_path, mode, jobs):
+    """Run one setup in this process and return its wall time and peak memory (used in a child process)"""
+    sys.path.insert(0, str(SCRIPT_DIR))
+    import setup as obsidian_setup
+
+    run_options, setup_options, _ = MODES[mode]
+    context = dict(os.environ, **TEMPLATE_VARIABLES, VAULT_PATH=str(vault_path))
+    with open(os.devnull, "w", encoding="utf-8") as devnull:
+        setup = obsidian_setup.ObsidianSetup(
+            vault_path=vault_path,
+            source_path=source_path,
+            jobs=jobs,
+            template_context=obsidian_setup.MappingProxyType(context),
+            events=obsidian_setup.EventStream(stream=devnull),
+            **setup_options,
+        )
+        started = time.perf_counter()
+        success = setup.run_setup(**run_options)
+        seconds = time.perf_counter() - started
+
+    peak_rss = _peak_rss_bytes()
+    return {"success": success, "seconds": seconds, "peak_rss_bytes": peak_rss, "syscalls": dict(setup.snapshot.syscalls)}
+
+
+def _peak_rss_bytes():
+    try:
+        import resource
+    except ImportError:  # Windows
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def _run_child(vault_path, source_path, mode, jobs):
+    """Measure a run in a fresh interpreter so peak memory belongs to that run only"""
+    command = [sys.executable, str(Path(__file__).resolve()), "--measure", str(vault_path), str(source_path), mode, "--jobs", str(jobs)]
+    result = subprocess.run(command, capture_output=True, text=True, check=False)
+    if result.returncode != 0:
+        raise RuntimeError(f"Benchmark run failed ({mode}): {result.stderr.strip() or result.stdout.strip()}")
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def run_benchmarks(generator, modes, repeat, jobs, work_directory):
+    """Time every mode on cold (fresh) and warm (already set up) vaults
+
+    Modes that only configure an existing setup (--configure, --ignore-files) start their cold
+    runs from a vault that had its files copied, since they need the deployed config.json.
+    """
+    work = Path(work_directory)
+    source = generator.generate_source(work / "source")
+    pristine_vault = generator.generate_vault(work / "pristine-vault")
+    print(f"🏗️ Generated synthetic source and vault in {work}")
+
+    results = []
+    for mode in modes:
+        for state in ("cold", "warm"):
+            samples = []
+            for _ in range(repeat):
+                vault = work / f"vault-{mode}-{state}"
+                if vault.exists():
+                    shutil.rmtree(vault)
+                shutil.copytree(pristine_vault, vault, symlinks=True)
+                if MODES[mode][2]:
+                    _run_child(vault, source, "copy", jobs)
+                if state == "warm":
+                    _run_child(vault, source, mode, jobs)
+                samples.append(_run_child(vault, source, mode, jobs))
+
+            seconds = [sample["seconds"] for sample in samples]
+            result = {
+                "mode": mode,
+                "state": state,
+                "success": all(sample["success"] for sample in samples),
+                "seconds": seconds,
+                "median_seconds": statistics.median(seconds),
+                "min_seconds": min(seconds),
+                "peak_rss_bytes": max((sample["peak_rss_bytes"] or 0) for sample in samples) or None,
+                "syscalls": samples[-1]["syscalls"],
+            }
+            results.append(result)
+            status = "✅" if result["success"] else "❌"
+            peak = f"{result['peak_rss_bytes'] / (1024 * 1024):.1f} MiB" if result["peak_rss_bytes"] else "n/a"
+            print(f"{status} {mode:<13} {state:<5} median {result['median_seconds']:.3f}s  min {result['min_seconds']:.3f}s  peak {peak}")
+    return results
+
+
+def _git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=SCRIPT_DIR, capture_output=True, text=True, check=True).stdout.strip()
+    except Exception:
+        return None
+
+
+def compare_results(previous, current):
+    """Print the median time change of each mode/state against a previous results file"""
+    baseline = {(result["mode"], result["state"]): result for result in previous.get("results", [])}
+    print(f"📊 Compared with {previous.get('meta', {}).get('commit') or 'previous run'}:")
+    for result in current["results"]:
+        old = baseline.get((result["mode"], result["state"]))
+        if not old:
+            continue
+        change = (result["median_seconds"] - old["median_seconds"]) / old["median_seconds"] * 100 if old["median_seconds"] else 0.0
+        icon = "⚠️" if change > 10 else "✅"
+        print(f"   {icon} {result['mode']:<13} {result['state']:<5} {old['median_seconds']:.3f}s -> {result['median_seconds']:.3f}s ({change:+.1f}%)")
+
+
+def main():
+    """Main function"""
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description="Benchmark setup.py against synthetic vaults",
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog="""
+Examples:
+  python benchmark.py                               # Benchmark every mode at the default scale
+  python benchmark.py --scripts 200 --commands 50   # Smaller synthetic source tree
+  python benchmark.py --modes default copy          # Only benchmark some modes
+  python benchmark.py --compare old-results.json    # Compare with results saved from another commit
+        """,
+    )
+    parser.add_argument("--output", default="benchmark-results.json", help="Where to save results as JSON (default: benchmark-results.json)")
+    parser.add_argument("--compare", default=None, help="Compare with a previously saved results file")
+    parser.add_argument("--modes", nargs="+", choices=list(MODES), default=list(MODES), help="Modes to benchmark (default: all)")
+    parser.add_argument("--repeat", type=int, default=3, help="Timed runs per mode and vault state (default: 3)")
+    parser.add_argument("--jobs", type=int, default=1, help="Value passed as setup.py --jobs (default: 1)")
+    parser.add_argument("--scripts", type=int, default=2000, help="Number of Templater scripts (default: 2000)")
+    parser.add_argument("--commands", type=int, default=500, help="Number of Templater commands (default: 500)")
+    parser.add_argument("--css-files", type=int, default=200, help="Number of CSS snippets (default: 200)")
+    parser.add_argument("--css-depth", type=int, default=6, help="Maximum CssSnippets folder depth (default: 6)")
+    parser.add_argument("--plugins", type=int, default=100, help="Number of installed plugins in the vault (default: 100)")
+    parser.add_argument("--data-json-entries", type=int, default=5000, help="Folder templates in the existing Templater data.json (default: 5000)")
+    parser.add_argument("--keep", action="store_true", help="Keep the generated source tree and vaults")
+    parser.add_argument("--measure", nargs=3, metavar=("VAULT", "SOURCE", "MODE"), help=argparse.SUPPRESS)
+
+    args = parser.parse_args()
+
+    if args.measure:
+        vault_path, source_path, mode = args.measure
+        print(json.dumps(measure(vault_path, source_path, mode, args.jobs)))
+        return
+
+    if args.repeat < 1:
+        print("❌ --repeat must be at least 1.")
+        sys.exit(1)
+
+    generator = VaultGenerator(scripts=args.scripts, commands=args.commands, css_files=args.css_files, css_depth=args.css_depth, plugins=args.plugins, data_json_entries=args.data_json_entries)
+    work_directory = tempfile.mkdtemp(prefix="obsidian-setup-bench-")
+    try:
+        results = run_benchmarks(generator, args.modes, args.repeat, args.jobs, work_directory)
+    except Exception as e:
+        print(f"❌ Benchmark failed: {e}")
+        sys.exit(1)
+    finally:
+        if not args.keep:
+            shutil.rmtree(work_directory, ignore_errors=True)
+
+    report = {
+        "meta": {
+            "commit": _git_commit(),
+            "created": time.strftime("%Y-%m-%d %H:%M:%S"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "repeat": args.repeat,
+            "jobs": args.jobs,
+            "scale": generator.scale(),
+        },
+        "results": results,
+    }
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+    print(f"💾 Results saved to: {args.output}")
+
+    if args.compare:
+        try:
+            with open(args.compare, "r", encoding="utf-8") as f:
+                compare_results(json.load(f), report)
+        except Exception as e:
+            print(f"⚠️ Could not compare with {args.compare}: {e}")
+
+    if not all(result["success"] for result in results):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
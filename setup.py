@@ -1,540 +1,5484 @@
 #!/usr/bin/env python3
 
+import abc
+import asyncio
+import base64
+import contextlib
+import cProfile
+import ctypes
+import ctypes.util
+import difflib
+import errno
+import gzip
+import hashlib
+import io
+import itertools
 import json
+import mmap
+import operator
 import os
+import posixpath
+import pstats
+import random
+import re
+import select
+import sqlite3
 import string
+import struct
 import sys
 import shutil
+import stat
+import tarfile
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+import zipfile
+import zlib
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from functools import lru_cache
 from pathlib import Path
+from types import MappingProxyType
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+
+HASH_CHUNK_SIZE = 1024 * 1024
+COPY_CHUNK_SIZE = 1024 * 1024
+
+# Templated files larger than this are rendered line by line and spooled to disk instead of held in memory
+TEMPLATE_STREAM_THRESHOLD = 1024 * 1024
+
+# ioctl request for reflink clones (Btrfs, XFS and other copy-on-write filesystems on Linux)
+FICLONE = 0x40049409
+
+# Errors meaning "this copy method is not supported here", so the next method should be tried
+COPY_FALLBACK_ERRNOS = {errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.ENOTSUP, errno.ENOTSOCK, errno.EBADF, errno.EPERM, errno.ENOTTY}
+
+# Compressed archive members up to this size are staged in memory before being appended, larger ones on disk
+ARCHIVE_SPOOL_SIZE = 8 * 1024 * 1024
+
+# Everything the tool keeps in a vault (deploy manifest, caches, index, journal, lock and backups) lives in this folder
+STATE_DIRNAME = ".obsidian-setup"
+DEFAULT_BACKUP_DIRECTORY = f"{STATE_DIRNAME}/backup"
+
+# Where older versions kept their state in the vault root: {old name: name in the state folder, or None if it is dropped}
+LEGACY_STATE_PATHS = {
+    ".obsidian-setup-manifest.json": "manifest.json",
+    ".obsidian-setup-plugins.json": "plugins.json",
+    ".obsidian-setup-audit.json": "audit.json",
+    ".obsidian-setup-dedup.json": "dedup.json",
+    ".obsidian-setup-directories.json": "directories.json",
+    ".obsidian-setup-index.sqlite": "index.sqlite",
+    ".obsidian-setup-journal.json": "journal.json",
+    ".obsidian-setup-ai-cache": "ai-cache",
+    ".obsidian-setup-backup": "backup",
+    ".obsidian-setup.lock": None,
+    ".obsidian-setup-queue.json": None,
+}
+
+
+@lru_cache(maxsize=1)
+def current_umask():
+    """Return the process umask, so files written via temp files get the mode open() would give them
+
+    Read from /proc/self/status where the kernel reports it. Elsewhere the only way to read it is to
+    set it, so it is swapped with 0o077 for an instant: a file another thread creates meanwhile gets
+    owner-only permissions rather than world-writable ones.
+    """
+    with contextlib.suppress(OSError, ValueError):
+        with open("/proc/self/status", "r", encoding="ascii", errors="replace") as f:
+            for line in f:
+                if line.startswith("Umask:"):
+                    return int(line.split()[1], 8)
+    umask = os.umask(0o077)
+    os.umask(umask)
+    return umask
+
+
+def state_path(vault_path, name):
+    """Return the path of name in the vault's state folder, creating the folder if needed"""
+    state_directory = Path(vault_path) / STATE_DIRNAME
+    state_directory.mkdir(exist_ok=True)
+    return state_directory / name
+
+
+def migrate_legacy_state(vault_path, in_use=()):
+    """Move the state files older versions left in the vault root into the state folder
+
+    Paths in in_use (e.g. a backup folder still given with --backup-dir) stay where they are, and
+    nothing is moved over state that already exists in the folder.
+    """
+    vault_path = Path(vault_path)
+    for legacy_name, name in LEGACY_STATE_PATHS.items():
+        legacy_path = vault_path / legacy_name
+        if legacy_path in in_use or not os.path.lexists(legacy_path):
+            continue
+        with contextlib.suppress(FileNotFoundError):
+            if name is None:
+                os.unlink(legacy_path)
+            elif not os.path.lexists(state_path(vault_path, name)):
+                os.replace(legacy_path, state_path(vault_path, name))
+
+
+def hash_bytes(data):
+    """Return the sha256 hex digest of bytes"""
+    return hashlib.sha256(data).hexdigest()
+
+
+def hash_file(path):
+    """Return the sha256 hex digest of a file, reading it in chunks"""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        while chunk := f.read(HASH_CHUNK_SIZE):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def copy_fd(src_fd, dst_fd):
+    """Copy an open file into another with the fastest method available, returning the method used
+
+    Tries a reflink clone, then os.copy_file_range, then os.sendfile, then falls back to a chunked
+    read/write loop. Every method streams from the current offsets, so a method that fails midway
+    hands over to the next one without losing data, and memory use does not depend on file size.
+    """
+    if fcntl is not None and sys.platform.startswith("linux"):
+        try:
+            fcntl.ioctl(dst_fd, FICLONE, src_fd)
+            return "reflink"
+        except OSError:
+            pass
+
+    kernel_copies = []
+    if hasattr(os, "copy_file_range"):
+        kernel_copies.append(("copy_file_range", lambda: os.copy_file_range(src_fd, dst_fd, COPY_CHUNK_SIZE)))
+    if hasattr(os, "sendfile") and sys.platform.startswith("linux"):
+        kernel_copies.append(("sendfile", lambda: os.sendfile(dst_fd, src_fd, None, COPY_CHUNK_SIZE)))
+
+    for method, copy_chunk in kernel_copies:
+        try:
+            while copy_chunk():
+                pass
+            return method
+        except OSError as e:
+            if e.errno not in COPY_FALLBACK_ERRNOS:
+                raise
+
+    while chunk := os.read(src_fd, COPY_CHUNK_SIZE):
+        _write_all(dst_fd, chunk)
+    return "chunked"
+
+
+def _write_all(fd, data):
+    view = memoryview(data)
+    while view:
+        written = os.write(fd, view)
+        view = view[written:]
+
+
+def _replace_atomic(path, write, mode=None, fsync=False):
+    """Fill a temp file next to path through write(fd) and rename it into place
+
+    With fsync the data is flushed to disk before the rename, so a crash leaves either the old
+    or the new file, never an empty one."""
+    path = Path(path)
+    fd, temp_path = tempfile.mkstemp(dir=path.parent, prefix=f".{path.name}.", suffix=".tmp")
+    try:
+        try:
+            result = write(fd)
+            if fsync:
+                os.fsync(fd)
+        finally:
+            os.close(fd)
+        os.chmod(temp_path, mode if mode is not None else 0o666 & ~current_umask())
+        os.replace(temp_path, path)
+        return result
+    except BaseException:
+        try:
+            os.unlink(temp_path)
+        except OSError:
+            pass
+        raise
+
+
+def write_file_atomic(path, data, mode=None, fsync=False):
+    """Write bytes to a temp file next to path and rename it into place"""
+    _replace_atomic(path, lambda fd: _write_all(fd, data), mode, fsync)
+
+
+def fsync_directory(path):
+    """Flush a directory's entries (e.g. files just renamed into it) to disk; a no-op where unsupported"""
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def copy_file_atomic(source, path, mode=None):
+    """Stream a file's bytes to a temp file next to path and rename it into place"""
+    with open(source, "rb") as src:
+        return _replace_atomic(path, lambda fd: copy_fd(src.fileno(), fd), mode)
+
+
+def load_env_file(path):
+    """Parse KEY=VALUE lines from a .env file, ignoring blank lines and comments"""
+    values = {}
+    with open(path, "r", encoding="utf-8") as f:
+        for line_number, line in enumerate(f, 1):
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            if line.startswith("export "):
+                line = line[len("export ") :].lstrip()
+            key, separator, value = line.partition("=")
+            key = key.strip()
+            if not separator or not key:
+                raise ValueError(f"{path}:{line_number}: expected KEY=VALUE")
+            value = value.strip()
+            if len(value) >= 2 and value[0] == value[-1] and value[0] in "\"'":
+                value = value[1:-1]
+            values[key] = value
+    return values
+
+
+def build_template_context(env_file=None, overrides=None):
+    """Build the read-only variable context for templates: environment, then .env file, then --set overrides"""
+    context = dict(os.environ)
+    if env_file:
+        context.update(load_env_file(env_file))
+    if overrides:
+        context.update(overrides)
+    return MappingProxyType(context)
+
+
+class CompiledTemplate:
+    """A string.Template-compatible template parsed into literal text and variable names"""
+
+    def __init__(self, text):
+        self.segments = []
+        self.variables = set()
+        position = 0
+        for match in string.Template.pattern.finditer(text):
+            literal = text[position : match.start()]
+            position = match.end()
+            if match.group("escaped") is not None:
+                self._append_literal(literal + "$")
+            elif match.group("invalid") is not None:
+                start = match.start("invalid")
+                line_number = text.count("\n", 0, start) + 1
+                column = start - (text.rfind("\n", 0, start) + 1)
+                raise ValueError(f"Invalid placeholder in string: line {line_number}, col {column}")
+            else:
+                name = match.group("named") or match.group("braced")
+                self._append_literal(literal)
+                self.segments.append((True, name))
+                self.variables.add(name)
+        self._append_literal(text[position:])
+        self.variables = frozenset(self.variables)
+
+    @classmethod
+    def from_segments(cls, segments):
+        """Rebuild a template from the segments of an earlier parse (e.g. stored in a source bundle)"""
+        compiled = cls.__new__(cls)
+        compiled.segments = [(bool(is_variable), value) for is_variable, value in segments]
+        compiled.variables = frozenset(value for is_variable, value in compiled.segments if is_variable)
+        return compiled
+
+    def _append_literal(self, literal):
+        if not literal:
+            return
+        if self.segments and not self.segments[-1][0]:
+            self.segments[-1] = (False, self.segments[-1][1] + literal)
+        else:
+            self.segments.append((False, literal))
+
+    def render(self, context, missing):
+        """Render against context, adding unknown variable names to missing and leaving their placeholders as is"""
+        parts = []
+        for is_variable, value in self.segments:
+            if not is_variable:
+                parts.append(value)
+            elif value in context:
+                parts.append(str(context[value]))
+            else:
+                missing.add(value)
+                parts.append("${" + value + "}")
+        return "".join(parts)
+
+
+@lru_cache(maxsize=4096)
+def compile_template_line(line):
+    """Compile a single line of a streamed template (placeholders never span lines)"""
+    return CompiledTemplate(line)
+
+
+class RenderedTemplate:
+    """Rendered template output, spooled to disk once it grows past TEMPLATE_STREAM_THRESHOLD"""
+
+    def __init__(self):
+        self.file = tempfile.SpooledTemporaryFile(max_size=TEMPLATE_STREAM_THRESHOLD)
+        self.size = 0
+        self.missing = set()
+        self.source_hash = None
+        self._digest = hashlib.sha256()
+
+    @property
+    def rendered_hash(self):
+        return self._digest.hexdigest()
+
+    def write(self, data):
+        self.file.write(data)
+        self._digest.update(data)
+        self.size += len(data)
+
+    def write_to(self, fd):
+        """Copy the rendered bytes to an open file descriptor"""
+        self.file.seek(0)
+        while chunk := self.file.read(COPY_CHUNK_SIZE):
+            _write_all(fd, chunk)
+
+    def close(self):
+        self.file.close()
+
+
+class TemplateRenderer:
+    """Renders templated files against a frozen context, caching compiled templates by content hash"""
+
+    def __init__(self, context):
+        self.context = context
+        # Returns a source's bytes when sources are not plain files (see SourceBundle.read)
+        self.reader = None
+        self._compiled = {}
+        self._lock = threading.Lock()
+
+    def compile(self, text, content_hash=None):
+        """Return the compiled template for text, parsing it only the first time its content is seen"""
+        content_hash = content_hash or hash_bytes(text.encode("utf-8"))
+        with self._lock:
+            compiled = self._compiled.get(content_hash)
+        if compiled is None:
+            compiled = CompiledTemplate(text)
+            with self._lock:
+                self._compiled[content_hash] = compiled
+        return compiled
+
+    def export(self):
+        """Return the compiled template cache so it can be shared with another renderer"""
+        with self._lock:
+            return dict(self._compiled)
+
+    def preload(self, compiled):
+        """Seed the compiled template cache (e.g. with templates compiled by a fleet parent process)"""
+        with self._lock:
+            self._compiled.update(compiled)
+
+    def _iter_lines(self, source):
+        """Yield (raw bytes, compiled template) pairs for a source file, whole or line by line"""
+        if self.reader is not None:
+            data = self.reader(source)
+            if len(data) <= TEMPLATE_STREAM_THRESHOLD:
+                raw = bytes(data)
+                yield raw, self.compile(raw.decode("utf-8"), hash_bytes(raw))
+                return
+            for raw in io.BytesIO(data):
+                yield raw, compile_template_line(raw.decode("utf-8"))
+            return
+        source = Path(source)
+        if source.stat().st_size <= TEMPLATE_STREAM_THRESHOLD:
+            raw = source.read_bytes()
+            yield raw, self.compile(raw.decode("utf-8"), hash_bytes(raw))
+            return
+        with open(source, "rb") as f:
+            for raw in f:
+                yield raw, compile_template_line(raw.decode("utf-8"))
+
+    def variables(self, source):
+        """Return the variables a templated file uses"""
+        names = set()
+        for _, compiled in self._iter_lines(source):
+            names.update(compiled.variables)
+        return names
+
+    def missing_variables(self, source):
+        """Return the variables a templated file uses that are not in the context"""
+        return {name for name in self.variables(source) if name not in self.context}
+
+    def render(self, source):
+        """Render a templated file, raising ValueError listing every missing variable at once"""
+        rendered = RenderedTemplate()
+        source_digest = hashlib.sha256()
+        try:
+            for raw, compiled in self._iter_lines(source):
+                source_digest.update(raw)
+                rendered.write(compiled.render(self.context, rendered.missing).encode("utf-8"))
+            rendered.source_hash = source_digest.hexdigest()
+            if rendered.missing:
+                raise ValueError(f"missing template variables: {', '.join(sorted(rendered.missing))}")
+            return rendered
+        except BaseException:
+            rendered.close()
+            raise
+
+
+class DeployManifest:
+    """Persisted record of deployed files, used to skip targets that are already up to date"""
+
+    VERSION = 1
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.entries = {}
+        self.dirty = False
+        self._lock = threading.Lock()
+
+    def load(self):
+        """Load manifest entries from disk, starting empty if the file is missing or invalid"""
+        self.entries = {}
+        self.dirty = False
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            if data.get("version") == self.VERSION and isinstance(data.get("files"), dict):
+                self.entries = data["files"]
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            print(f"⚠️ Ignoring unreadable deploy manifest {self.path}: {e}", file=sys.stderr)
+        return self
+
+    def save(self, write=write_file_atomic):
+        """Write manifest entries to disk if anything changed, through write(path, data)"""
+        if not self.dirty:
+            return True
+        try:
+            write(self.path, json.dumps({"version": self.VERSION, "files": self.entries}, indent=2, sort_keys=True).encode("utf-8"))
+            self.dirty = False
+            return True
+        except Exception as e:
+            print(f"⚠️ Failed to save deploy manifest {self.path}: {e}", file=sys.stderr)
+            return False
+
+    def get(self, key):
+        return self.entries.get(key)
+
+    def record(self, key, source_stat, target_stat, source_hash, rendered_hash=None):
+        """Record the state of a deployed file"""
+        entry = {
+            "source_size": source_stat.st_size,
+            "source_mtime_ns": source_stat.st_mtime_ns,
+            "source_hash": source_hash,
+            "size": target_stat.st_size,
+            "mtime_ns": target_stat.st_mtime_ns,
+        }
+        if rendered_hash is not None:
+            entry["rendered_hash"] = rendered_hash
+        with self._lock:
+            if self.entries.get(key) != entry:
+                self.entries[key] = entry
+                self.dirty = True
+
+    def remove(self, key):
+        """Forget a deployed file"""
+        with self._lock:
+            if self.entries.pop(key, None) is not None:
+                self.dirty = True
+
+    def keys_under(self, key):
+        """Return the recorded keys equal to key or below it"""
+        with self._lock:
+            return [entry_key for entry_key in self.entries if entry_key == key or entry_key.startswith(key + "/")]
+
+    @staticmethod
+    def stat_matches(entry, stat_result, prefix=""):
+        """Check whether a stat result matches the size and mtime recorded in an entry"""
+        return entry.get(f"{prefix}size") == stat_result.st_size and entry.get(f"{prefix}mtime_ns") == stat_result.st_mtime_ns
+
+
+PLUGIN_VERSION_OPERATORS = {">=": operator.ge, "<=": operator.le, "==": operator.eq, "!=": operator.ne, ">": operator.gt, "<": operator.lt}
+
+
+def parse_version(version):
+    """Parse a version like "1.2.3" (or "1.2.3-beta.1") into a comparable tuple; "2.0" equals "2" """
+    parts = []
+    for part in str(version).split("-")[0].split("+")[0].split("."):
+        digits = re.match(r"\d+", part.strip())
+        parts.append(int(digits.group()) if digits else 0)
+    while len(parts) > 1 and parts[-1] == 0:
+        parts.pop()
+    return tuple(parts)
+
+
+def parse_plugin_requirement(requirement):
+    """Split a required_plugins entry like "templater-obsidian>=2.0,<3" into (plugin id, [(operator, version)])"""
+    found = re.fullmatch(r"\s*([^<>=!,\s]+)\s*(.*)", requirement)
+    if not found:
+        raise ValueError(f"invalid plugin requirement: {requirement!r}")
+    plugin_id, constraints = found.groups()
+    parsed = []
+    if constraints:
+        for constraint in constraints.split(","):
+            match = re.fullmatch(r"\s*(>=|<=|==|!=|>|<)\s*(\d[\w.+-]*)\s*", constraint)
+            if not match:
+                raise ValueError(f"invalid version constraint in {requirement!r}: {constraint.strip()!r}")
+            parsed.append((match.group(1), match.group(2)))
+    return plugin_id, parsed
+
+
+class PluginInventory:
+    """Parsed manifests of a vault's installed plugins, cached in the vault by manifest size and mtime
+
+    Only manifests that changed since the cache was written are read again, and those are parsed in
+    parallel. Lookups go through an in-memory index by plugin id and folder name.
+    """
+
+    VERSION = 1
+    MANIFEST_FIELDS = ("id", "name", "version", "minAppVersion", "author", "isDesktopOnly")
+
+    def __init__(self, plugins_path, cache_path, jobs=8):
+        self.plugins_path = Path(plugins_path)
+        self.cache_path = Path(cache_path)
+        self.jobs = max(1, jobs)
+        self.plugins = {}
+        self.parsed = 0
+        self.loaded = False
+        self._index = {}
+
+    def load(self):
+        """Scan the plugins folder, reusing cached manifests whose size and mtime are unchanged"""
+        cached = {}
+        try:
+            with open(self.cache_path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            if data.get("version") == self.VERSION and isinstance(data.get("plugins"), dict):
+                cached = data["plugins"]
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            print(f"⚠️ Ignoring unreadable plugin cache {self.cache_path}: {e}", file=sys.stderr)
+
+        plugins = {}
+        to_parse = []
+        try:
+            with os.scandir(self.plugins_path) as entries:
+                for entry in entries:
+                    if not entry.is_dir():
+                        continue
+                    manifest_path = os.path.join(entry.path, "manifest.json")
+                    try:
+                        stat_result = os.stat(manifest_path)
+                    except (FileNotFoundError, NotADirectoryError):
+                        continue
+                    record = cached.get(entry.name)
+                    if record and record.get("size") == stat_result.st_size and record.get("mtime_ns") == stat_result.st_mtime_ns:
+                        plugins[entry.name] = record
+                    else:
+                        to_parse.append((entry.name, manifest_path, stat_result))
+        except FileNotFoundError:
+            pass
+
+        if to_parse:
+            with ThreadPoolExecutor(max_workers=min(self.jobs, len(to_parse))) as executor:
+                for job, record in zip(to_parse, executor.map(self._parse_manifest, to_parse)):
+                    plugins[job[0]] = record
+
+        self.parsed = len(to_parse)
+        self.plugins = plugins
+        self._index = {}
+        for folder, record in plugins.items():
+            self._index[folder] = record
+            plugin_id = record.get("manifest", {}).get("id")
+            if plugin_id:
+                self._index.setdefault(plugin_id, record)
+        self.loaded = True
+
+        if plugins != cached:
+            self.save()
+        return self
+
+    @classmethod
+    def _parse_manifest(cls, job):
+        _, manifest_path, stat_result = job
+        record = {"size": stat_result.st_size, "mtime_ns": stat_result.st_mtime_ns}
+        try:
+            with open(manifest_path, "r", encoding="utf-8") as f:
+                manifest = json.load(f)
+            if not isinstance(manifest, dict):
+                raise ValueError("manifest must be an object")
+            missing = [field for field in ("id", "version") if not isinstance(manifest.get(field), str)]
+            if missing:
+                raise ValueError(f"manifest is missing {', '.join(missing)}")
+            record["manifest"] = {field: manifest[field] for field in cls.MANIFEST_FIELDS if field in manifest}
+        except Exception as e:
+            record["error"] = str(e)
+        return record
+
+    def save(self):
+        """Write the cache to the vault"""
+        try:
+            write_file_atomic(self.cache_path, json.dumps({"version": self.VERSION, "plugins": self.plugins}, indent=2, sort_keys=True).encode("utf-8"))
+            return True
+        except Exception as e:
+            print(f"⚠️ Failed to save plugin cache {self.cache_path}: {e}", file=sys.stderr)
+            return False
+
+    def get(self, plugin_id):
+        """Return the inventory record ({"manifest": ...} or {"error": ...}) of a plugin, or None"""
+        if not self.loaded:
+            self.load()
+        return self._index.get(plugin_id)
+
+    def list(self):
+        """Return (folder, record) pairs sorted by folder name"""
+        if not self.loaded:
+            self.load()
+        return sorted(self.plugins.items())
+
+    def check(self, requirement, app_version=None):
+        """Check a required_plugins entry; return (status, message) with status ok, missing, broken, version or app"""
+        plugin_id, constraints = parse_plugin_requirement(requirement)
+        record = self.get(plugin_id)
+        if record is None:
+            return "missing", f"{plugin_id} is not installed"
+        if "error" in record:
+            return "broken", f"{plugin_id} has an unreadable manifest ({record['error']})"
+
+        manifest = record["manifest"]
+        version = manifest["version"]
+        failed = [f"{operator_name}{wanted}" for operator_name, wanted in constraints if not PLUGIN_VERSION_OPERATORS[operator_name](parse_version(version), parse_version(wanted))]
+        if failed:
+            return "version", f"{plugin_id} {version} does not satisfy {','.join(failed)}"
+
+        min_app_version = manifest.get("minAppVersion")
+        if app_version and min_app_version and parse_version(min_app_version) > parse_version(app_version):
+            return "app", f"{plugin_id} {version} needs Obsidian {min_app_version} or newer (have {app_version})"
+        return "ok", f"{plugin_id} {version}"
+
+
+def file_signature(path):
+    """Return (mtime_ns, size) for a file, or None if it does not exist"""
+    try:
+        stat_result = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return (stat_result.st_mtime_ns, stat_result.st_size)
+
+
+_json_cache = {}
+_json_cache_lock = threading.Lock()
+
+
+def load_json_cached(path):
+    """Load a JSON file, re-parsing it only when its mtime or size changed since the last load"""
+    path = str(path)
+    signature = file_signature(path)
+    if signature is None:
+        raise FileNotFoundError(f"File not found: {path}")
+    with _json_cache_lock:
+        cached = _json_cache.get(path)
+    if cached and cached[0] == signature:
+        return cached[1]
+    with open(path, "r", encoding="utf-8") as f:
+        data = json.load(f)
+    with _json_cache_lock:
+        _json_cache[path] = (signature, data)
+    return data
+
+
+def merge_config(base, overlay):
+    """Deep-merge overlay into a copy of base; nested objects merge, other values replace, nulls are ignored"""
+    merged = dict(base)
+    for key, value in overlay.items():
+        if value is None:
+            continue
+        if isinstance(value, dict) and isinstance(merged.get(key), dict):
+            merged[key] = merge_config(merged[key], value)
+        else:
+            merged[key] = value
+    return merged
+
+
+def describe_config_changes(old, new, limit=10):
+    """Return a key-level diff of two JSON objects as lines; list values report added and removed items"""
+    lines = []
+    missing = object()
+    for key in sorted(old.keys() | new.keys()):
+        before, after = old.get(key, missing), new.get(key, missing)
+        if before == after:
+            continue
+        if isinstance(before, list) and isinstance(after, list):
+            before_items = [json.dumps(item, sort_keys=True, ensure_ascii=False) for item in before]
+            after_items = [json.dumps(item, sort_keys=True, ensure_ascii=False) for item in after]
+            before_set, after_set = set(before_items), set(after_items)
+            added = [item for item in after_items if item not in before_set]
+            removed = [item for item in before_items if item not in after_set]
+            if not added and not removed:
+                lines.append(f"~ {key}: reordered")
+                continue
+            lines.append(f"~ {key}: +{len(added)} -{len(removed)}")
+            changed = [f"  + {item}" for item in added] + [f"  - {item}" for item in removed]
+            lines.extend(changed[:limit])
+            if len(changed) > limit:
+                lines.append(f"  ... and {len(changed) - limit} more")
+        elif before is missing:
+            lines.append(f"+ {key}: {json.dumps(after, ensure_ascii=False)}")
+        elif after is missing:
+            lines.append(f"- {key}")
+        else:
+            lines.append(f"~ {key}: {json.dumps(before, ensure_ascii=False)} -> {json.dumps(after, ensure_ascii=False)}")
+    return lines
+
+
+class LayeredConfig:
+    """Vault config.json merged over the source config.json, with a precomputed index of dotted paths"""
+
+    REQUIRED_PATHS = ("templates_folder", "user_scripts_folder", "commands_folder", "startup_template")
+    PATH_LISTS = ("note_directories", "clipping_directories", "daily_note_directories", "sensitive")
+
+    def __init__(self, source_config_path, vault_config_path):
+        self.layers = (Path(source_config_path), Path(vault_config_path))
+        self.data = {}
+        self.index = {}
+        self.errors = []
+        self._signatures = None
+        self._pinned = {}
+        self._redirects = {}
+
+    def redirect(self, layer, path):
+        """Read a layer from another file (e.g. its staged replacement in a transaction); None reads the layer again"""
+        layer = Path(layer)
+        if path is None:
+            self._redirects.pop(layer, None)
+        else:
+            self._redirects[layer] = Path(path)
+        self._signatures = None
+
+    def pin(self, layer, data):
+        """Use already parsed data for a layer instead of reading it from disk (e.g. a source bundle's config.json)"""
+        self._pinned[Path(layer)] = data
+        self._signatures = None
+
+    def refresh(self):
+        """Rebuild the merged config if either layer was created, removed or modified"""
+        signatures = tuple(("pinned",) if layer in self._pinned else file_signature(self._redirects.get(layer, layer)) for layer in self.layers)
+        if signatures == self._signatures:
+            return self
+        self._signatures = signatures
+
+        merged = {}
+        self.errors = []
+        for layer, signature in zip(self.layers, signatures):
+            if signature is None:
+                continue
+            try:
+                data = self._pinned[layer] if layer in self._pinned else load_json_cached(self._redirects.get(layer, layer))
+            except Exception as e:
+                self.errors.append(f"{layer}: {e}")
+                continue
+            if not isinstance(data, dict):
+                self.errors.append(f"{layer}: top level must be an object")
+                continue
+            merged = merge_config(merged, data)
+
+        self.data = merged
+        self.index = {}
+        self._index(merged, "")
+        self.errors.extend(self.validate(merged))
+        return self
+
+    def _index(self, node, prefix):
+        for key, value in node.items():
+            path = f"{prefix}{key}"
+            self.index[path] = value
+            if isinstance(value, dict):
+                self._index(value, f"{path}.")
+
+    def get(self, path, default=None):
+        """Get a value by dotted path (e.g. "paths.commands_folder")"""
+        value = self.refresh().index.get(path)
+        return default if value is None else value
+
+    @classmethod
+    def validate(cls, config):
+        """Return a list of schema errors for the paths, required_plugins, ignore_files, templater and ai sections"""
+        errors = []
+
+        def is_string_list(value):
+            return isinstance(value, list) and all(isinstance(item, str) for item in value)
+
+        required_plugins = config.get("required_plugins", [])
+        if not is_string_list(required_plugins):
+            errors.append("required_plugins must be a list of strings")
+        else:
+            for requirement in required_plugins:
+                try:
+                    parse_plugin_requirement(requirement)
+                except ValueError as e:
+                    errors.append(f"required_plugins: {e}")
+
+        paths = config.get("paths")
+        if not isinstance(paths, dict):
+            errors.append("paths must be an object")
+        else:
+            for key in cls.REQUIRED_PATHS:
+                if key not in paths:
+                    errors.append(f"paths.{key} is required")
+            for key, value in paths.items():
+                if key in cls.PATH_LISTS and not is_string_list(value):
+                    errors.append(f"paths.{key} must be a list of strings")
+                elif key not in cls.PATH_LISTS and not isinstance(value, str) and not is_string_list(value):
+                    errors.append(f"paths.{key} must be a string or a list of strings")
+
+        ignore_files = config.get("ignore_files", {})
+        if not isinstance(ignore_files, dict):
+            errors.append("ignore_files must be an object")
+        else:
+            for name, override in ignore_files.items():
+                if is_string_list(override):
+                    continue
+                if isinstance(override, dict) and set(override) <= {"add", "remove"} and all(is_string_list(value) for value in override.values()):
+                    continue
+                errors.append(f"ignore_files.{name} must be a list of patterns or an object with add/remove lists")
+
+        templater = config.get("templater", {})
+        if not isinstance(templater, dict):
+            errors.append("templater must be an object")
+        elif not isinstance(templater.get("preserve_user_entries", False), bool):
+            errors.append("templater.preserve_user_entries must be a boolean")
+
+        ai = config.get("ai", {})
+        if not isinstance(ai, dict):
+            errors.append("ai must be an object")
+        else:
+            for key, value in ai.items():
+                if not isinstance(value, (str, int, float, bool, dict)) and value is not None:
+                    errors.append(f"ai.{key} must be a string, number, boolean or object")
+            for key in ("gemini_endpoint", "ollama_endpoint"):
+                if key in ai and not (isinstance(ai[key], str) and ai[key].startswith(("http://", "https://"))):
+                    errors.append(f"ai.{key} must be an http(s) URL")
+            batch = ai.get("batch", {})
+            if not isinstance(batch, dict):
+                errors.append("ai.batch must be an object")
+            else:
+                for key, value in batch.items():
+                    if key not in AI_BATCH_DEFAULTS:
+                        errors.append(f"ai.batch.{key} is not a known setting ({', '.join(AI_BATCH_DEFAULTS)})")
+                    elif isinstance(value, bool) or not isinstance(value, (int, float)) or value < 0:
+                        errors.append(f"ai.batch.{key} must be a non-negative number")
+                    elif key == "concurrency" and (value < 1 or value != int(value)):
+                        errors.append("ai.batch.concurrency must be a positive integer")
+
+        return errors
+
+
+def new_snapshot_id(root):
+    """Return a timestamp id that no backup generation under root uses yet, in either backup format"""
+    root = Path(root)
+    base = snapshot_id = time.strftime("%Y%m%d-%H%M%S")
+    suffix = 1
+    while (root / "snapshots" / f"{snapshot_id}.json").exists() or (root / "archives" / f"{snapshot_id}.index.json").exists():
+        suffix += 1
+        snapshot_id = f"{base}-{suffix}"
+    return snapshot_id
+
+
+class BackupStore:
+    """Content-addressed backup store: file contents are stored once under objects/<hash>, and
+    each run that backs something up writes one snapshot manifest under snapshots/<id>.json"""
+
+    def __init__(self, root):
+        self.root = Path(root)
+        self.objects_path = self.root / "objects"
+        self.snapshots_path = self.root / "snapshots"
+        self.files = {}
+        self._lock = threading.Lock()
+
+    def object_path(self, digest):
+        return self.objects_path / digest[:2] / digest[2:]
+
+    def store(self, path):
+        """Store a file's contents, hashing and copying it in one pass, and return its hash"""
+        self.objects_path.mkdir(parents=True, exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=self.objects_path, prefix=".incoming-")
+        try:
+            digest = hashlib.sha256()
+            with open(path, "rb") as src, os.fdopen(fd, "wb") as dst:
+                while chunk := src.read(COPY_CHUNK_SIZE):
+                    digest.update(chunk)
+                    dst.write(chunk)
+            object_path = self.object_path(digest.hexdigest())
+            if object_path.exists():
+                os.unlink(temp_path)
+            else:
+                object_path.parent.mkdir(exist_ok=True)
+                os.replace(temp_path, object_path)
+            return digest.hexdigest()
+        except BaseException:
+            with contextlib.suppress(OSError):
+                os.unlink(temp_path)
+            raise
+
+    def add(self, path, key, name=None, content_hash=None):
+        """Add a file to the pending snapshot; content already in the store is not read again"""
+        stat_result = os.stat(path)
+        if not (content_hash and self.object_path(content_hash).exists()):
+            content_hash = self.store(path)
+        with self._lock:
+            self.files[key] = {"hash": content_hash, "size": stat_result.st_size, "mode": stat_result.st_mode & 0o7777, "name": str(name or key)}
+        return content_hash
+
+    def discard(self):
+        """Drop the pending snapshot (its objects are removed by the next prune unless referenced)"""
+        with self._lock:
+            self.files = {}
+
+    def commit(self, vault_path, run_id=None):
+        """Write the pending snapshot manifest and return its id (None if nothing was backed up)"""
+        with self._lock:
+            files, self.files = self.files, {}
+        if not files:
+            return None
+
+        self.snapshots_path.mkdir(parents=True, exist_ok=True)
+        snapshot_id = new_snapshot_id(self.root)
+
+        snapshot = {"id": snapshot_id, "created": time.strftime("%Y-%m-%d %H:%M:%S"), "vault": str(vault_path), "run": run_id, "files": files}
+        write_file_atomic(self.snapshots_path / f"{snapshot_id}.json", json.dumps(snapshot, indent=2, sort_keys=True).encode("utf-8"))
+        return snapshot_id
+
+    def list_snapshots(self):
+        """Return all snapshot manifests, oldest first"""
+        snapshots = []
+        if not self.snapshots_path.is_dir():
+            return snapshots
+        for path in sorted(self.snapshots_path.glob("*.json")):
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    snapshots.append(json.load(f))
+            except Exception as e:
+                print(f"⚠️ Ignoring unreadable backup snapshot {path}: {e}", file=sys.stderr)
+        snapshots.sort(key=lambda snapshot: (snapshot.get("created", ""), snapshot.get("id", "")))
+        return snapshots
+
+    def find_snapshot(self, reference):
+        """Find a snapshot by id, unique id prefix, or "latest" """
+        snapshots = self.list_snapshots()
+        if reference == "latest":
+            return snapshots[-1] if snapshots else None
+        matches = [snapshot for snapshot in snapshots if snapshot.get("id") == reference]
+        if not matches:
+            matches = [snapshot for snapshot in snapshots if str(snapshot.get("id", "")).startswith(reference)]
+        return matches[0] if len(matches) == 1 else None
+
+    def has(self, snapshot, key):
+        return self.object_path(snapshot["files"][key]["hash"]).exists()
+
+    def extract(self, snapshot, key, target, mode=None):
+        """Write a backed up file to target atomically"""
+        copy_file_atomic(self.object_path(snapshot["files"][key]["hash"]), target, mode)
+
+    def prune(self, keep):
+        """Delete all but the newest keep snapshots, then any objects no snapshot refers to"""
+        snapshots = self.list_snapshots()
+        if keep is None or len(snapshots) <= keep:
+            return 0, 0
+
+        removed_snapshots = 0
+        for snapshot in snapshots[: len(snapshots) - keep]:
+            with contextlib.suppress(FileNotFoundError):
+                os.unlink(self.snapshots_path / f"{snapshot['id']}.json")
+                removed_snapshots += 1
+        return removed_snapshots, self.collect_garbage()
+
+    def collect_garbage(self):
+        """Delete the objects no snapshot manifest on disk refers to, returning how many were deleted
+
+        If any manifest cannot be read, every object is kept: it may be the only copy of a file that
+        manifest points to.
+        """
+        referenced = set()
+        for path in self.snapshots_path.glob("*.json"):
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    referenced.update(info["hash"] for info in json.load(f)["files"].values())
+            except Exception as e:
+                print(f"⚠️ Keeping all backup objects: cannot read snapshot {path}: {e}", file=sys.stderr)
+                return 0
+
+        removed_objects = 0
+        try:
+            prefixes = list(os.scandir(self.objects_path))
+        except FileNotFoundError:
+            return 0
+        for prefix in prefixes:
+            if not prefix.is_dir():
+                continue
+            for item in os.scandir(prefix.path):
+                if prefix.name + item.name not in referenced:
+                    os.unlink(item.path)
+                    removed_objects += 1
+        return removed_objects
+
+
+class ArchiveBackupStore:
+    """Backup store that writes each run's backups into one compressed tar archive
+
+    Every member is written as its own gzip stream, so the archive is still a valid .tar.gz, and a
+    sidecar index records each member's offset so a single file can be extracted by seeking to it
+    instead of decompressing the whole archive. Files are streamed in chunks, so memory stays
+    bounded. Old generations are rotated by prune().
+    """
+
+    def __init__(self, root):
+        self.root = Path(root)
+        self.archives_path = self.root / "archives"
+        self._lock = threading.Lock()
+        self._archive = None
+        self._temp_path = None
+        self.files = {}
+
+    def archive_path(self, snapshot_id):
+        return self.archives_path / f"{snapshot_id}.tar.gz"
+
+    def index_path(self, snapshot_id):
+        return self.archives_path / f"{snapshot_id}.index.json"
+
+    def add(self, path, key, name=None, content_hash=None):
+        """Append a file to this run's archive as a separately compressed tar member
+
+        The member is compressed into a spooled temp file first, so parallel backups only take the
+        lock to append the finished member to the archive.
+        """
+        stat_result = os.stat(path)
+        tarinfo = tarfile.TarInfo(key)
+        tarinfo.size = stat_result.st_size
+        tarinfo.mode = stat_result.st_mode & 0o7777
+        tarinfo.mtime = int(stat_result.st_mtime)
+
+        digest = hashlib.sha256()
+        with tempfile.SpooledTemporaryFile(max_size=ARCHIVE_SPOOL_SIZE) as compressed:
+            with open(path, "rb") as src, gzip.GzipFile(fileobj=compressed, mode="wb", mtime=0) as member:
+                member.write(tarinfo.tobuf(tarfile.PAX_FORMAT))
+                written = 0
+                while chunk := src.read(COPY_CHUNK_SIZE):
+                    digest.update(chunk)
+                    member.write(chunk)
+                    written += len(chunk)
+                if written != tarinfo.size:
+                    raise OSError(f"{path} changed size while being backed up")
+                member.write(b"\0" * (-written % tarfile.BLOCKSIZE))
+            length = compressed.tell()
+            compressed.seek(0)
+
+            with self._lock:
+                if self._archive is None:
+                    self.archives_path.mkdir(parents=True, exist_ok=True)
+                    fd, self._temp_path = tempfile.mkstemp(dir=self.archives_path, prefix=".incoming-", suffix=".tar.gz")
+                    self._archive = os.fdopen(fd, "wb")
+                offset = self._archive.tell()
+                shutil.copyfileobj(compressed, self._archive, COPY_CHUNK_SIZE)
+                self.files[key] = {"hash": digest.hexdigest(), "size": tarinfo.size, "mode": tarinfo.mode, "name": str(name or key), "offset": offset, "length": length}
+        return digest.hexdigest()
+
+    def discard(self):
+        """Drop this run's unfinished archive"""
+        with self._lock:
+            archive, temp_path = self._archive, self._temp_path
+            self._archive, self.files, self._temp_path = None, {}, None
+        if archive is not None:
+            archive.close()
+            with contextlib.suppress(OSError):
+                os.unlink(temp_path)
+
+    def commit(self, vault_path, run_id=None):
+        """Finish the archive, write its index and return the snapshot id (None if nothing was backed up)"""
+        with self._lock:
+            archive, files, temp_path = self._archive, self.files, self._temp_path
+            self._archive, self.files, self._temp_path = None, {}, None
+        if archive is None:
+            return None
+
+        try:
+            # End-of-archive marker: two zero blocks, in a final gzip stream of their own
+            with gzip.GzipFile(fileobj=archive, mode="wb", mtime=0) as member:
+                member.write(b"\0" * (2 * tarfile.BLOCKSIZE))
+            archive.flush()
+            os.fsync(archive.fileno())
+        finally:
+            archive.close()
+
+        snapshot_id = new_snapshot_id(self.root)
+
+        os.chmod(temp_path, 0o666 & ~current_umask())
+        os.replace(temp_path, self.archive_path(snapshot_id))
+        index = {"id": snapshot_id, "created": time.strftime("%Y-%m-%d %H:%M:%S"), "vault": str(vault_path), "archive": self.archive_path(snapshot_id).name, "run": run_id, "files": files}
+        write_file_atomic(self.index_path(snapshot_id), json.dumps(index, indent=2, sort_keys=True).encode("utf-8"))
+        return snapshot_id
+
+    def list_snapshots(self):
+        """Return the index of every archive generation, oldest first"""
+        snapshots = []
+        if not self.archives_path.is_dir():
+            return snapshots
+        for path in sorted(self.archives_path.glob("*.index.json")):
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    snapshots.append(json.load(f))
+            except Exception as e:
+                print(f"⚠️ Ignoring unreadable backup archive index {path}: {e}", file=sys.stderr)
+        snapshots.sort(key=lambda snapshot: (snapshot.get("created", ""), snapshot.get("id", "")))
+        return snapshots
+
+    find_snapshot = BackupStore.find_snapshot
+
+    def has(self, snapshot, key):
+        return self.archive_path(snapshot["id"]).exists()
+
+    def extract(self, snapshot, key, target, mode=None):
+        """Stream one member out of an archive by seeking to its offset from the index"""
+        info = snapshot["files"][key]
+        with open(self.archive_path(snapshot["id"]), "rb") as raw:
+            raw.seek(info["offset"])
+            with gzip.GzipFile(fileobj=raw, mode="rb") as member, tarfile.open(fileobj=member, mode="r|") as tar:
+                stream = tar.extractfile(tar.next())
+
+                def write(fd):
+                    while chunk := stream.read(COPY_CHUNK_SIZE):
+                        _write_all(fd, chunk)
+
+                _replace_atomic(target, write, mode)
+
+    def prune(self, keep):
+        """Delete all but the newest keep archive generations"""
+        snapshots = self.list_snapshots()
+        if keep is None or len(snapshots) <= keep:
+            return 0, 0
+
+        removed = 0
+        for snapshot in snapshots[: len(snapshots) - keep]:
+            for path in (self.archive_path(snapshot["id"]), self.index_path(snapshot["id"])):
+                with contextlib.suppress(FileNotFoundError):
+                    os.unlink(path)
+            removed += 1
+        return removed, 0
+
+
+class BackupCatalog:
+    """Every backup generation in a backup directory, whichever format wrote it
+
+    New backups go to the store picked by --backup-format; listing, restore and pruning cover the
+    object store and the archives alike, so switching formats never hides older generations.
+    """
+
+    def __init__(self, root, backup_format="store"):
+        self.stores = {"store": BackupStore(root), "archive": ArchiveBackupStore(root)}
+        self.writer = self.stores[backup_format]
+
+    def add(self, path, key, name=None, content_hash=None):
+        return self.writer.add(path, key, name, content_hash)
+
+    def discard(self):
+        self.writer.discard()
+
+    def commit(self, vault_path, run_id=None):
+        return self.writer.commit(vault_path, run_id)
+
+    def list_snapshots(self):
+        """Return the snapshots of both stores, oldest first, each tagged with its "format" """
+        snapshots = [{**snapshot, "format": backup_format} for backup_format, store in self.stores.items() for snapshot in store.list_snapshots()]
+        snapshots.sort(key=lambda snapshot: (snapshot.get("created", ""), snapshot.get("id", "")))
+        return snapshots
+
+    find_snapshot = BackupStore.find_snapshot
+
+    def has(self, snapshot, key):
+        return self.stores[snapshot["format"]].has(snapshot, key)
+
+    def extract(self, snapshot, key, target, mode=None):
+        self.stores[snapshot["format"]].extract(snapshot, key, target, mode)
+
+    def prune(self, keep):
+        """Delete all but the newest keep generations across both formats, then unreferenced objects"""
+        snapshots = self.list_snapshots()
+        if keep is None or len(snapshots) <= keep:
+            return 0, 0
+
+        store, archives = self.stores["store"], self.stores["archive"]
+        removed = 0
+        for snapshot in snapshots[: len(snapshots) - keep]:
+            if snapshot["format"] == "archive":
+                paths = (archives.archive_path(snapshot["id"]), archives.index_path(snapshot["id"]))
+            else:
+                paths = (store.snapshots_path / f"{snapshot['id']}.json",)
+            for path in paths:
+                with contextlib.suppress(FileNotFoundError):
+                    os.unlink(path)
+            removed += 1
+        return removed, store.collect_garbage()
+
+
+class VaultTransaction:
+    """Write-ahead journal that makes one run's vault writes all-or-nothing
+
+    Writes are staged as temp files next to their targets, so committing is a burst of renames on
+    the same filesystem. Before the first rename the journal (every staged rename and the folders
+    the run created) is written and flushed, and each target about to be replaced is hard-linked
+    aside, so undoing is another burst of renames. A commit interrupted by a crash is rolled back
+    by the next run from the journal (see recover).
+    """
+
+    JOURNAL_FILENAME = "journal.json"
+    VERSION = 1
+
+    def __init__(self, vault_path, snapshot):
+        self.vault_path = Path(vault_path)
+        self.journal_path = state_path(self.vault_path, self.JOURNAL_FILENAME)
+        self.id = f"{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}"
+        self.snapshot = snapshot
+        self.state = "open"
+        self.staged = {}
+        self._directory_mark = len(snapshot.created_directories)
+        self._lock = threading.Lock()
+
+    def stage(self, path, write, mode=None, fsync=False):
+        """Fill a temp file next to path through write(fd) and remember the rename; returns the temp file's stat"""
+        path = Path(path)
+        fd, temp_path = tempfile.mkstemp(dir=path.parent, prefix=f".{path.name}.", suffix=f".{self.id}.staged")
+        try:
+            try:
+                write(fd)
+                if fsync:
+                    os.fsync(fd)
+            finally:
+                os.close(fd)
+            os.chmod(temp_path, mode if mode is not None else 0o666 & ~current_umask())
+            stat_result = os.stat(temp_path)
+            with self._lock:
+                if self.state != "open":
+                    raise RuntimeError(f"transaction {self.id} is already {self.state}")
+                previous = self.staged.get(os.path.abspath(path))
+                self.staged[os.path.abspath(path)] = temp_path
+        except BaseException:
+            with contextlib.suppress(OSError):
+                os.unlink(temp_path)
+            raise
+        if previous:
+            with contextlib.suppress(OSError):
+                os.unlink(previous)
+        return stat_result
+
+    def staged_path(self, path):
+        """Return the temp file holding path's staged content, or None"""
+        with self._lock:
+            return self.staged.get(os.path.abspath(path))
+
+    def created_directories(self):
+        return self.snapshot.created_directories[self._directory_mark :]
+
+    def commit(self):
+        """Rename every staged file into place, undoing the renames already made if anything fails"""
+        with self._lock:
+            if self.state != "open":
+                raise RuntimeError(f"transaction {self.id} is already {self.state}")
+            self.state = "committing"
+            entries = [{"target": target, "staged": staged, "previous": staged[: -len(".staged")] + ".previous"} for target, staged in sorted(self.staged.items())]
+        if not entries:
+            self.state = "committed"
+            return 0
+
+        journal = {"version": self.VERSION, "id": self.id, "state": "committing", "renames": entries, "directories": self.created_directories()}
+        try:
+            write_file_atomic(self.journal_path, json.dumps(journal, indent=2).encode("utf-8"), fsync=True)
+            fsync_directory(self.vault_path)
+            for entry in entries:
+                try:
+                    os.link(entry["target"], entry["previous"])
+                except FileNotFoundError:
+                    pass  # a new file: undoing the rename means removing it
+                except OSError:  # no hard links on this filesystem
+                    shutil.copy2(entry["target"], entry["previous"])
+                os.replace(entry["staged"], entry["target"])
+            for parent in sorted({os.path.dirname(entry["target"]) for entry in entries}):
+                fsync_directory(parent)
+            journal["state"] = "committed"
+            write_file_atomic(self.journal_path, json.dumps(journal, indent=2).encode("utf-8"), fsync=True)
+        except BaseException:
+            self.undo(entries, journal["directories"])
+            with contextlib.suppress(OSError):
+                os.unlink(self.journal_path)
+            self.state = "rolled back"
+            raise
+
+        self.state = "committed"
+        self.finish(entries)
+        with contextlib.suppress(OSError):
+            os.unlink(self.journal_path)
+        return len(entries)
+
+    def rollback(self):
+        """Discard every staged write and remove the folders this run created; returns the number discarded"""
+        with self._lock:
+            if self.state != "open":
+                return 0
+            self.state = "rolled back"
+            staged = list(self.staged.values())
+        for temp_path in staged:
+            with contextlib.suppress(OSError):
+                os.unlink(temp_path)
+        self.remove_directories(self.created_directories())
+        return len(staged)
+
+    @staticmethod
+    def undo(entries, directories):
+        """Put back what the journaled renames replaced, whether or not each rename happened"""
+        for entry in reversed(entries):
+            if os.path.lexists(entry["staged"]):
+                # Never renamed: drop the staged file and any link made just before the crash
+                for path in (entry["staged"], entry["previous"]):
+                    with contextlib.suppress(FileNotFoundError):
+                        os.unlink(path)
+            elif os.path.lexists(entry["previous"]):
+                os.replace(entry["previous"], entry["target"])
+            else:
+                with contextlib.suppress(FileNotFoundError):
+                    os.unlink(entry["target"])
+        VaultTransaction.remove_directories(directories)
+
+    @staticmethod
+    def finish(entries):
+        """Delete the pre-commit links once a commit is final"""
+        for entry in entries:
+            with contextlib.suppress(FileNotFoundError):
+                os.unlink(entry["previous"])
+
+    @staticmethod
+    def remove_directories(directories):
+        for directory in reversed(directories):
+            with contextlib.suppress(OSError):
+                os.rmdir(directory)
+
+    @classmethod
+    def recover(cls, vault_path):
+        """Finish or roll back a transaction left behind by an interrupted run; returns (id, outcome) or None"""
+        journal_path = Path(vault_path) / STATE_DIRNAME / cls.JOURNAL_FILENAME
+        try:
+            with open(journal_path, "r", encoding="utf-8") as f:
+                journal = json.load(f)
+        except FileNotFoundError:
+            return None
+        if journal.get("version") != cls.VERSION:
+            raise ValueError(f"unsupported journal version in {journal_path}")
+        if journal.get("state") == "committed":
+            cls.finish(journal["renames"])
+            outcome = "completed"
+        else:
+            cls.undo(journal["renames"], journal.get("directories", []))
+            outcome = "rolled back"
+        os.unlink(journal_path)
+        return journal.get("id"), outcome
+
+
+# Lock waits shorter than this (seconds) are only reported as JSON events, not in the text output
+LOCK_WAIT_REPORT_THRESHOLD = 0.01
+
+
+class VaultRunQueue:
+    """Serializes runs against one vault with fcntl advisory locks, merging identical runs that queue up
+
+    Before waiting for the vault lock, a run takes a ticket for its kind of work (its signature). A
+    run that starts covers every ticket of its signature issued so far, because it reads the source
+    and the vault after they were issued. So a run that gets the lock after an identical, later
+    started run has succeeded has nothing left to do: a burst of identical runs collapses into the
+    one in progress plus a single follow-up run. Without fcntl (Windows) runs are not serialized.
+    """
+
+    LOCK_FILENAME = "lock"
+    QUEUE_FILENAME = "queue.json"
+
+    def __init__(self, vault_path, signature):
+        self.lock_path = state_path(vault_path, self.LOCK_FILENAME)
+        self.queue_path = state_path(vault_path, self.QUEUE_FILENAME)
+        self.signature = signature
+        self.wait = 0.0
+        self.coalesced = False  # an identical run did this run's work
+        self.merged = 0  # identical runs waiting behind this one that it does the work of
+
+    def _update(self, update):
+        """Apply update(entry) to this signature's entry of the queue file under its lock, returning the result"""
+        fd = os.open(self.queue_path, os.O_RDWR | os.O_CREAT, 0o666)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            with os.fdopen(os.dup(fd), "r+", encoding="utf-8") as f:
+                try:
+                    queue = json.load(f)
+                except ValueError:
+                    queue = {}
+                entry = queue.setdefault(self.signature, {"issued": 0, "covered": 0, "pending": 0})
+                result = update(entry)
+                if entry["pending"] == 0 and entry["covered"] >= entry["issued"]:
+                    del queue[self.signature]  # nobody is waiting or running; a new ticket starts a new run either way
+                f.seek(0)
+                f.truncate()
+                json.dump(queue, f)
+        finally:
+            os.close(fd)  # releases the lock
+        return result
+
+    def run(self, work, on_acquired=None):
+        """Run work() holding the vault lock unless an identical run already did it; returns its result (True if coalesced)
+
+        on_acquired(queue) is called once the lock is held, before work runs or the run is coalesced.
+        """
+        if fcntl is None:
+            return work()
+
+        def take_ticket(entry):
+            entry["issued"] += 1
+            entry["pending"] += 1
+            return entry["issued"]
+
+        def decide(entry):
+            entry["pending"] -= 1
+            return entry["covered"], entry["issued"], entry["pending"]
+
+        ticket = self._update(take_ticket)
+        fd = os.open(self.lock_path, os.O_RDWR | os.O_CREAT, 0o666)
+        try:
+            started = time.perf_counter()
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            self.wait = time.perf_counter() - started
+            covered, issued, pending = self._update(decide)
+            self.coalesced = covered >= ticket
+            self.merged = 0 if self.coalesced else pending
+            if on_acquired:
+                on_acquired(self)
+            if self.coalesced:
+                return True
+
+            success = False
+
+            def cover(entry):
+                if success:
+                    entry["covered"] = max(entry["covered"], issued)
+                elif entry["pending"] == 0:
+                    entry["covered"] = entry["issued"]  # a failed run covers nobody; with nobody queued its entry can go
+
+            try:
+                success = work()
+                return success
+            finally:
+                self._update(cover)
+        finally:
+            os.close(fd)
+
+
+class _StatEntry:
+    """DirEntry-like record for paths written or created during the run"""
+
+    __slots__ = ("path", "_is_dir", "_stat")
+
+    def __init__(self, path, stat_result=None, is_dir=False):
+        self.path = path
+        self._stat = stat_result
+        self._is_dir = stat.S_ISDIR(stat_result.st_mode) if stat_result else is_dir
+
+    def is_dir(self):
+        return self._is_dir
+
+    def is_file(self):
+        return not self._is_dir
+
+    def stat(self):
+        if self._stat is None:
+            self._stat = os.stat(self.path)
+        return self._stat
+
+
+class FileSystemSnapshot:
+    """Cache of directory listings and stat results shared by copy, backup and overwrite checks
+
+    Each directory is listed once with os.scandir; existence and file/dir checks are answered from
+    the listing (d_type, no extra syscall) and stat results are taken from the cached DirEntry.
+    Writes made during the run are recorded so the snapshot stays consistent. Metadata syscalls are
+    counted so the cost of a run can be measured.
+    """
+
+    def __init__(self):
+        self.syscalls = {"scandir": 0, "stat": 0, "mkdir": 0}
+        self.created_directories = []
+        self._listings = {}
+        self._stated = set()
+        self._lock = threading.RLock()
+
+    @staticmethod
+    def _key(path):
+        return os.path.abspath(path)
+
+    def _count(self, syscall, count=1):
+        with self._lock:
+            self.syscalls[syscall] += count
+
+    def listdir(self, directory):
+        """Return {name: entry} for a directory, listing it at most once (empty if it does not exist)"""
+        key = self._key(directory)
+        with self._lock:
+            listing = self._listings.get(key)
+            if listing is not None:
+                return listing
+            self.syscalls["scandir"] += 1
+            listing = {}
+            try:
+                with os.scandir(key) as entries:
+                    for entry in entries:
+                        listing[entry.name] = entry
+            except (FileNotFoundError, NotADirectoryError):
+                pass
+            self._listings[key] = listing
+            return listing
+
+    def entry(self, path):
+        """Return the cached entry for a path, or None if it does not exist"""
+        parent, name = os.path.split(self._key(path))
+        if not name:
+            return _StatEntry(parent, is_dir=True) if os.path.isdir(parent) else None
+        return self.listdir(parent).get(name)
+
+    def exists(self, path):
+        return self.entry(path) is not None
+
+    def is_file(self, path):
+        entry = self.entry(path)
+        return entry is not None and entry.is_file()
+
+    def is_dir(self, path):
+        entry = self.entry(path)
+        return entry is not None and entry.is_dir()
+
+    def stat(self, path):
+        """Return the stat result for a path, calling stat at most once per path"""
+        entry = self.entry(path)
+        if entry is None:
+            raise FileNotFoundError(errno.ENOENT, "No such file or directory", str(path))
+        key = self._key(path)
+        with self._lock:
+            first_stat = key not in self._stated
+            self._stated.add(key)
+        if first_stat and not (isinstance(entry, _StatEntry) and entry._stat is not None):
+            self._count("stat")
+        return entry.stat()
+
+    def export(self, root, recursive=True):
+        """Return picklable {directory: {name: entry}} listings for root (and its subdirectories)"""
+        listings = {}
+        key = self._key(root)
+        listing = {}
+        for name, entry in self.listdir(key).items():
+            path = os.path.join(key, name)
+            listing[name] = _StatEntry(path, self.stat(path))
+            if recursive and entry.is_dir():
+                listings.update(self.export(path))
+        listings[key] = listing
+        return listings
+
+    def preload(self, listings):
+        """Seed the snapshot with listings exported from another snapshot"""
+        with self._lock:
+            for key, listing in listings.items():
+                self._listings[key] = dict(listing)
+                self._stated.update(os.path.join(key, name) for name in listing)
+
+    def walk_files(self, root):
+        """Yield every file under root in sorted order, listing each directory once"""
+        listing = self.listdir(root)
+        for name in sorted(listing):
+            entry = listing[name]
+            path = Path(root) / name
+            if entry.is_dir():
+                yield from self.walk_files(path)
+            else:
+                yield path
+
+    def ensure_dir(self, directory):
+        """Create a directory (and parents) unless the snapshot already knows it exists"""
+        if self.is_dir(directory):
+            return
+        key = self._key(directory)
+        missing = []
+        while not self.is_dir(key):
+            missing.append(key)
+            parent = os.path.dirname(key)
+            if parent == key:
+                break
+            key = parent
+        os.makedirs(directory, exist_ok=True)
+        self._count("mkdir", len(missing))
+        with self._lock:
+            self.created_directories.extend(reversed(missing))
+            for created in reversed(missing):
+                parent, name = os.path.split(created)
+                self.listdir(parent)[name] = _StatEntry(created, is_dir=True)
+                self._listings[created] = {}
+
+    def record(self, path, stat_result=None):
+        """Stat a path just written (or take the stat of its staged replacement) and store the result, returning it"""
+        key = self._key(path)
+        if stat_result is None:
+            stat_result = os.stat(key)
+            self._count("stat")
+        parent, name = os.path.split(key)
+        with self._lock:
+            self._stated.add(key)
+            listing = self._listings.get(parent)
+            if listing is not None:
+                listing[name] = _StatEntry(key, stat_result)
+            self._listings.pop(key, None)
+        return stat_result
+
+    def invalidate(self, path):
+        """Forget what is cached about a path (and everything below it) so it is read again"""
+        key = self._key(path)
+        parent = os.path.dirname(key)
+        prefix = key + os.sep
+        with self._lock:
+            self._listings.pop(parent, None)
+            for cached in [cached for cached in self._listings if cached.startswith(prefix)]:
+                del self._listings[cached]
+            self._listings.pop(key, None)
+            self._stated = {cached for cached in self._stated if os.path.dirname(cached) != parent and not cached.startswith(prefix)}
+
+    def summary(self):
+        return ", ".join(f"{count} {syscall}" for syscall, count in self.syscalls.items())
+
+
+def _merkle_digest(children):
+    """Hash a directory from its (name, hash, is_dir) children, sorted by name"""
+    return hash_bytes("\n".join(f"{name}{'/' if is_dir else ''}\0{child_hash}" for name, child_hash, is_dir in sorted(children)).encode("utf-8"))
+
+
+def _merkle_children(leaves):
+    """Return {directory: [(name, path, is_dir)]} for a flat {relative file path: hash} map"""
+    children = {"": []}
+    for path in leaves:
+        parts = path.split("/")
+        for depth in range(1, len(parts)):
+            directory = "/".join(parts[:depth])
+            if directory not in children:
+                children[directory] = []
+                children["/".join(parts[: depth - 1])].append((parts[depth - 1], directory, True))
+        children["/".join(parts[:-1])].append((parts[-1], path, False))
+    return children
+
+
+def merkle_tree(leaves, children=None):
+    """Return {directory: hash} for a flat {relative file path: hash} map ("" is the root)
+
+    Directories hash their sorted children's names and hashes, so two trees with the same root hash
+    hold the same files, and equal subtree hashes let a comparison skip that whole subtree.
+    """
+    children = children or _merkle_children(leaves)
+    hashes = {}
+
+    def visit(directory):
+        entries = [(name, visit(path) if is_dir else leaves[path], is_dir) for name, path, is_dir in children[directory]]
+        hashes[directory] = _merkle_digest(entries)
+        return hashes[directory]
+
+    visit("")
+    return hashes
+
+
+def merkle_diff(expected, actual):
+    """Compare two {relative file path: hash} maps, descending only into directories whose hashes differ
+
+    Returns sorted (path, status) pairs with status "missing", "modified" or "extra".
+    """
+    expected_children, actual_children = _merkle_children(expected), _merkle_children(actual)
+    expected_dirs, actual_dirs = merkle_tree(expected, expected_children), merkle_tree(actual, actual_children)
+
+    differences = []
+    pending = [""] if expected_dirs[""] != actual_dirs[""] else []
+    while pending:
+        directory = pending.pop()
+        entries = {}
+        for children in (expected_children, actual_children):
+            for name, path, is_dir in children.get(directory, []):
+                entries[path] = entries.get(path, False) or is_dir
+        for path, is_dir in entries.items():
+            if is_dir:
+                if expected_dirs.get(path) != actual_dirs.get(path):
+                    pending.append(path)
+                # A file on one side replaced by a directory on the other
+                if path in expected or path in actual:
+                    differences.append((path, "missing" if path in expected else "extra"))
+            elif path not in actual:
+                differences.append((path, "missing"))
+            elif path not in expected:
+                differences.append((path, "extra"))
+            elif expected[path] != actual[path]:
+                differences.append((path, "modified"))
+    return sorted(differences)
+
+
+class MerkleIndex:
+    """Hashes of a tree's files, cached in a file so unchanged trees are verified without reading files
+
+    A directory's listing is cached under its mtime (which changes when entries are added, removed
+    or renamed), so an unchanged directory is not listed again. Its files' hashes are cached under
+    their size and mtime, because editing a file in place does not change the directory's mtime.
+    A clean tree therefore costs one stat per directory and file, and no reads.
+    """
+
+    VERSION = 1
+
+    def __init__(self, base_path, cache_path=None):
+        self.base_path = Path(base_path)
+        self.cache_path = Path(cache_path) if cache_path else None
+        self.directories = {}
+        self.files = {}
+        self.dirty = False
+        self.files_read = 0
+        self.directories_listed = 0
+        if self.cache_path:
+            try:
+                with open(self.cache_path, "r", encoding="utf-8") as f:
+                    data = json.load(f)
+                if data.get("version") == self.VERSION:
+                    self.directories = data.get("directories", {})
+                    self.files = data.get("files", {})
+            except FileNotFoundError:
+                pass
+            except Exception as e:
+                print(f"⚠️ Ignoring unreadable audit cache {self.cache_path}: {e}", file=sys.stderr)
+
+    def _relative(self, path):
+        return Path(path).relative_to(self.base_path).as_posix()
+
+    def _cached_hash(self, cached, stat_result, path):
+        if cached and cached[0] == stat_result.st_size and cached[1] == stat_result.st_mtime_ns:
+            return cached[2]
+        self.files_read += 1
+        return hash_file(path)
+
+    def file_hash(self, path):
+        """Return the hash of one file (None if missing), cached under its size and mtime"""
+        key = self._relative(path)
+        try:
+            stat_result = os.stat(path)
+        except (FileNotFoundError, NotADirectoryError):
+            if self.files.pop(key, None) is not None:
+                self.dirty = True
+            return None
+        file_hash = self._cached_hash(self.files.get(key), stat_result, path)
+        record = [stat_result.st_size, stat_result.st_mtime_ns, file_hash]
+        if self.files.get(key) != record:
+            self.files[key] = record
+            self.dirty = True
+        return file_hash
+
+    def scan(self, directory):
+        """Return {path relative to directory: hash} for every file under directory"""
+        leaves = {}
+        self._scan(Path(directory), "", leaves)
+        return leaves
+
+    def _scan(self, path, relative, leaves):
+        key = self._relative(path)
+        try:
+            directory_stat = os.stat(path)
+        except (FileNotFoundError, NotADirectoryError):
+            return
+        cached = self.directories.get(key)
+        if cached and cached["mtime_ns"] == directory_stat.st_mtime_ns:
+            kinds = {name: value == "d" for name, value in cached["entries"].items()}
+        else:
+            self.directories_listed += 1
+            kinds = {}
+            with os.scandir(path) as entries:
+                for entry in entries:
+                    kinds[entry.name] = entry.is_dir()
+
+        records = {}
+        for name, is_dir in kinds.items():
+            child = path / name
+            child_relative = f"{relative}/{name}" if relative else name
+            if is_dir:
+                records[name] = "d"
+                self._scan(child, child_relative, leaves)
+                continue
+            try:
+                stat_result = os.stat(child)
+            except FileNotFoundError:
+                continue
+            previous = cached["entries"].get(name) if cached else None
+            file_hash = self._cached_hash(previous if isinstance(previous, list) else None, stat_result, child)
+            records[name] = [stat_result.st_size, stat_result.st_mtime_ns, file_hash]
+            leaves[child_relative] = file_hash
+
+        record = {"mtime_ns": directory_stat.st_mtime_ns, "entries": records}
+        if cached != record:
+            self.directories[key] = record
+            self.dirty = True
+
+    def save(self):
+        """Write the cache if anything changed"""
+        if not (self.cache_path and self.dirty):
+            return True
+        try:
+            write_file_atomic(self.cache_path, json.dumps({"version": self.VERSION, "directories": self.directories, "files": self.files}, sort_keys=True).encode("utf-8"))
+            self.dirty = False
+            return True
+        except Exception as e:
+            print(f"⚠️ Failed to save audit cache {self.cache_path}: {e}", file=sys.stderr)
+            return False
+
+
+class EventStream:
+    """Sink for structured setup events: renders them and aggregates per-phase timings and bytes
+
+    Every event is a dict. Log events carry a human-readable "message"; operation events carry
+    phase, path, bytes, duration and outcome. The text renderer prints messages only (the classic
+    output), the json renderer writes every event as one JSON line.
+    """
+
+    def __init__(self, log_format="text", stream=None):
+        self.log_format = log_format
+        self.stream = stream
+        self.phases = {}
+        self._lock = threading.Lock()
+
+    def write(self, event):
+        with self._lock:
+            if event.get("event") == "operation":
+                self._aggregate(event)
+            stream = self.stream or sys.stdout
+            if self.log_format == "json":
+                stream.write(json.dumps(event, ensure_ascii=False, default=str) + "\n")
+            elif "message" in event:
+                stream.write(f"{event['message']}\n")
+
+    def _aggregate(self, event):
+        phase = self.phases.setdefault(event["phase"], {"operations": 0, "bytes": 0, "busy": 0.0, "start": None, "end": None})
+        phase["operations"] += 1
+        phase["bytes"] += event.get("bytes") or 0
+        phase["busy"] += event["duration"]
+        start = event["time"] - event["duration"]
+        phase["start"] = start if phase["start"] is None else min(phase["start"], start)
+        phase["end"] = event["time"] if phase["end"] is None else max(phase["end"], event["time"])
+
+    def phase_report(self):
+        """Return one summary event per phase: operation count, wall time, busy time and bytes moved"""
+        with self._lock:
+            phases = dict(self.phases)
+        if not phases:
+            return []
+        width = max(len(name) for name in phases)
+        events = [{"event": "log", "message": "📈 Phase report:"}]
+        for name, phase in phases.items():
+            wall = phase["end"] - phase["start"]
+            events.append(
+                {
+                    "event": "phase",
+                    "phase": name,
+                    "operations": phase["operations"],
+                    "wall": round(wall, 6),
+                    "busy": round(phase["busy"], 6),
+                    "bytes": phase["bytes"],
+                    "message": f"   {name:<{width}}  {phase['operations']:>5} ops  {wall:.3f}s wall  {phase['busy']:.3f}s busy  {phase['bytes']} bytes",
+                }
+            )
+        return events
+
+
+class TaskGraph:
+    """Small dependency graph of setup tasks; tasks whose dependencies have succeeded run concurrently
+
+    Tasks must be added after their dependencies, which keeps the graph acyclic. After the first
+    failure no new task is started, and tasks that never ran are reported as skipped.
+    """
+
+    def __init__(self):
+        self.tasks = {}
+        self.results = {}
+        self.wall_time = 0.0
+
+    def add(self, name, title, function, depends_on=()):
+        unknown = [dependency for dependency in depends_on if dependency not in self.tasks]
+        if unknown:
+            raise ValueError(f"Task {name} depends on unknown task(s): {', '.join(unknown)}")
+        self.tasks[name] = {"title": title, "function": function, "depends_on": list(depends_on)}
+
+    @staticmethod
+    def _timed(execute, function):
+        started = time.perf_counter()
+        succeeded, lines = execute(function)
+        return succeeded, lines, time.perf_counter() - started
+
+    def run(self, execute, emit, max_workers=None):
+        """Run all tasks; execute(function) returns (succeeded, lines) and emit(title, lines) prints a
+        finished task's output. Output is emitted in the order tasks were added, so it is deterministic."""
+        order = list(self.tasks)
+        pending = list(order)
+        running = {}
+        failed = False
+        emitted = 0
+        started = time.perf_counter()
+
+        with ThreadPoolExecutor(max_workers=max_workers or max(1, len(order))) as executor:
+            while pending or running:
+                if not failed:
+                    for name in list(pending):
+                        if all(self.results.get(dependency, {}).get("status") == "ok" for dependency in self.tasks[name]["depends_on"]):
+                            pending.remove(name)
+                            running[executor.submit(self._timed, execute, self.tasks[name]["function"])] = name
+                if not running:
+                    break
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    succeeded, lines, duration = future.result()
+                    self.results[name] = {"status": "ok" if succeeded else "failed", "duration": duration, "lines": lines}
+                    failed = failed or not succeeded
+
+                while emitted < len(order) and order[emitted] in self.results:
+                    result = self.results[order[emitted]]
+                    emit(self.tasks[order[emitted]]["title"], result["lines"])
+                    emitted += 1
+
+        for name in pending:
+            self.results[name] = {"status": "skipped", "duration": 0.0, "lines": []}
+        for name in order[emitted:]:
+            emit(self.tasks[name]["title"], self.results[name]["lines"])
+
+        self.wall_time = time.perf_counter() - started
+        return not failed
+
+    def critical_path(self):
+        """Return the duration of the longest dependency chain, the lower bound for the wall time"""
+        finish = {}
+        for name in self.tasks:
+            duration = self.results.get(name, {}).get("duration", 0.0)
+            finish[name] = duration + max((finish[dependency] for dependency in self.tasks[name]["depends_on"]), default=0.0)
+        return max(finish.values(), default=0.0)
+
+    def report(self):
+        """Return the per-task timing report as lines"""
+        total = sum(result["duration"] for result in self.results.values())
+        lines = [f"⏱️ Task timings: {self.wall_time:.3f}s wall, {self.critical_path():.3f}s critical path, {total:.3f}s total"]
+        width = max((len(name) for name in self.tasks), default=0)
+        icons = {"ok": "✅", "failed": "❌", "skipped": "⏭️"}
+        for name in self.tasks:
+            result = self.results.get(name, {"status": "skipped", "duration": 0.0})
+            lines.append(f"   {icons[result['status']]} {name:<{width}}  {result['duration']:.3f}s")
+        return lines
+
+
+class IgnoreMatcher:
+    """gitignore-style patterns compiled into one regex
+
+    The rules are joined into a single alternation in reverse order, each alternative in its own
+    named group, so one fullmatch finds the last matching rule (the one gitignore says wins).
+    Patterns without a slash match a name at any depth, so they are compiled separately and only
+    matched against the last path component. A path is ignored when its last matching rule is not
+    negated, or when a parent directory is ignored (git never looks inside an ignored directory, so
+    a negation cannot re-include it). Directory results are cached for the duration of one call, so
+    checking many files costs two short regex matches per file and a matcher can be shared between
+    threads.
+    """
+
+    def __init__(self, patterns):
+        self.rules = []
+        for line in patterns:
+            rule = self._parse(line)
+            if rule:
+                self.rules.append(rule)
+        self._regexes = {}
+        for is_dir in (True, False):
+            candidates = [index for index, rule in enumerate(self.rules) if is_dir or not rule["dir_only"]]
+            self._regexes[is_dir] = (
+                self._compile(index for index in candidates if not self.rules[index]["anchored"]),
+                self._compile(index for index in candidates if self.rules[index]["anchored"]),
+            )
+
+    @staticmethod
+    def _parse(line):
+        """Parse one pattern line into a rule, or None for blank lines and comments"""
+        line = line.rstrip("\n").rstrip("\r")
+        stripped = line.rstrip(" ")
+        if stripped.endswith("\\") and len(stripped) < len(line):
+            stripped += " "
+        line = stripped
+        if not line or line.startswith("#"):
+            return None
+
+        negated = line.startswith("!")
+        if negated:
+            line = line[1:]
+        elif line.startswith("\\!") or line.startswith("\\#"):
+            line = line[1:]
+        dir_only = line.endswith("/")
+        line = line.rstrip("/")
+        if not line:
+            return None
+
+        anchored = "/" in line
+        segments = line.lstrip("/").split("/")
+        regex = ""
+        for index, segment in enumerate(segments):
+            last = index == len(segments) - 1
+            if segment == "**":
+                # Leading or inner "**/" matches zero or more directories, a trailing "/**" everything inside
+                regex += ".+" if last else "(?:.*/)?"
+            else:
+                regex += IgnoreMatcher._translate_segment(segment) + ("" if last else "/")
+        return {"pattern": ("!" if negated else "") + line + ("/" if dir_only else ""), "negated": negated, "dir_only": dir_only, "anchored": anchored, "regex": regex}
+
+    @staticmethod
+    def _translate_segment(segment):
+        """Translate one path segment's wildcards (*, ?, [...]) into a regex that never crosses "/" """
+        regex = ""
+        index = 0
+        while index < len(segment):
+            char = segment[index]
+            index += 1
+            if char == "*":
+                while index < len(segment) and segment[index] == "*":
+                    index += 1
+                regex += "[^/]*"
+            elif char == "?":
+                regex += "[^/]"
+            elif char == "\\" and index < len(segment):
+                regex += re.escape(segment[index])
+                index += 1
+            elif char == "[":
+                search_from = index + 1 if segment[index : index + 1] in ("!", "^") else index
+                if segment[search_from : search_from + 1] == "]":
+                    search_from += 1
+                end = segment.find("]", search_from)
+                if end < 0:
+                    regex += re.escape(char)
+                    continue
+                body = segment[index:end]
+                index = end + 1
+                if body[:1] in ("!", "^"):
+                    body = "^" + body[1:]
+                regex += "(?!/)[" + body.replace("\\", "\\\\") + "]"
+            else:
+                regex += re.escape(char)
+        return regex
+
+    def _compile(self, indexes):
+        alternatives = [f"(?P<r{index}>{self.rules[index]['regex']})" for index in sorted(indexes, reverse=True)]
+        return re.compile("|".join(alternatives), re.DOTALL) if alternatives else None
+
+    def match(self, path, is_dir=False):
+        """Return the rule deciding a path (the last matching one, or the one ignoring a parent), or None"""
+        path = path.replace(os.sep, "/").strip("/")
+        while path.startswith("./"):
+            path = path[2:]
+        return self._match(path, is_dir, {})
+
+    def _match(self, path, is_dir, dir_cache):
+        """Match a normalized path, memoizing parent directory results in dir_cache"""
+        parent, _, name = path.rpartition("/")
+        if parent:
+            parent_rule = dir_cache.get(parent, False)
+            if parent_rule is False:
+                parent_rule = dir_cache[parent] = self._match(parent, True, dir_cache)
+            if parent_rule is not None and not parent_rule["negated"]:
+                return parent_rule
+
+        name_regex, path_regex = self._regexes[is_dir]
+        best = -1
+        found = name_regex.fullmatch(name) if name_regex else None
+        if found:
+            best = int(found.lastgroup[1:])
+        found = path_regex.fullmatch(path) if path_regex else None
+        if found:
+            best = max(best, int(found.lastgroup[1:]))
+        return self.rules[best] if best >= 0 else None
+
+    def filter_ignored(self, paths):
+        """Return the ignored files among already normalized paths (relative, "/"-separated)"""
+        ignored = []
+        dir_cache = {}
+        for path in paths:
+            rule = self._match(path, False, dir_cache)
+            if rule is not None and not rule["negated"]:
+                ignored.append(path)
+        return ignored
+
+
+# inotify event flags (see inotify(7))
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+INOTIFY_WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF
+INOTIFY_EVENT = struct.Struct("iIII")
+
+
+class SourceWatcher(abc.ABC):
+    """Base class for source tree watchers: reports changed paths, grouping bursts of events
+
+    A reported directory means "everything under it may have changed" (a directory was created or
+    moved in, or the event queue overflowed).
+    """
+
+    name = "watcher"
+    IGNORED_NAMES = {".git", "__pycache__", STATE_DIRNAME, ".DS_Store"}
+
+    def __init__(self, root):
+        self.root = Path(root).resolve()
+
+    def _include(self, path):
+        """Skip VCS/cache folders and editor swap and backup files"""
+        name = os.path.basename(path)
+        if name.endswith(("~", ".swp", ".swx", ".tmp")) or name.startswith(".#"):
+            return False
+        relative = os.path.relpath(path, self.root)
+        return not any(part in self.IGNORED_NAMES for part in relative.split(os.sep))
+
+    @abc.abstractmethod
+    def _poll(self, timeout):
+        """Return the set of paths changed within timeout seconds (None waits forever)"""
+
+    def changes(self, debounce=0.05, timeout=None):
+        """Wait for a change, then keep collecting until the tree has been quiet for debounce seconds"""
+        changed = self._poll(timeout)
+        if not changed:
+            return set()
+        while True:
+            more = self._poll(debounce)
+            if not more:
+                return changed
+            changed |= more
+
+    def close(self):
+        pass
+
+
+class InotifyWatcher(SourceWatcher):
+    """Linux inotify watcher, called through libc with ctypes; every directory gets its own watch"""
+
+    name = "inotify"
+
+    def __init__(self, root):
+        super().__init__(root)
+        self._libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self.fd = self._libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error))
+        self._watches = {}
+        try:
+            self._add_tree(self.root)
+        except BaseException:
+            self.close()
+            raise
+
+    def _add_tree(self, directory):
+        """Watch a directory and every directory below it"""
+        for current, directories, _ in os.walk(directory):
+            directories[:] = [name for name in directories if self._include(os.path.join(current, name))]
+            wd = self._libc.inotify_add_watch(self.fd, os.fsencode(current), INOTIFY_WATCH_MASK)
+            if wd < 0:
+                error = ctypes.get_errno()
+                if error in (errno.ENOENT, errno.ENOTDIR):
+                    continue
+                raise OSError(error, f"inotify_add_watch failed for {current}: {os.strerror(error)}")
+            self._watches[wd] = current
+
+    def _read_events(self):
+        data = b""
+        while True:
+            try:
+                chunk = os.read(self.fd, 64 * 1024)
+            except BlockingIOError:
+                return data
+            if not chunk:
+                return data
+            data += chunk
+
+    def _poll(self, timeout):
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return set()
+
+        changed = set()
+        data = self._read_events()
+        offset = 0
+        while offset + INOTIFY_EVENT.size <= len(data):
+            wd, mask, _, length = INOTIFY_EVENT.unpack_from(data, offset)
+            raw_name = data[offset + INOTIFY_EVENT.size : offset + INOTIFY_EVENT.size + length].rstrip(b"\0")
+            offset += INOTIFY_EVENT.size + length
+
+            if mask & IN_Q_OVERFLOW:
+                # Events were dropped, so every file may have changed
+                changed.add(str(self.root))
+                continue
+            if mask & IN_IGNORED:
+                self._watches.pop(wd, None)
+                continue
+            directory = self._watches.get(wd)
+            if directory is None or mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+                continue
+
+            path = os.path.join(directory, os.fsdecode(raw_name)) if raw_name else directory
+            if not self._include(path):
+                continue
+            if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                self._add_tree(path)
+            changed.add(path)
+        return changed
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+
+class PollingWatcher(SourceWatcher):
+    """Portable fallback: rescans the tree and compares file sizes and mtimes"""
+
+    name = "polling"
+
+    def __init__(self, root, interval=0.5):
+        super().__init__(root)
+        self.interval = interval
+        self._state = self._scan()
+
+    def _scan(self):
+        state = {}
+        for current, directories, files in os.walk(self.root):
+            directories[:] = [name for name in directories if self._include(os.path.join(current, name))]
+            for name in files:
+                path = os.path.join(current, name)
+                if not self._include(path):
+                    continue
+                try:
+                    stat_result = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                state[path] = (stat_result.st_size, stat_result.st_mtime_ns)
+        return state
+
+    def _poll(self, timeout):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            remaining = self.interval if deadline is None else min(self.interval, max(0.0, deadline - time.monotonic()))
+            time.sleep(remaining)
+            state = self._scan()
+            changed = {path for path in state.keys() | self._state.keys() if state.get(path) != self._state.get(path)}
+            self._state = state
+            if changed or (deadline is not None and time.monotonic() >= deadline):
+                return changed
+
+
+def create_source_watcher(root, backend="auto", poll_interval=0.5):
+    """Return an inotify watcher where available, falling back to polling"""
+    if backend in ("auto", "inotify") and sys.platform.startswith("linux"):
+        try:
+            return InotifyWatcher(root)
+        except (OSError, AttributeError, TypeError) as e:
+            if backend == "inotify":
+                raise
+            print(f"⚠️ inotify unavailable ({e}), falling back to polling", file=sys.stderr)
+    elif backend == "inotify":
+        raise OSError(errno.ENOSYS, "inotify is only available on Linux")
+    return PollingWatcher(root, poll_interval)
+
+
+# Frontmatter and H1 rules of FileParser.parse (Templater/Scripts/parseFile.js); JavaScript's "." stops at any line terminator
+NOTE_FRONTMATTER_PATTERN = re.compile(r"---\s*[\s\S]*?\s*---\s*")
+NOTE_H1_PATTERN = re.compile(r"(\s*)#\s+([^\n\r\u2028\u2029]*)")
+
+# Notes handed to a normalize worker per task, and tasks kept in flight per worker
+NORMALIZE_BATCH_SIZE = 64
+NORMALIZE_QUEUE_DEPTH = 2
+
+
+def parse_note(text):
+    """Split a note into (frontmatter block, H1 title, content) the way FileParser.parse does
+
+    The frontmatter block is the raw text from the opening to the closing "---" ("" if there is none).
+    """
+    frontmatter = ""
+    body = text
+    match = NOTE_FRONTMATTER_PATTERN.match(text)
+    if match:
+        frontmatter = match.group(0).rstrip()
+        body = text[match.end() :]
+
+    match = NOTE_H1_PATTERN.match(body)
+    if match:
+        return frontmatter, match.group(2).strip(), body[match.end() :].lstrip()
+    return frontmatter, "", body.strip()
+
+
+def assemble_note(frontmatter, title, content):
+    """Join a note's parts back together like FileParser.reassemble()"""
+    parts = []
+    if frontmatter:
+        parts.append(frontmatter + "\n\n")
+    if title:
+        parts.append(f"# {title}" + ("\n\n" if content else "\n"))
+    parts.append(content)
+    return "".join(parts)
+
+
+def normalize_note(text, basename, sync_title=False):
+    """Apply FileParser.parse and reassemble() to a note, returning (new text, reason), or (None, None) if unchanged
+
+    Like the script, only a note missing its H1 (or, with sync_title, one whose H1 differs from the
+    file name, as the Sync H1 Title command does) is rewritten. The frontmatter block is kept byte
+    for byte rather than rebuilt from Obsidian's metadata cache.
+    """
+    frontmatter, title, content = parse_note(text)
+    if not title:
+        title, reason = basename.strip(), "added H1"
+    elif sync_title and title != basename:
+        title, reason = basename, "synced H1 with file name"
+    else:
+        return None, None
+
+    new_text = assemble_note(frontmatter, title, content)
+    return (None, None) if new_text == text else (new_text, reason)
+
+
+def _normalize_note_batch(task):
+    """Normalize a batch of notes in a worker process, returning one result per note"""
+    vault_path, relative_paths, sync_title, dry_run = task
+    results = []
+    for relative in relative_paths:
+        started = time.perf_counter()
+        path = os.path.join(vault_path, relative)
+        result = {"path": relative, "outcome": "unchanged", "bytes": 0}
+        try:
+            before = os.stat(path)
+            with open(path, "r", encoding="utf-8", newline="") as f:
+                text = f.read()
+            new_text, reason = normalize_note(text, os.path.splitext(os.path.basename(relative))[0], sync_title)
+            if new_text is not None:
+                data = new_text.encode("utf-8")
+                result.update(outcome="changed", reason=reason, bytes=len(data))
+                if dry_run:
+                    result["diff"] = "".join(difflib.unified_diff(text.splitlines(True), new_text.splitlines(True), f"a/{relative}", f"b/{relative}"))
+                else:
+                    # Never overwrite an edit made (e.g. in Obsidian) since the note was read
+                    after = os.stat(path)
+                    if (after.st_mtime_ns, after.st_size) != (before.st_mtime_ns, before.st_size):
+                        raise OSError("modified while being normalized")
+                    write_file_atomic(path, data, stat.S_IMODE(before.st_mode))
+        except (OSError, UnicodeDecodeError) as e:
+            result.update(outcome="failed", error=str(e))
+        result["duration"] = time.perf_counter() - started
+        results.append(result)
+    return results
+
+
+FRONTMATTER_KEY_PATTERN = re.compile(r"([^\s#:-][^:]*):(.*)")
+INLINE_TAG_PATTERN = re.compile(r"(?<![\w&/#])#([\w/-]*[^\W\d][\w/-]*)")
+
+
+def _frontmatter_lines(frontmatter):
+    """Return the lines between the "---" fences of a raw frontmatter block"""
+    lines = frontmatter.splitlines()
+    return lines[1:-1] if len(lines) >= 2 else []
+
+
+def _frontmatter_key_span(lines, key):
+    """Return (start, end) of a top-level key's line and its indented or list continuation lines, or None"""
+    for index, line in enumerate(lines):
+        match = FRONTMATTER_KEY_PATTERN.match(line)
+        if match and match.group(1).strip() == key:
+            end = index + 1
+            while end < len(lines) and (lines[end][:1].isspace() or lines[end].startswith("-")):
+                end += 1
+            return index, end
+    return None
+
+
+def get_frontmatter_list(frontmatter, key):
+    """Read a list property (e.g. tags) from a raw frontmatter block: inline [a, b], a block list or a scalar"""
+    lines = _frontmatter_lines(frontmatter)
+    span = _frontmatter_key_span(lines, key)
+    if span is None:
+        return []
+    start, end = span
+    value = FRONTMATTER_KEY_PATTERN.match(lines[start]).group(2).strip()
+    if value.startswith("[") and value.endswith("]"):
+        items = value[1:-1].split(",")
+    elif value:
+        items = re.split(r"[,\s]+", value)
+    else:
+        items = [line.strip()[1:] for line in lines[start + 1 : end] if line.strip().startswith("-")]
+    return [item for item in (item.strip().strip("\"'").lstrip("#") for item in items) if item]
+
+
+def set_frontmatter_values(frontmatter, values):
+    """Set top-level properties in a raw frontmatter block, serialized like FileParser._frontmatterObjToText
+
+    Other lines are kept as they are; strings are written as JSON strings, which YAML reads back unchanged.
+    """
+    lines = _frontmatter_lines(frontmatter)
+    for key, value in values.items():
+        if isinstance(value, list):
+            line = f"{key}: [{', '.join(json.dumps(item, ensure_ascii=False) for item in value)}]"
+        elif isinstance(value, str):
+            line = f"{key}: {json.dumps(value, ensure_ascii=False)}"
+        else:
+            line = f"{key}: {json.dumps(value)}"
+        span = _frontmatter_key_span(lines, key)
+        if span is None:
+            lines.append(line)
+        else:
+            lines[span[0] : span[1]] = [line]
+    return "\n".join(["---", *lines, "---"])
+
+
+# Defaults for the ai section of config.json; endpoints can point at a local stub server for testing
+AI_DEFAULTS = {
+    "gemini_endpoint": "https://generativelanguage.googleapis.com/v1beta",
+    "gemini_model": "gemini-2.5-flash-lite",
+    "ollama_endpoint": "http://localhost:11434",
+    "ollama_model": "gemma3:12b",
+}
+AI_BATCH_DEFAULTS = {"concurrency": 4, "requests_per_second": 2, "max_retries": 5, "timeout": 120}
+
+# HTTP statuses worth retrying: timeouts, rate limiting and transient server errors
+AI_RETRY_STATUSES = {408, 429, 500, 502, 503, 504}
+AI_BACKOFF_BASE = 1.0
+AI_BACKOFF_MAX = 60.0
+
+
+class AIRetryableError(Exception):
+    """A request failed in a way that may succeed when retried; retry_after is the server's hint in seconds"""
+
+    def __init__(self, message, retry_after=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class AIClient:
+    """Blocking Gemini and Ollama requests shaped like GeminiAdapter and OllamaAdapter in exec.js"""
+
+    def __init__(self, settings):
+        self.settings = settings
+
+    def model(self, provider):
+        return self.settings[f"{provider}_model"]
+
+    def build_request(self, provider, prompt, response_format=None, images=None):
+        """Return (url, headers, body) for one generate call"""
+        if provider == "gemini":
+            parts = [{"text": prompt}] + [{"inline_data": {"mime_type": "image/png", "data": image}} for image in images or []]
+            body = {"contents": [{"role": "user", "parts": parts}], "generationConfig": {"thinkingConfig": {"thinkingBudget": 0}}}
+            if response_format:
+                body["generationConfig"].update(responseMimeType="application/json", responseSchema=response_format)
+            url = f"{self.settings['gemini_endpoint'].rstrip('/')}/models/{self.model(provider)}:generateContent"
+            return url, {"X-goog-api-key": str(self.settings.get("gemini_api_key") or "")}, body
+        if provider == "ollama":
+            body = {"model": self.model(provider), "prompt": prompt, "stream": False}
+            if images:
+                body["images"] = images
+            if response_format:
+                body["format"] = response_format
+            return f"{self.settings['ollama_endpoint'].rstrip('/')}/api/generate", {}, body
+        raise ValueError(f"Unsupported provider: {provider}")
+
+    def send(self, url, headers, body, timeout):
+        """POST a JSON body and return the decoded JSON response, raising AIRetryableError for transient failures"""
+        request = urllib.request.Request(url, data=json.dumps(body).encode("utf-8"), headers={"Content-Type": "application/json", **headers}, method="POST")
+        try:
+            with urllib.request.urlopen(request, timeout=timeout) as response:
+                return json.loads(response.read())
+        except urllib.error.HTTPError as e:
+            detail = e.read(500).decode("utf-8", "replace").strip()
+            if e.code in AI_RETRY_STATUSES:
+                retry_after = e.headers.get("Retry-After")
+                raise AIRetryableError(f"HTTP {e.code}", float(retry_after) if retry_after and retry_after.isdigit() else None) from None
+            raise RuntimeError(f"HTTP {e.code}: {detail[:200]}") from None
+        except (urllib.error.URLError, TimeoutError, ConnectionError) as e:
+            raise AIRetryableError(str(getattr(e, "reason", e))) from None
+
+    def parse_response(self, provider, data, response_format=None):
+        """Extract the generated text (parsed as JSON for structured output) from a response"""
+        if provider == "gemini":
+            try:
+                content = data["candidates"][0]["content"]["parts"][0]["text"]
+            except (KeyError, IndexError, TypeError):
+                raise RuntimeError(f"unexpected Gemini response: {json.dumps(data)[:200]}") from None
+        else:
+            if not data.get("done"):
+                raise RuntimeError("Ollama response is not done")
+            content = (data.get("response") or "").strip()
+            if not content:
+                raise RuntimeError("Empty response from Ollama")
+        return json.loads(content) if response_format else content
+
+
+class AIResponseCache:
+    """On-disk cache of AI responses, one JSON file per request key, sharded by the key's first two characters"""
+
+    def __init__(self, root):
+        self.root = Path(root)
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(provider, model, prompt, response_format=None, image_hashes=()):
+        """Hash everything that determines a response: provider, model, prompt (which embeds the content) and output format"""
+        request = {"provider": provider, "model": model, "prompt": prompt, "format": response_format, "images": list(image_hashes)}
+        return hash_bytes(json.dumps(request, sort_keys=True, ensure_ascii=False).encode("utf-8"))
+
+    def path(self, key):
+        return self.root / key[:2] / f"{key[2:]}.json"
+
+    def get(self, key):
+        try:
+            with open(self.path(key), "r", encoding="utf-8") as f:
+                response = json.load(f)["response"]
+        except (OSError, ValueError, KeyError):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return response
+
+    def put(self, key, response):
+        path = self.path(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        write_file_atomic(path, json.dumps({"response": response}, ensure_ascii=False).encode("utf-8"))
+
+
+class TokenBucket:
+    """Asyncio token bucket: rate tokens per second, holding at most capacity (the allowed burst)"""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        """Wait until a token is available and take it; a rate of 0 means unlimited"""
+        if not self.rate:
+            return
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class AIBatchRunner:
+    """Sends AI requests from asyncio with bounded concurrency, a token bucket, retries with backoff and a response cache
+
+    HTTP calls are blocking urllib requests run on a thread pool as large as the concurrency limit,
+    so no third-party HTTP client is needed.
+    """
+
+    def __init__(self, client, cache, concurrency=4, requests_per_second=2, max_retries=5, timeout=120):
+        self.client = client
+        self.cache = cache
+        self.concurrency = max(1, int(concurrency))
+        self.max_retries = max(0, int(max_retries))
+        self.timeout = timeout
+        self.bucket = TokenBucket(float(requests_per_second or 0), max(1.0, float(requests_per_second or 0)))
+        self.executor = ThreadPoolExecutor(max_workers=self.concurrency)
+        self.stats = {"requests": 0, "retries": 0, "failed": 0}
+
+    async def generate(self, provider, prompt, response_format=None, images=None, image_hashes=()):
+        """Return the response for a prompt, from the cache when the same request was made before"""
+        key = self.cache.key(provider, self.client.model(provider), prompt, response_format, image_hashes)
+        cached = self.cache.get(key)
+        if cached is not None:
+            return cached
+
+        url, headers, body = self.client.build_request(provider, prompt, response_format, images)
+        loop = asyncio.get_running_loop()
+        for attempt in range(self.max_retries + 1):
+            await self.bucket.acquire()
+            self.stats["requests"] += 1
+            try:
+                data = await loop.run_in_executor(self.executor, self.client.send, url, headers, body, self.timeout)
+                response = self.client.parse_response(provider, data, response_format)
+                break
+            except AIRetryableError as e:
+                if attempt == self.max_retries:
+                    self.stats["failed"] += 1
+                    raise RuntimeError(f"{provider}: {e} (gave up after {attempt + 1} attempts)") from None
+                delay = e.retry_after if e.retry_after is not None else min(AI_BACKOFF_MAX, AI_BACKOFF_BASE * 2**attempt) * (0.5 + random.random() / 2)
+                self.stats["retries"] += 1
+                await asyncio.sleep(delay)
+            except Exception:
+                self.stats["failed"] += 1
+                raise
+
+        self.cache.put(key, response)
+        return response
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+
+
+SUMMARIZE_PROMPT = """Summarize the following text in a single comprehensive summary paragraph.
+It must include all key arguments, main points, and conclusions from the original text.
+Be careful not to lose any critical information.
+Ignore the frontmatter and the first H1 title below the frontmatter if they exist, only summarize the content below.
+
+Text to summarize:
+{text}"""
+
+SUGGEST_TAGS_PROMPT = """Suggest a few tags that are really appropriate for the following content.
+Use existing tags only.
+Existing tags: {tags}
+Content: {content}"""
+
+RENAME_IMAGE_PROMPT = "Generate a filename for the image using 3-8 English words in lowercase with underscores."
+
+# Embedded image links and pasted image names matched by renameImages.js
+IMAGE_LINK_PATTERN = re.compile(r"!\[\[([^|\]]+?)]]")
+PASTED_IMAGE_PATTERN = re.compile(r"Pasted image \d{14}\.(png|jpg|jpeg|gif|bmp|webp)")
+
+AI_JOBS = ("summarize", "tags", "rename-images")
+AI_CACHE_DIRNAME = "ai-cache"
+
+
+# [[target#heading|alias]] and ![[target]]; group 1 is "!" for embeds
+WIKILINK_PATTERN = re.compile(r"(!?)\[\[([^\]|#^]*)[^\]]*]]")
+# [text](target) and ![alt](target "title"); group 2 is the target, URL-encoded or wrapped in <...>
+MARKDOWN_LINK_PATTERN = re.compile(r"(!?)\[[^\]\n]*]\((<[^>\n]*>|[^)\s]*)([^)\n]*\))")
+IMAGE_EXTENSIONS = {".png", ".jpg", ".jpeg", ".gif", ".bmp", ".webp", ".svg", ".avif"}
+
+
+def markdown_link_target(target):
+    """Decode the target of a Markdown link to a vault path, without any #heading; None for URLs like https: or obsidian:"""
+    target = target[1:-1] if target.startswith("<") and target.endswith(">") else urllib.parse.unquote(target)
+    if re.match(r"[A-Za-z][A-Za-z0-9+.-]*:", target):
+        return None
+    return target.split("#", 1)[0].strip() or None
+
+
+def parse_note_metadata(text):
+    """Return the title, content, tags, links and frontmatter properties of a note for the vault index"""
+    frontmatter, title, content = parse_note(text)
+    properties = {}
+    for line in _frontmatter_lines(frontmatter):
+        match = FRONTMATTER_KEY_PATTERN.match(line)
+        if match:
+            properties[match.group(1).strip()] = match.group(2).strip()
+    tags = dict.fromkeys(get_frontmatter_list(frontmatter, "tags") + INLINE_TAG_PATTERN.findall(content))
+    links = dict.fromkeys((target.strip(), embed == "!") for embed, target in WIKILINK_PATTERN.findall(content) if target.strip())
+    for embed, target, _ in MARKDOWN_LINK_PATTERN.findall(content):
+        target = markdown_link_target(target)
+        if target:
+            links[(target, embed == "!")] = None
+    return {"title": title, "content": content, "tags": list(tags), "links": list(links), "properties": properties}
+
+
+def _link_name(target):
+    """Name a link resolves by: the file name, without .md for notes"""
+    name = target.rsplit("/", 1)[-1]
+    return name[:-3] if name.lower().endswith(".md") else name
+
+
+class VaultIndex:
+    """SQLite index of the notes under the note folders: tags, wikilinks, Markdown links and embeds, frontmatter
+    properties and full-text search, plus the vault's image files
+
+    update() only parses notes whose size or mtime changed since the last update, so keeping the
+    index current costs one stat per note.
+    """
+
+    VERSION = 2
+    FILENAME = "index.sqlite"
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+        CREATE TABLE IF NOT EXISTS notes (id INTEGER PRIMARY KEY, path TEXT UNIQUE NOT NULL, size INTEGER, mtime_ns INTEGER, title TEXT);
+        CREATE TABLE IF NOT EXISTS tags (note_id INTEGER NOT NULL REFERENCES notes(id) ON DELETE CASCADE, tag TEXT NOT NULL COLLATE NOCASE, PRIMARY KEY (note_id, tag));
+        CREATE INDEX IF NOT EXISTS tags_by_tag ON tags (tag);
+        CREATE TABLE IF NOT EXISTS links (note_id INTEGER NOT NULL REFERENCES notes(id) ON DELETE CASCADE, target TEXT NOT NULL, name TEXT NOT NULL COLLATE NOCASE, embed INTEGER NOT NULL, PRIMARY KEY (note_id, target, embed));
+        CREATE INDEX IF NOT EXISTS links_by_name ON links (name);
+        CREATE TABLE IF NOT EXISTS properties (note_id INTEGER NOT NULL REFERENCES notes(id) ON DELETE CASCADE, key TEXT NOT NULL, value TEXT, PRIMARY KEY (note_id, key));
+        CREATE INDEX IF NOT EXISTS properties_by_key ON properties (key);
+        CREATE TABLE IF NOT EXISTS attachments (path TEXT PRIMARY KEY, name TEXT NOT NULL COLLATE NOCASE, size INTEGER);
+        CREATE INDEX IF NOT EXISTS attachments_by_name ON attachments (name);
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.stats = {"notes": 0, "parsed": 0, "removed": 0, "failed": 0}
+        self.db = self._connect()
+
+    def _connect(self):
+        db = sqlite3.connect(self.path)
+        db.execute("PRAGMA foreign_keys = ON")
+        version = db.execute("PRAGMA user_version").fetchone()[0]
+        if version not in (0, self.VERSION):
+            # Built by another version of this tool: start over rather than migrate
+            db.close()
+            self.path.unlink()
+            db = sqlite3.connect(self.path)
+            db.execute("PRAGMA foreign_keys = ON")
+        db.executescript(self.SCHEMA)
+        try:
+            db.execute("CREATE VIRTUAL TABLE IF NOT EXISTS notes_fts USING fts5 (title, content)")
+            self.fts = True
+        except sqlite3.OperationalError:  # SQLite built without FTS5
+            self.fts = False
+        db.execute(f"PRAGMA user_version = {self.VERSION}")
+        return db
+
+    def close(self):
+        self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def update(self, vault_path, note_paths, attachments):
+        """Bring the index in line with the notes (vault-relative paths) and image attachments given
+
+        Notes whose size and mtime match the index are skipped; new and changed notes are parsed and
+        notes that are gone are dropped, all in one SQLite transaction.
+        """
+        vault_path = Path(vault_path)
+        indexed = {path: (note_id, size, mtime_ns) for note_id, path, size, mtime_ns in self.db.execute("SELECT id, path, size, mtime_ns FROM notes")}
+        seen = set()
+        with self.db:
+            for relative in note_paths:
+                seen.add(relative)
+                path = vault_path / relative
+                try:
+                    stat_result = path.stat()
+                    record = indexed.get(relative)
+                    if record and record[1:] == (stat_result.st_size, stat_result.st_mtime_ns):
+                        continue
+                    metadata = parse_note_metadata(path.read_text(encoding="utf-8"))
+                except (OSError, UnicodeDecodeError):
+                    self.stats["failed"] += 1
+                    continue
+                if record:
+                    self._delete(record[0])
+                self._insert(relative, stat_result, metadata)
+                self.stats["parsed"] += 1
+
+            removed = [record[0] for path, record in indexed.items() if path not in seen]
+            for note_id in removed:
+                self._delete(note_id)
+            self.stats["removed"] = len(removed)
+            self.stats["notes"] = len(seen)
+
+            current = {path: size for path, size in attachments}
+            stored = dict(self.db.execute("SELECT path, size FROM attachments"))
+            self.db.executemany("DELETE FROM attachments WHERE path = ?", [(path,) for path in stored.keys() - current.keys()])
+            self.db.executemany(
+                "INSERT OR REPLACE INTO attachments (path, name, size) VALUES (?, ?, ?)",
+                [(path, path.rsplit("/", 1)[-1], size) for path, size in current.items() if stored.get(path) != size],
+            )
+        return self.stats
+
+    def _insert(self, relative, stat_result, metadata):
+        note_id = self.db.execute("INSERT INTO notes (path, size, mtime_ns, title) VALUES (?, ?, ?, ?)", (relative, stat_result.st_size, stat_result.st_mtime_ns, metadata["title"])).lastrowid
+        self.db.executemany("INSERT OR IGNORE INTO tags (note_id, tag) VALUES (?, ?)", [(note_id, tag) for tag in metadata["tags"]])
+        self.db.executemany("INSERT OR IGNORE INTO links (note_id, target, name, embed) VALUES (?, ?, ?, ?)", [(note_id, target, _link_name(target), embed) for target, embed in metadata["links"]])
+        self.db.executemany("INSERT INTO properties (note_id, key, value) VALUES (?, ?, ?)", [(note_id, key, value) for key, value in metadata["properties"].items()])
+        if self.fts:
+            self.db.execute("INSERT INTO notes_fts (rowid, title, content) VALUES (?, ?, ?)", (note_id, metadata["title"], metadata["content"]))
+
+    def _delete(self, note_id):
+        self.db.execute("DELETE FROM notes WHERE id = ?", (note_id,))
+        if self.fts:
+            self.db.execute("DELETE FROM notes_fts WHERE rowid = ?", (note_id,))
+
+    def tags(self):
+        """Return (tag, note count) for every tag, most used first"""
+        return self.db.execute("SELECT tag, COUNT(*) FROM tags GROUP BY tag ORDER BY COUNT(*) DESC, tag").fetchall()
+
+    def notes_with_tag(self, tag):
+        """Return the notes tagged with tag or one of its nested tags (tag/child), like Obsidian's tag search"""
+        tag = tag.lstrip("#")
+        return [row[0] for row in self.db.execute("SELECT DISTINCT n.path FROM tags t JOIN notes n ON n.id = t.note_id WHERE t.tag = ? OR substr(t.tag, 1, ?) = ? ORDER BY n.path", (tag, len(tag) + 1, tag + "/"))]
+
+    def backlinks(self, target):
+        """Return (note, embed) for every link to target (a note name, file name or vault path)"""
+        return self.db.execute("SELECT DISTINCT n.path, l.embed FROM links l JOIN notes n ON n.id = l.note_id WHERE l.name = ? OR l.target = ? ORDER BY n.path", (_link_name(target), target)).fetchall()
+
+    def notes_with_property(self, key):
+        """Return (note, raw value) for every note whose frontmatter has key"""
+        return self.db.execute("SELECT n.path, p.value FROM properties p JOIN notes n ON n.id = p.note_id WHERE p.key = ? ORDER BY n.path", (key,)).fetchall()
+
+    def search(self, query, limit=50):
+        """Full-text search of titles and content, best matches first; returns (note, snippet)"""
+        if not self.fts:
+            pattern = f"%{query}%"
+            return [(path, "") for (path,) in self.db.execute("SELECT path FROM notes WHERE title LIKE ? ORDER BY path LIMIT ?", (pattern, limit))]
+        return self.db.execute("SELECT n.path, snippet(notes_fts, 1, '[', ']', '…', 12) FROM notes_fts JOIN notes n ON n.id = notes_fts.rowid WHERE notes_fts MATCH ? ORDER BY rank LIMIT ?", (query, limit)).fetchall()
+
+    def orphaned_attachments(self):
+        """Return the images that no indexed note links to or embeds, by file name or vault path
+
+        Only notes in the index count, so an image linked only from outside the note folders is reported too.
+        """
+        return [row[0] for row in self.db.execute("SELECT a.path FROM attachments a WHERE NOT EXISTS (SELECT 1 FROM links l WHERE l.name = a.name OR l.target = a.path) ORDER BY a.path")]
+
+
+ATTACHMENT_EXTENSIONS = IMAGE_EXTENSIONS | {".pdf", ".mp3", ".m4a", ".wav", ".ogg", ".mp4", ".webm", ".mov"}
+
+# Bytes hashed from each end of a file in the second duplicate-scan stage
+DEDUP_BLOCK_SIZE = 64 * 1024
+
+# Wikilinks and embeds split into "[[" or "![[", the link target, and the rest ("#heading|alias]]")
+ATTACHMENT_LINK_PATTERN = re.compile(r"(!?\[\[)([^\]|#^]*)([^\]]*]])")
+
+
+def hash_file_ends(path, size):
+    """Return the sha256 hex digest of a file's first and last DEDUP_BLOCK_SIZE bytes (the whole file if it is no larger)"""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        if size <= 2 * DEDUP_BLOCK_SIZE:
+            digest.update(f.read())
+        else:
+            digest.update(f.read(DEDUP_BLOCK_SIZE))
+            f.seek(-DEDUP_BLOCK_SIZE, os.SEEK_END)
+            digest.update(f.read(DEDUP_BLOCK_SIZE))
+    return digest.hexdigest()
+
+
+class DuplicateScanner:
+    """Finds byte-identical files, narrowing the candidates in stages so most files are never read in full
+
+    Files are grouped by size, then same-size files by a hash of their first and last block, and
+    only files that still collide are hashed in full. Hashes are cached by path, size and mtime,
+    so a re-scan only reads files that changed. Hard links to one inode count as one file.
+    """
+
+    VERSION = 1
+
+    def __init__(self, root, cache_path, jobs=8):
+        self.root = Path(root)
+        self.cache_path = Path(cache_path)
+        self.jobs = max(1, jobs)
+        self.stats = {"files": 0, "candidates": 0, "ends_hashed": 0, "fully_hashed": 0, "cached": 0}
+
+    def _load_cache(self):
+        try:
+            with open(self.cache_path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            if data.get("version") == self.VERSION and isinstance(data.get("files"), dict):
+                return data["files"]
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            print(f"⚠️ Ignoring unreadable duplicate scan cache {self.cache_path}: {e}", file=sys.stderr)
+        return {}
+
+    def _hash_stage(self, paths, key, records, cached, hasher):
+        """Fill records[path][key] for paths, from the cache when size and mtime match, otherwise with hasher on a thread pool"""
+        to_hash = []
+        for path in paths:
+            record, previous = records[path], cached.get(path)
+            if previous and previous.get(key) and (previous.get("size"), previous.get("mtime_ns")) == (record["size"], record["mtime_ns"]):
+                record[key] = previous[key]
+                self.stats["cached"] += 1
+            else:
+                to_hash.append(path)
+
+        def run(path):
+            try:
+                return hasher(self.root / path, records[path]["size"])
+            except OSError:
+                return None
+
+        if to_hash:
+            with ThreadPoolExecutor(max_workers=min(self.jobs, len(to_hash))) as executor:
+                for path, digest in zip(to_hash, executor.map(run, to_hash)):
+                    records[path][key] = digest
+        return len(to_hash)
+
+    def scan(self, files, key=None):
+        """Return groups of identical files from (vault-relative path, stat_result) pairs
+
+        Each group is sorted by key (default: the path), and of several hard links to one file only
+        the first by key is considered.
+        """
+        key = key or (lambda path: path)
+        cached = self._load_cache()
+        records, inodes = {}, set()
+        for path, stat_result in sorted(files, key=lambda item: key(item[0])):
+            if (stat_result.st_dev, stat_result.st_ino) in inodes:
+                continue
+            inodes.add((stat_result.st_dev, stat_result.st_ino))
+            records[path] = {"size": stat_result.st_size, "mtime_ns": stat_result.st_mtime_ns}
+        self.stats["files"] = len(records)
+
+        def collide(paths, key):
+            groups = {}
+            for path in paths:
+                if records[path].get(key) is not None:
+                    groups.setdefault((records[path]["size"], records[path][key]), []).append(path)
+            return [group for group in groups.values() if len(group) > 1]
+
+        by_size = {}
+        for path, record in records.items():
+            if record["size"]:
+                by_size.setdefault(record["size"], []).append(path)
+        candidates = [path for group in by_size.values() if len(group) > 1 for path in group]
+        self.stats["candidates"] = len(candidates)
+
+        self.stats["ends_hashed"] = self._hash_stage(candidates, "ends", records, cached, hash_file_ends)
+        groups = collide(candidates, "ends")
+        # Files no larger than two blocks were read whole by the previous stage
+        large = [path for group in groups for path in group if records[path]["size"] > 2 * DEDUP_BLOCK_SIZE]
+        self.stats["fully_hashed"] = self._hash_stage(large, "full", records, cached, lambda path, size: hash_file(path))
+        groups = [group for group in groups if records[group[0]]["size"] <= 2 * DEDUP_BLOCK_SIZE] + collide(large, "full")
+
+        if records != cached:
+            write_file_atomic(self.cache_path, json.dumps({"version": self.VERSION, "files": records}, separators=(",", ":")).encode("utf-8"))
+        return sorted(sorted(group, key=key) for group in groups)
+
+
+DIRECTORY_GLOB_PATTERN = re.compile(r"[*?[]")
+
+
+def is_directory_pattern(entry):
+    """Return True if a folder entry of config.json is a glob rather than a literal path"""
+    return bool(DIRECTORY_GLOB_PATTERN.search(entry))
+
+
+def translate_directory_pattern(pattern):
+    """Translate a folder glob into a regex for "/" + a vault-relative folder path
+
+    "*" and "?" match within one folder name, "[...]" is a character class and a "**" segment
+    matches any number of folders (including none).
+    """
+    regex = []
+    for segment in pattern.strip("/").split("/"):
+        if segment == "**":
+            regex.append("(?:/[^/]+)*")
+            continue
+        regex.append("/")
+        i = 0
+        while i < len(segment):
+            char = segment[i]
+            if char == "*":
+                regex.append("[^/]*")
+            elif char == "?":
+                regex.append("[^/]")
+            elif char == "[" and "]" in segment[i + 2 :]:
+                end = segment.index("]", i + 2)
+                body = segment[i + 1 : end]
+                negate = body.startswith("!")
+                body = (body[1:] if negate else body).replace("\\", "\\\\").replace("[", "\\[")
+                if not negate and body.startswith("^"):
+                    body = "\\" + body
+                regex.append("[" + ("^/" if negate else "") + body + "]")
+                i = end
+            else:
+                regex.append(re.escape(char))
+            i += 1
+    return "".join(regex)
+
+
+def directory_pattern_specificity(pattern):
+    """Rank a folder glob: more literal folder names first, then more literal characters, then fewer "**" segments"""
+    segments = pattern.strip("/").split("/")
+    literal_segments = sum(not is_directory_pattern(segment) for segment in segments)
+    literal_chars = len(re.sub(r"\[[^\]]*]|[*?]", "", pattern))
+    return (literal_segments, literal_chars, -segments.count("**"))
+
+
+def expand_directory_entries(entries, directories):
+    """Expand folder entries (literal paths or globs) against the vault's folders in one pass
+
+    Returns [(folder, index of the entry that claims it)], grouped by entry in config order and
+    sorted within an entry. A folder matched by several entries goes to the most specific one: a
+    literal path beats any glob, and ties go to the earlier entry. Literal entries are kept even
+    when the folder does not exist yet; directories is only read when there are globs.
+    """
+    claims = {}
+    patterns = []
+    for index, entry in enumerate(entries):
+        entry = entry.strip("/")
+        if is_directory_pattern(entry):
+            patterns.append((index, entry))
+        else:
+            claims.setdefault(entry, index)
+
+    if patterns:
+        # One alternation, most specific first: the first alternative that matches is the winner
+        patterns.sort(key=lambda item: (directory_pattern_specificity(item[1]), -item[0]), reverse=True)
+        matcher = re.compile("|".join(f"(?P<p{index}>{translate_directory_pattern(entry)})" for index, entry in patterns))
+        for directory in directories:
+            if directory not in claims:
+                match = matcher.fullmatch("/" + directory)
+                if match:
+                    claims[directory] = int(match.lastgroup[1:])
+
+    return sorted(claims.items(), key=lambda item: (item[1], item[0]))
+
+
+class DirectoryIndex:
+    """Every folder of a vault outside dot folders, cached with each folder's mtime and subfolder names
+
+    A folder's mtime changes when entries are added to or removed from it, so a refresh only lists
+    the folders whose mtime changed and costs one stat per folder otherwise.
+    """
+
+    VERSION = 1
+
+    def __init__(self, root, cache_path):
+        self.root = Path(root)
+        self.cache_path = Path(cache_path)
+        self.listed = 0
+
+    def load(self):
+        """Return every folder below the root as a sorted list of vault-relative paths"""
+        cached = {}
+        try:
+            with open(self.cache_path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            if data.get("version") == self.VERSION and isinstance(data.get("directories"), dict):
+                cached = data["directories"]
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            print(f"⚠️ Ignoring unreadable folder cache {self.cache_path}: {e}", file=sys.stderr)
+
+        directories = {}
+        pending = [""]
+        while pending:
+            relative = pending.pop()
+            try:
+                mtime_ns = os.stat(self.root / relative).st_mtime_ns
+                record = cached.get(relative)
+                if record and record.get("mtime_ns") == mtime_ns:
+                    children = record["children"]
+                else:
+                    with os.scandir(self.root / relative) as entries:
+                        children = sorted(entry.name for entry in entries if not entry.name.startswith(".") and entry.is_dir(follow_symlinks=False))
+                    self.listed += 1
+            except OSError:
+                continue
+            directories[relative] = {"mtime_ns": mtime_ns, "children": children}
+            pending.extend(f"{relative}/{child}" if relative else child for child in children)
+
+        if directories != cached:
+            write_file_atomic(self.cache_path, json.dumps({"version": self.VERSION, "directories": directories}, separators=(",", ":")).encode("utf-8"))
+        return sorted(relative for relative in directories if relative)
 
 
 class ObsidianSetup:
-    def __init__(self, vault_path=None, source_path=None, backup_existing_config=True, backup_directory=".obsidian-setup-backup", overwrite_existing_files=True):
+    # Kept in the vault's state folder (STATE_DIRNAME)
+    MANIFEST_FILENAME = "manifest.json"
+    PLUGIN_CACHE_FILENAME = "plugins.json"
+    AUDIT_CACHE_FILENAME = "audit.json"
+    DEDUP_CACHE_FILENAME = "dedup.json"
+    DIRECTORY_CACHE_FILENAME = "directories.json"
+
+    # AI agent ignore files written from paths.sensitive
+    IGNORE_FILES = {
+        ".cursorignore": "Ignore file for Cursor AI agent",
+        ".cursorindexingignore": "Ignore file for Cursor indexing only",
+        ".codeiumignore": "Ignore file for Codeium/Windsurf agent",
+        ".geminiignore": "Ignore file for Gemini CLI",
+        ".aiexclude": "Ignore file for Gemini Code Assist",
+        ".aiderignore": "Ignore file for Aider agent",
+        ".aiignore": "Universal AI agent ignore file (standard)",
+    }
+
+    # Names that usually hold secrets; the sensitive-file audit warns when an agent can see one
+    SENSITIVE_FILE_PATTERNS = [".env", ".env.*", "*.pem", "*.key", "*.p12", "*.pfx", "id_rsa*", "id_ed25519*", "*secret*", "*credential*", "*password*", f"{STATE_DIRNAME}/"]
+
+    def __init__(self, vault_path=None, source_path=None, backup_existing_config=True, backup_directory=DEFAULT_BACKUP_DIRECTORY, overwrite_existing_files=True, force=False, jobs=1, template_context=None, backup_keep=20, backup_format="store", events=None, obsidian_version=None, source_bundle=None):
         self.vault_path = Path(vault_path) if vault_path else Path.cwd()
-        self.source_path = Path(source_path) if source_path else Path.cwd()
+        self.bundle = open_source_bundle(str(Path(source_bundle).resolve())) if source_bundle else None
+        self.source_path = self.bundle.root if self.bundle else (Path(source_path) if source_path else Path.cwd())
         self.obsidian_path = self.vault_path / ".obsidian"
         self.plugins_path = self.obsidian_path / "plugins"
         self.templater_data_path = self.plugins_path / "templater-obsidian" / "data.json"
         self.config_path = self.vault_path / "config.json"
         self.source_config_path = self.source_path / "config.json"
         self.config = None
+        self.settings = LayeredConfig(self.source_config_path, self.config_path)
+        self.snapshot = FileSystemSnapshot()
+        self.source_hashes = {}
         self.backup_existing_config = backup_existing_config
         self.backup_directory = self.vault_path / backup_directory
+        migrate_legacy_state(self.vault_path, in_use={self.backup_directory})
         self.overwrite_existing_files = overwrite_existing_files
+        self.backup_format = backup_format
+        self.backups = BackupCatalog(self.backup_directory, backup_format)
+        self.backup_keep = backup_keep
+        self.force = force
+        self.jobs = max(1, jobs)
+        self.renderer = TemplateRenderer(template_context if template_context is not None else build_template_context())
+        self._stats_lock = threading.Lock()
+        self._log_buffer = threading.local()
+        self.events = events or EventStream()
+        self.profiles = None
+        self.manifest = DeployManifest(state_path(self.vault_path, self.MANIFEST_FILENAME))
+        self.deploy_stats = {"copied": 0, "updated": 0, "unchanged": 0}
+        self.plugins = PluginInventory(self.plugins_path, state_path(self.vault_path, self.PLUGIN_CACHE_FILENAME))
+        self.obsidian_version = obsidian_version
+        self.transaction = None
+        if self.bundle is not None:
+            self.use_source_bundle(self.bundle)
+
+    def emit(self, event):
+        """Send an event to the event stream, or buffer it when called from a parallel task"""
+        event.setdefault("time", time.time())
+        events = getattr(self._log_buffer, "events", None)
+        if events is None:
+            self.events.write(event)
+        else:
+            events.append(event)
+
+    def log(self, message=""):
+        """Emit a human-readable message"""
+        self.emit({"event": "log", "message": message})
+
+    @contextlib.contextmanager
+    def operation(self, phase, path=None):
+        """Time an operation and emit it as a structured event; the caller fills in bytes and outcome"""
+        event = {"event": "operation", "phase": phase, "path": str(path) if path is not None else None, "bytes": 0, "outcome": "ok"}
+        started = time.perf_counter()
+        try:
+            yield event
+        except BaseException:
+            event["outcome"] = "error"
+            raise
+        finally:
+            event["duration"] = time.perf_counter() - started
+            self.emit(event)
+
+    def _count_deploy(self, outcome):
+        with self._stats_lock:
+            self.deploy_stats[outcome] += 1
+
+    def replace_file(self, path, write, mode=None, fsync=False):
+        """Atomically replace a vault file through write(fd), staged in the open transaction if there is one
+
+        Returns the new file's stat, which the snapshot records in place of the target's.
+        """
+        if self.transaction is None:
+            _replace_atomic(path, write, mode, fsync)
+            return self.snapshot.record(path)
+        return self.snapshot.record(path, self.transaction.stage(path, write, mode, fsync))
+
+    def write_file(self, path, data, mode=None, fsync=False):
+        """Atomically replace a vault file with bytes (see replace_file)"""
+        return self.replace_file(path, lambda fd: _write_all(fd, data), mode, fsync)
+
+    def load_config(self):
+        """Load configuration from config.json, merged over the source config.json"""
+        # Within a transaction, read the config.json this run has staged but not yet committed
+        staged_config = self.transaction.staged_path(self.config_path) if self.transaction else None
+        self.settings.redirect(self.config_path, staged_config)
+        if staged_config is None and not self.config_path.exists():
+            self.log(f"❌ Configuration file not found: {self.config_path}")
+            self.log("Please ensure config.json exists in the vault root directory.")
+            sys.exit(1)
+
+        self.settings.refresh()
+        if self.settings.errors:
+            self.log("❌ Error loading configuration:")
+            for error in self.settings.errors:
+                self.log(f"   - {error}")
+            sys.exit(1)
+
+        return self.settings.data
+
+    def check_required_plugins(self):
+        """Check that every required plugin is installed, readable and satisfies its version constraints"""
+        required_plugins = self.config.get("required_plugins", [])
+
+        self.plugins.load()
+        missing_plugins = []
+        problems = []
+        for requirement in required_plugins:
+            with self.operation("plugins", requirement) as event:
+                status, message = self.plugins.check(requirement, self.obsidian_version)
+                event["outcome"] = "installed" if status == "ok" else status
+                if status == "missing":
+                    missing_plugins.append(parse_plugin_requirement(requirement)[0])
+                elif status != "ok":
+                    problems.append(message)
+
+        if problems:
+            self.log("❌ The following required plugins are installed but not usable:")
+            for problem in problems:
+                self.log(f"   - {problem}")
+            self.log("Update or reinstall them in Obsidian under Settings > Community plugins, then run this script again.")
+
+        if missing_plugins:
+            self.log("❌ The following required plugins are not installed:")
+            for plugin in missing_plugins:
+                self.log(f"   - {plugin}")
+            self.log("\nInstallation instructions:")
+            self.log("1. Open Obsidian and go to Settings > Community plugins")
+            self.log("2. Click the 'Browse' button")
+            self.log("3. Search for and install the plugins listed above")
+            self.log("4. Enable the plugins after installation")
+            self.log("5. Run this script again after installation is complete")
+
+        if problems or missing_plugins:
+            return False
+
+        self.log(f"✅ All required plugins are installed. ({len(self.plugins.plugins)} plugins in inventory, {self.plugins.parsed} manifest(s) read)")
+        return True
+
+    def list_plugins(self):
+        """Print the installed plugins from the plugin inventory"""
+        self.plugins.load()
+        plugins = self.plugins.list()
+        if not plugins:
+            self.log(f"📭 No plugins found in: {self.plugins_path}")
+            return True
+
+        self.log(f"🧩 Installed plugins in {self.plugins_path} ({self.plugins.parsed} manifest(s) read, {len(plugins) - self.plugins.parsed} from cache):")
+        success = True
+        for folder, record in plugins:
+            manifest = record.get("manifest")
+            if manifest is None:
+                self.log(f"   ❌ {folder}: unreadable manifest ({record['error']})")
+                success = False
+                continue
+            note = ""
+            min_app_version = manifest.get("minAppVersion")
+            if self.obsidian_version and min_app_version and parse_version(min_app_version) > parse_version(self.obsidian_version):
+                note = f"  ⚠️ needs Obsidian {min_app_version}"
+                success = False
+            self.log(f"   - {manifest['id']} {manifest['version']}" + (f" (min app {min_app_version})" if min_app_version else "") + note)
+        return success
+
+    def get_command_templates(self):
+        """Find template files specifically in the Commands folder for hotkey registration"""
+        commands_folder = self.config["paths"]["commands_folder"]
+        commands_path = self.vault_path / commands_folder
+
+        if not self.snapshot.is_dir(commands_path):
+            self.log(f"⚠️ Commands folder not found: {commands_path}")
+            return []
+
+        command_files = []
+        for name, entry in self.snapshot.listdir(commands_path).items():
+            if name.endswith(".md") and entry.is_file():
+                relative_path = (commands_path / name).relative_to(self.vault_path)
+                command_files.append(str(relative_path))
+
+        return sorted(command_files)
+
+    def _get_config_value(self, path, default=None):
+        """Get configuration value from the layered (vault over source) config"""
+        return self.settings.get(path, default)
+
+    def copy_file(self, source_path, target_path, backup_relative_path=None, templating=False, relative_path=None):
+        """Copy a file from source to target with automatic backup, overwrite handling, and logging"""
+        target = Path(str(target_path))
+        with self.operation("copy", relative_path if relative_path else target.name) as event:
+            return self._copy_file(event, Path(str(source_path)), target, backup_relative_path, templating, relative_path)
+
+    def _copy_file(self, event, source, target, backup_relative_path, templating, relative_path):
+        display_path = relative_path if relative_path else target.name
+        event["outcome"] = "failed"
+
+        if not self.snapshot.exists(source):
+            self.log(f"❌ Source file not found: {source}")
+            return False
+
+        # Check if target exists and handle overwrite logic
+        file_existed = self.snapshot.exists(target)
+
+        if file_existed and not self.overwrite_existing_files:
+            self.log(f"⚠️ Skipped (already exists): {display_path}")
+            event["outcome"] = "skipped"
+            return True  # Return True as this is expected behavior, not an error
+
+        rendered = None
+        try:
+            key = self._manifest_key(target)
+            entry = None if self.force else self.manifest.get(key)
+            source_stat = self.snapshot.stat(source)
+            target_stat = self.snapshot.stat(target) if file_existed else None
+
+            # Render templated files up front so the rendered hash can be compared with the deployed one
+            if templating:
+                rendered = self.renderer.render(source)
+                source_hash = rendered.source_hash
+                rendered_hash = rendered.rendered_hash
+                expected_size = rendered.size
+            else:
+                rendered_hash = None
+                expected_size = source_stat.st_size
+                if entry and DeployManifest.stat_matches(entry, source_stat, "source_"):
+                    source_hash = entry["source_hash"]
+                else:
+                    source_hash = self._hash_source(source, source_stat)
+            content_hash = rendered_hash or source_hash
+
+            if file_existed and self._is_deployed(entry, target, target_stat, content_hash, expected_size):
+                self.manifest.record(key, source_stat, target_stat, source_hash, rendered_hash)
+                self._count_deploy("unchanged")
+                event["outcome"] = "unchanged"
+                return True
+
+            # Create parent directories if they don't exist
+            self.snapshot.ensure_dir(target.parent)
+
+            # Create backup if backup path is provided, backup is enabled, and file exists
+            if backup_relative_path and file_existed:
+                known_hash = entry.get("rendered_hash", entry.get("source_hash")) if entry and DeployManifest.stat_matches(entry, target_stat) else None
+                self.create_backup(target, backup_relative_path, known_hash)
+
+            # Write through a temp file so an interrupted or concurrent copy never leaves a truncated target.
+            # Non-templated files are copied as raw bytes, so binary assets work and memory stays flat.
+            mode = (target_stat.st_mode & 0o7777) if target_stat else None
+            if templating:
+                target_stat = self.replace_file(target, rendered.write_to, mode)
+            elif self.bundle is not None:
+                target_stat = self.write_file(target, self.bundle.read(source), mode)
+            else:
+                with open(source, "rb") as src:
+                    target_stat = self.replace_file(target, lambda fd: copy_fd(src.fileno(), fd), mode)
+
+            self.manifest.record(key, source_stat, target_stat, source_hash, rendered_hash)
+
+            # Log success based on whether file existed before
+            action = "Updated" if file_existed else "Copied"
+            self._count_deploy(action.lower())
+            event["outcome"] = action.lower()
+            event["bytes"] = expected_size
+            self.log(f"✅ {action}: {display_path}")
+            return True
+
+        except Exception as e:
+            self.log(f"❌ Failed to copy: {display_path} ({e})")
+            return False
+
+        finally:
+            if rendered is not None:
+                rendered.close()
+
+    def _hash_source(self, source, source_stat):
+        """Hash a source file, reusing an earlier hash while its size and mtime are unchanged"""
+        key = os.path.abspath(source)
+        cached = self.source_hashes.get(key)
+        if cached and cached[0] == source_stat.st_size and cached[1] == source_stat.st_mtime_ns:
+            return cached[2]
+        source_hash = hash_bytes(self.bundle.read(source)) if self.bundle is not None else hash_file(source)
+        self.source_hashes[key] = (source_stat.st_size, source_stat.st_mtime_ns, source_hash)
+        return source_hash
+
+    def use_prepared_source(self, prepared):
+        """Reuse a source tree that was already scanned, hashed and compiled (see PreparedSource)"""
+        self.snapshot.preload(prepared.listings)
+        self.source_hashes.update(prepared.hashes)
+        self.renderer.preload(prepared.compiled)
+        with _json_cache_lock:
+            _json_cache.update(prepared.json_cache)
+
+    def use_source_bundle(self, bundle):
+        """Read the source from a bundle (see SourceBundle) instead of a source directory"""
+        self.snapshot.preload(bundle.listings())
+        self.source_hashes.update(bundle.hashes())
+        self.renderer.preload(bundle.compiled_templates())
+        self.renderer.reader = bundle.read
+        self.settings.pin(self.source_config_path, bundle.config())
+
+    def _manifest_key(self, target):
+        """Return the manifest key for a target path (vault relative when possible)"""
+        try:
+            return target.relative_to(self.vault_path).as_posix()
+        except ValueError:
+            return target.as_posix()
+
+    def _is_deployed(self, entry, target, target_stat, content_hash, expected_size):
+        """Check whether an existing target already holds the expected content"""
+        if self.force:
+            return False
+
+        # Target untouched since the last deploy: compare hashes from the manifest without reading it
+        if entry and DeployManifest.stat_matches(entry, target_stat):
+            return entry.get("rendered_hash", entry.get("source_hash")) == content_hash
+
+        # Unknown or modified target: only read it when the size could match
+        if target_stat.st_size != expected_size:
+            return False
+        return hash_file(target) == content_hash
+
+    def create_backup(self, source_path, relative_path=None, content_hash=None):
+        """Back up a file (or every file in a directory) into the content-addressed backup store"""
+        if not self.backup_existing_config:
+            return False
+
+        source = Path(source_path)
+        if not self.snapshot.exists(source):
+            return False
+
+        # Use relative path if provided, otherwise use filename
+        name = Path(relative_path) if relative_path else Path(source.name)
+
+        with self.operation("backup", name) as event:
+            try:
+                if self.snapshot.is_file(source):
+                    self.backups.add(source, self._manifest_key(source), name, content_hash)
+                    event["bytes"] = self.snapshot.stat(source).st_size
+                else:
+                    for item in self.snapshot.walk_files(source):
+                        self.backups.add(item, self._manifest_key(item), name / item.relative_to(source))
+                        event["bytes"] += self.snapshot.stat(item).st_size
+
+                self.log(f"📋 Backed up: {name}")
+                return True
+            except Exception as e:
+                event["outcome"] = "failed"
+                self.log(f"⚠️ Failed to backup {source}: {e}")
+                return False
+
+    def commit_backups(self, run_id=None):
+        """Write this run's backup snapshot and apply the retention policy"""
+        try:
+            snapshot_id = self.backups.commit(self.vault_path, run_id)
+            if snapshot_id:
+                self.log(f"🗄️ Backup snapshot: {snapshot_id} (restore with --restore {snapshot_id})")
+            removed_snapshots, removed_objects = self.backups.prune(self.backup_keep)
+            if removed_snapshots:
+                self.log(f"🧹 Pruned {removed_snapshots} old backup snapshot(s)" + (f" and {removed_objects} unreferenced object(s)" if removed_objects else ""))
+            return snapshot_id
+        except Exception as e:
+            self.log(f"⚠️ Failed to save backup snapshot: {e}")
+            return None
+
+    def list_backups(self):
+        """Print the backup snapshots stored for this vault"""
+        snapshots = self.backups.list_snapshots()
+        if not snapshots:
+            self.log(f"📭 No backup snapshots found in: {self.backup_directory}")
+            return True
+
+        self.log(f"🗄️ Backup snapshots in {self.backup_directory}:")
+        for snapshot in snapshots:
+            files = snapshot.get("files", {})
+            size = sum(info.get("size", 0) for info in files.values())
+            self.log(f"   - {snapshot['id']}  {snapshot.get('created', '')}  {len(files)} file(s), {size} bytes" + ("  (archive)" if snapshot["format"] == "archive" else ""))
+        return True
+
+    def restore_backup(self, reference):
+        """Restore the files of a backup snapshot that differ from the vault"""
+        snapshot = self.backups.find_snapshot(reference)
+        if not snapshot:
+            self.log(f"❌ Backup snapshot not found (or ambiguous): {reference}")
+            self.log("Use --list-backups to see available snapshots.")
+            return False
+
+        files = snapshot.get("files", {})
+        self.log(f"♻️ Restoring backup snapshot {snapshot['id']} ({len(files)} file(s))...")
+
+        restored = unchanged = failed = 0
+        for key, info in sorted(files.items()):
+            target = self.vault_path / key
+            if not self.backups.has(snapshot, key):
+                self.log(f"❌ Missing backup data for: {key}")
+                failed += 1
+                continue
+
+            try:
+                target_exists = self.snapshot.is_file(target)
+                if target_exists and self.snapshot.stat(target).st_size == info["size"] and hash_file(target) == info["hash"]:
+                    unchanged += 1
+                    continue
+
+                # Back up the current version first so the restore itself can be undone
+                if target_exists:
+                    self.create_backup(target, key)
+                self.snapshot.ensure_dir(target.parent)
+                self.backups.extract(snapshot, key, target, info.get("mode"))
+                self.snapshot.record(target)
+                self.log(f"✅ Restored: {key}")
+                restored += 1
+            except Exception as e:
+                self.log(f"❌ Failed to restore {key}: {e}")
+                failed += 1
+
+        self.commit_backups()
+        self.log(f"📊 Restore summary: {restored} restored, {unchanged} unchanged, {failed} failed")
+        return failed == 0
+
+    def _copy_directory_contents(self, source_dir, target_dir, backup_prefix=None):
+        """Copy directory contents recursively, creating directories as needed and only overwriting files if specified"""
+        source = Path(source_dir)
+        target = Path(target_dir)
+
+        if not self.snapshot.is_dir(source):
+            self.log(f"❌ Source directory not found: {source}")
+            return False
+
+        # Create target directory if it doesn't exist
+        self.snapshot.ensure_dir(target)
+
+        # Determine backup prefix based on source directory name if not provided
+        if backup_prefix is None:
+            backup_prefix = source.name
+
+        try:
+            copy_jobs = []
+            for item in self.snapshot.walk_files(source):
+                # Calculate relative path from source
+                relative_path = item.relative_to(source)
+                target_file = target / relative_path
+
+                # Generate backup path maintaining directory structure
+                backup_relative_path = Path(backup_prefix) / relative_path
+                copy_jobs.append((item, target_file, backup_relative_path, relative_path))
+
+            total_count = len(copy_jobs)
+
+            if self.jobs > 1 and total_count > 1:
+                # Create every target directory up front so workers only open and write files
+                for target_parent in sorted({job[1].parent for job in copy_jobs}):
+                    self.snapshot.ensure_dir(target_parent)
+
+                # Results come back in submission order, so buffered logs print deterministically
+                with ThreadPoolExecutor(max_workers=self.jobs) as executor:
+                    results = list(executor.map(self._copy_file_buffered, copy_jobs))
+                for _, events in results:
+                    for event in events:
+                        self.emit(event)
+                success_count = sum(1 for copied, _ in results if copied)
+            else:
+                # Copy file (copy_file handles all logic internally)
+                success_count = 0
+                for item, target_file, backup_relative_path, relative_path in copy_jobs:
+                    if self.copy_file(item, target_file, backup_relative_path=backup_relative_path, relative_path=relative_path):
+                        success_count += 1
+
+            self.log(f"✅ Processed {backup_prefix} folder: {success_count}/{total_count} files processed successfully")
+            return success_count == total_count
+
+        except Exception as e:
+            self.log(f"❌ Error copying directory contents: {e}")
+            return False
+
+    def _copy_file_buffered(self, copy_job):
+        """Run copy_file in a worker thread, returning its result and buffered log lines"""
+        item, target_file, backup_relative_path, relative_path = copy_job
+        return self._run_buffered(lambda: self.copy_file(item, target_file, backup_relative_path=backup_relative_path, relative_path=relative_path))
+
+    def get_templated_sources(self):
+        """List the source files that are rendered as templates (config.json and the .gemini folder)"""
+        sources = [self.source_config_path]
+        source_gemini_path = self.source_path / ".gemini"
+        if self.snapshot.is_dir(source_gemini_path):
+            sources.extend(self.snapshot.walk_files(source_gemini_path))
+        return sources
+
+    def check_template_variables(self):
+        """Check that every variable used by templated source files is defined"""
+        problems = []
+        for source in self.get_templated_sources():
+            relative_path = source.relative_to(self.source_path).as_posix()
+            try:
+                missing = self.renderer.missing_variables(source)
+            except Exception as e:
+                problems.append(f"{relative_path}: {e}")
+                continue
+            if missing:
+                problems.append(f"{relative_path}: {', '.join(sorted(missing))}")
+
+        if problems:
+            self.log("❌ Missing or invalid template variables:")
+            for problem in problems:
+                self.log(f"   - {problem}")
+            self.log("Set them in the environment, in a .env file (--env-file) or with --set KEY=VALUE.")
+            return False
+        return True
+
+    def prepare_copy(self):
+        """Check the source tree and template variables, and load the deploy manifest, before copying"""
+        # Check if source files exist
+        if not self.snapshot.is_file(self.source_config_path):
+            self.log(f"❌ Source config.json not found: {self.source_config_path}")
+            return False
+
+        source_templater_path = self.source_path / "Templater"
+        if not self.snapshot.is_dir(source_templater_path):
+            self.log(f"❌ Source Templater folder not found: {source_templater_path}")
+            return False
+
+        # Report every missing template variable up front instead of failing on the first templated file
+        if not self.check_template_variables():
+            return False
+
+        self.manifest.load()
+        self.deploy_stats = {"copied": 0, "updated": 0, "unchanged": 0}
+        return True
+
+    def finish_copy(self):
+        """Save the deploy manifest and report what the copy step did"""
+        self.manifest.save(self.write_file)
+        stats = self.deploy_stats
+        self.log(f"📊 Deploy summary: {stats['copied']} copied, {stats['updated']} updated, {stats['unchanged']} unchanged")
+
+    def get_copy_tasks(self):
+        """Return (name, title, function) for each part of the copy step; the parts are independent of each other"""
+        return [
+            ("copy-config", "Copying config.json", self._copy_config),
+            ("copy-templater", "Copying Templater folder", self._copy_templater),
+            ("copy-css-snippets", "Copying CSS snippets", self._copy_css_snippets),
+            ("copy-gemini", "Copying .gemini folder", self._copy_gemini),
+            ("copy-agent-files", "Copying gemini.sh and AGENTS.md", self._copy_agent_files),
+        ]
+
+    def _copy_config(self):
+        """Handle config.json (with template substitution)"""
+        return self.copy_file(self.source_config_path, self.config_path, backup_relative_path="config.json", templating=True, relative_path="config.json")
+
+    def _copy_templater(self):
+        """Handle Templater folder - copy files individually"""
+        return self._copy_directory_contents(self.source_path / "Templater", self.vault_path / "Templater", "Templater")
+
+    def _copy_css_snippets(self):
+        """Handle CssSnippets folder"""
+        source_css_snippets_path = self.source_path / "CssSnippets"
+        if not self.snapshot.is_dir(source_css_snippets_path):
+            self.log(f"⚠️ Source CssSnippets folder not found: {source_css_snippets_path}")
+            return True
+        return self._copy_directory_contents(source_css_snippets_path, self.obsidian_path / "snippets", "CssSnippets")
+
+    def _copy_gemini(self):
+        """Handle .gemini folder (with template substitution)"""
+        source_gemini_path = self.source_path / ".gemini"
+        if not self.snapshot.is_dir(source_gemini_path):
+            self.log(f"⚠️ Source .gemini folder not found: {source_gemini_path}")
+            return True
+
+        target_gemini_path = self.vault_path / ".gemini"
+        self.snapshot.ensure_dir(target_gemini_path)
+
+        # Copy .gemini files individually with template substitution
+        for item in self.snapshot.walk_files(source_gemini_path):
+            relative_path = item.relative_to(source_gemini_path)
+            target_file = target_gemini_path / relative_path
+            backup_relative_path = Path(".gemini") / relative_path
+
+            if not self.copy_file(item, target_file, backup_relative_path=backup_relative_path, templating=True, relative_path=f".gemini/{relative_path}"):
+                return False
+        return True
+
+    def _copy_agent_files(self):
+        """Handle gemini.sh and AGENTS.md.example (copied as AGENTS.md)"""
+        source_gemini_sh = self.source_path / "gemini.sh"
+        if self.snapshot.is_file(source_gemini_sh):
+            if not self.copy_file(source_gemini_sh, self.vault_path / "gemini.sh", backup_relative_path="gemini.sh", relative_path="gemini.sh"):
+                return False
+        else:
+            self.log(f"⚠️ Source gemini.sh file not found: {source_gemini_sh}")
+
+        source_agents_example = self.source_path / "AGENTS.md.example"
+        if self.snapshot.is_file(source_agents_example):
+            if not self.copy_file(source_agents_example, self.vault_path / "AGENTS.md", backup_relative_path="AGENTS.md", relative_path="AGENTS.md"):
+                return False
+        else:
+            self.log(f"⚠️ Source AGENTS.md.example file not found: {source_agents_example}")
+        return True
+
+    def expand_directories(self, entries):
+        """Expand the literal folders and globs of a config.json folder list against the vault (see expand_directory_entries)"""
+        patterns = [entry for entry in entries if is_directory_pattern(entry)]
+        if not patterns:
+            return expand_directory_entries(entries, ())
+        index = DirectoryIndex(self.vault_path, state_path(self.vault_path, self.DIRECTORY_CACHE_FILENAME))
+        directories = index.load()
+        expanded = expand_directory_entries(entries, directories)
+        matched = sum(is_directory_pattern(entries[entry]) for _, entry in expanded)
+        self.log(f"📂 {len(patterns)} folder pattern(s) matched {matched} of {len(directories)} folders ({index.listed} listed, the rest from cache)")
+        return expanded
+
+    def create_folder_templates(self):
+        """Create folder templates configuration based on note directories (literal folders or glob patterns)"""
+        note_dirs = self.config["paths"].get("note_directories", [])
+        daily_dirs = self.config["paths"].get("daily_note_directories", [])
+        new_note_template = self.config["paths"].get("new_note_template")
+        daily_note_template = self.config["paths"].get("daily_note_template")
+
+        # If no templates are configured, return empty list
+        if not new_note_template and not daily_note_template:
+            self.log("⚠️ No note templates configured, skipping folder template setup")
+            return []
+
+        entries = []
+        templates = []
+
+        # Daily note directories come first, so they win over note directories that match a folder equally well
+        for daily_dir in daily_dirs:
+            if daily_note_template:
+                entries.append(daily_dir)
+                templates.append(daily_note_template)
+            else:
+                self.log(f"⚠️ No daily note template configured for daily directory: {daily_dir}")
+
+        for note_dir in note_dirs:
+            if new_note_template:
+                entries.append(note_dir)
+                templates.append(new_note_template)
+            elif note_dir not in entries:
+                self.log(f"⚠️ No new note template configured for directory: {note_dir}")
+
+        # Each folder appears once, with the template of the most specific entry that matches it
+        return [{"folder": folder, "template": templates[entry]} for folder, entry in self.expand_directories(entries)]
+
+    def setup_templater_config(self):
+        """Configure Templater plugin settings"""
+        with self.operation("templater-config", self.templater_data_path) as event:
+            succeeded = self._setup_templater_config(event)
+            if not succeeded:
+                event["outcome"] = "failed"
+            return succeeded
+
+    def _setup_templater_config(self, event):
+        existing_config = {}
+        config_exists = self.templater_data_path.exists()
+
+        if not config_exists:
+            self.log(f"📝 Templater configuration file not found. Creating new one: {self.templater_data_path}")
+        else:
+            self.log(f"📝 Found existing Templater configuration: {self.templater_data_path}")
+
+        try:
+            # Read existing configuration if it exists
+            if config_exists:
+                with open(self.templater_data_path, "r", encoding="utf-8") as f:
+                    existing_config = json.load(f)
+
+            templater_config = self.build_templater_config(existing_config)
+
+            # Merge with existing config (preserve any additional settings)
+            merged_config = dict(existing_config)
+            merged_config.update(templater_config)
+
+            # Compare parsed JSON, so formatting differences alone never cause a rewrite
+            changes = describe_config_changes(existing_config, merged_config)
+            event["changes"] = changes
+            if config_exists and not changes:
+                event["outcome"] = "unchanged"
+                self.log("✅ Templater configuration is already up to date (nothing written).")
+                return True
+
+            # Create .obsidian/plugins/templater-obsidian directory if it doesn't exist
+            self.snapshot.ensure_dir(self.templater_data_path.parent)
+
+            # Create backup using unified backup system
+            mode = None
+            if config_exists:
+                self.create_backup(self.templater_data_path, "data.json")
+                mode = self.snapshot.stat(self.templater_data_path).st_mode & 0o7777
+
+            # Save updated configuration
+            data = json.dumps(merged_config, indent=2, ensure_ascii=False).encode("utf-8")
+            self.write_file(self.templater_data_path, data, mode, fsync=True)
+            event["bytes"] = len(data)
+
+            action = "created" if not config_exists else "updated"
+            event["outcome"] = action
+            self.log(f"✅ Templater configuration {action} successfully:")
+            self.log(f"   - Templates folder: {merged_config['templates_folder']}")
+            self.log(f"   - User scripts folder: {merged_config['user_scripts_folder']}")
+            self.log(f"   - Folder templates: {len(merged_config['folder_templates'])} folders")
+            self.log(f"   - Enabled template hotkeys: {len(merged_config['enabled_templates_hotkeys'])} templates")
+            self.log(f"   - Startup templates: {len(merged_config['startup_templates'])} template(s)")
+            self.log(f"   - File creation trigger: {'Enabled' if merged_config['trigger_on_file_creation'] else 'Disabled'}")
+            if config_exists:
+                self.log("   Changes:")
+                for line in changes:
+                    self.log(f"     {line}")
+
+            return True
+
+        except Exception as e:
+            self.log(f"❌ Error configuring Templater: {e}")
+            return False
+
+    def build_templater_config(self, existing_config):
+        """Return the Templater settings this tool manages, given the current data.json contents"""
+        # Get command template files for hotkey registration
+        command_templates = self.get_command_templates()
+
+        # Create folder templates dynamically
+        folder_templates = self.create_folder_templates()
+
+        # Keep entries the user added in Obsidian if the config asks for it
+        if self._get_config_value("templater.preserve_user_entries", False):
+            command_templates = self._preserve_user_hotkeys(existing_config.get("enabled_templates_hotkeys"), command_templates)
+            folder_templates = self._preserve_user_folder_templates(existing_config.get("folder_templates"), folder_templates)
+
+        # Create templater configuration
+        return {
+            "templates_folder": self.config["paths"]["templates_folder"],
+            "trigger_on_file_creation": True,  # Always enable
+            "user_scripts_folder": self.config["paths"]["user_scripts_folder"],
+            "enable_folder_templates": True,
+            "folder_templates": folder_templates,
+            "enable_file_templates": False,
+            "file_templates": [{"regex": ".*", "template": ""}],
+            "enabled_templates_hotkeys": command_templates,
+            "startup_templates": [self.config["paths"]["startup_template"]],
+        }
+
+    def _preserve_user_hotkeys(self, existing_hotkeys, command_templates):
+        """Keep existing hotkeys outside the commands folder; the commands folder itself is managed here"""
+        commands_prefix = self.config["paths"]["commands_folder"].rstrip("/") + "/"
+        preserved = [hotkey for hotkey in existing_hotkeys or [] if isinstance(hotkey, str) and not hotkey.startswith(commands_prefix) and hotkey not in command_templates]
+        return command_templates + preserved
+
+    def _preserve_user_folder_templates(self, existing_folder_templates, folder_templates):
+        """Keep existing folder templates for folders this tool does not manage and templates it does not assign"""
+        managed_folders = {entry["folder"] for entry in folder_templates}
+        managed_templates = {self.config["paths"].get("new_note_template"), self.config["paths"].get("daily_note_template")} - {None}
+        preserved = [entry for entry in existing_folder_templates or [] if isinstance(entry, dict) and entry.get("folder") not in managed_folders and entry.get("template") not in managed_templates]
+        return folder_templates + preserved
+
+    def get_ignore_patterns(self):
+        """Return {ignore file name: patterns}: paths.sensitive, adjusted by any per-agent override in ignore_files
+
+        An override is either a list replacing the patterns, or {"add": [...], "remove": [...]}.
+        """
+        sensitive = self.config.get("paths", {}).get("sensitive", [])
+        overrides = self.config.get("ignore_files") or {}
+        ignore_patterns = {}
+        for filename in self.IGNORE_FILES:
+            override = overrides.get(filename)
+            if isinstance(override, list):
+                patterns = override
+            elif isinstance(override, dict):
+                removed = set(override.get("remove", []))
+                patterns = [pattern for pattern in sensitive if pattern not in removed] + override.get("add", [])
+            else:
+                patterns = sensitive
+            ignore_patterns[filename] = list(dict.fromkeys(patterns))
+        return ignore_patterns
+
+    def render_ignore_files(self, ignore_patterns=None):
+        """Return {ignore file name: content}, rendering each distinct pattern list once"""
+        ignore_patterns = ignore_patterns if ignore_patterns is not None else self.get_ignore_patterns()
+        rendered = {}
+        contents = {}
+        for filename, patterns in ignore_patterns.items():
+            if tuple(patterns) not in rendered:
+                rendered[tuple(patterns)] = ("# This file was automatically generated by obsidian-setup tool.\n\n" + "\n".join(patterns) + "\n").encode("utf-8")
+            contents[filename] = rendered[tuple(patterns)]
+        return contents
+
+    def create_ignore_files(self):
+        """Create ignore files for various AI coding agents"""
+        ignore_patterns = self.get_ignore_patterns()
+
+        if not any(ignore_patterns.values()):
+            self.log("⚠️ No sensitive patterns found in config.json paths.sensitive")
+            return True
+
+        for filename in sorted(set(self.config.get("ignore_files") or {}) - set(self.IGNORE_FILES)):
+            self.log(f"⚠️ Unknown ignore file in config.json ignore_files: {filename}")
 
-    def load_config(self):
-        """Load configuration from config.json"""
-        if not self.config_path.exists():
-            print(f"❌ Configuration file not found: {self.config_path}")
-            print("Please ensure config.json exists in the vault root directory.")
-            sys.exit(1)
+        # Define ignore files to create
+        ignore_files = self.IGNORE_FILES
+
+        self.log("📝 Creating AI agent ignore files...")
+
+        rendered = self.render_ignore_files(ignore_patterns)
+
+        success_count = 0
+        unchanged_count = 0
+        total_count = len(ignore_files)
+
+        # Create each ignore file
+        for filename, description in ignore_files.items():
+            ignore_file_path = self.vault_path / filename
+
+            with self.operation("ignore-files", filename) as event:
+                if self._write_ignore_file(event, ignore_file_path, filename, description, rendered[filename]):
+                    success_count += 1
+                unchanged_count += event["outcome"] == "unchanged"
+
+        # Make the renames durable with one directory fsync for the whole batch (a transaction does this on commit)
+        if success_count > unchanged_count and self.transaction is None:
+            fsync_directory(self.vault_path)
 
+        self.log(f"✅ AI ignore files: {success_count}/{total_count} files processed successfully ({unchanged_count} unchanged)")
+        return success_count == total_count
+
+    def _write_ignore_file(self, event, ignore_file_path, filename, description, content):
+        """Write one ignore file unless it already has this content, honouring the overwrite and backup settings"""
         try:
-            with open(self.config_path, "r", encoding="utf-8") as f:
-                return json.load(f)
-        except Exception as e:
-            print(f"❌ Error loading configuration: {e}")
-            sys.exit(1)
+            # Check if file already exists
+            file_existed = self.snapshot.exists(ignore_file_path)
+            target_stat = self.snapshot.stat(ignore_file_path) if file_existed else None
 
-    def check_plugin_installed(self, plugin_name):
-        """Check if a plugin is installed"""
-        plugin_path = self.plugins_path / plugin_name
-        manifest_path = plugin_path / "manifest.json"
-        return plugin_path.exists() and manifest_path.exists()
+            if file_existed and not self.overwrite_existing_files:
+                self.log(f"⚠️ Skipped (already exists): {filename}")
+                event["outcome"] = "skipped"
+                return True
 
-    def check_required_plugins(self):
-        """Check if all required plugins are installed"""
-        required_plugins = self.config.get("required_plugins", [])
+            # Identical content: no backup and no write, so file watchers and sync clients stay quiet
+            if file_existed and target_stat.st_size == len(content) and ignore_file_path.read_bytes() == content:
+                event["outcome"] = "unchanged"
+                return True
 
-        missing_plugins = []
-        for plugin in required_plugins:
-            if not self.check_plugin_installed(plugin):
-                missing_plugins.append(plugin)
+            # Create backup if file exists and backup is enabled
+            if file_existed and self.backup_existing_config:
+                self.create_backup(ignore_file_path, filename)
 
-        if missing_plugins:
-            print("❌ The following required plugins are not installed:")
-            for plugin in missing_plugins:
-                print(f"   - {plugin}")
-            print("\nInstallation instructions:")
-            print("1. Open Obsidian and go to Settings > Community plugins")
-            print("2. Click the 'Browse' button")
-            print("3. Search for and install the plugins listed above")
-            print("4. Enable the plugins after installation")
-            print("5. Run this script again after installation is complete")
+            # Write ignore file through a temp file and rename, so agents never read a partial file
+            self.write_file(ignore_file_path, content, (target_stat.st_mode & 0o7777) if target_stat else None, fsync=True)
+            event["bytes"] = len(content)
+
+            action = "Updated" if file_existed else "Created"
+            event["outcome"] = action.lower()
+            self.log(f"✅ {action}: {filename} ({description})")
+            return True
+
+        except Exception as e:
+            event["outcome"] = "failed"
+            self.log(f"❌ Failed to create {filename}: {e}")
             return False
 
-        print("✅ All required plugins are installed.")
-        return True
+    def check_ignore(self, paths):
+        """Report whether vault-relative paths are ignored by the AI agent ignore patterns"""
+        self.config = self.load_config()
 
-    def get_command_templates(self):
-        """Find template files specifically in the Commands folder for hotkey registration"""
-        commands_folder = self.config["paths"]["commands_folder"]
-        commands_path = self.vault_path / commands_folder
+        # Agents with the same patterns share one matcher and one answer
+        groups = {}
+        for filename, patterns in self.get_ignore_patterns().items():
+            groups.setdefault(tuple(patterns), []).append(filename)
+        matchers = [(IgnoreMatcher(patterns), filenames) for patterns, filenames in groups.items()]
 
-        if not commands_path.exists():
-            print(f"⚠️ Commands folder not found: {commands_path}")
-            return []
+        ignored_count = 0
+        for path in paths:
+            relative = path.replace(os.sep, "/")
+            is_dir = relative.endswith("/") or self.snapshot.is_dir(self.vault_path / relative)
+            agents = {}
+            for matcher, filenames in matchers:
+                rule = matcher.match(relative, is_dir)
+                ignored = rule is not None and not rule["negated"]
+                agents.update((filename, ignored) for filename in filenames)
+                suffix = f"  [{', '.join(filenames)}]" if len(matchers) > 1 else ""
+                message = f"🚫 {path}  (ignored by: {rule['pattern']})" if ignored else f"👁️ {path}  (not ignored" + (f", re-included by: {rule['pattern']})" if rule else ")")
+                self.emit({"event": "check-ignore", "path": path, "agents": filenames, "ignored": ignored, "pattern": rule["pattern"] if rule else None, "message": message + suffix})
+            ignored_count += all(agents.values())
+        # Like git check-ignore: succeed when at least one path is ignored (by every agent)
+        return ignored_count > 0
 
-        command_files = []
-        for file_path in commands_path.glob("*.md"):
-            relative_path = file_path.relative_to(self.vault_path)
-            command_files.append(str(relative_path))
+    def audit_sensitive(self, output_path=None):
+        """Walk the vault once and report which files each agent ignore file hides or exposes"""
+        started = time.perf_counter()
 
-        return sorted(command_files)
+        # Read the ignore files actually present in the vault; agents sharing the same patterns share a matcher
+        matchers = {}
+        agents = {}
+        for filename in self.IGNORE_FILES:
+            ignore_file_path = self.vault_path / filename
+            try:
+                patterns = tuple(ignore_file_path.read_text(encoding="utf-8").splitlines())
+            except FileNotFoundError:
+                patterns = None
+            agents[filename] = patterns
+            if patterns is not None and patterns not in matchers:
+                matchers[patterns] = IgnoreMatcher(patterns)
+        sensitive_matcher = IgnoreMatcher(self.SENSITIVE_FILE_PATTERNS)
+
+        files = []
+        pending = [""]
+        while pending:
+            directory = pending.pop()
+            for name, entry in self.snapshot.listdir(self.vault_path / directory).items():
+                relative = f"{directory}/{name}" if directory else name
+                if entry.is_dir():
+                    if name != ".git":
+                        pending.append(relative)
+                else:
+                    files.append(relative)
+        files.sort()
+
+        ignored_by = {patterns: matcher.filter_ignored(files) for patterns, matcher in matchers.items()}
+        sensitive = sensitive_matcher.filter_ignored(files)
+
+        report = {"vault": str(self.vault_path), "files": len(files), "agents": {}, "exposed_sensitive_files": {}}
+        self.log(f"🔎 Sensitive file audit of {self.vault_path} ({len(files)} files):")
+        for filename, description in self.IGNORE_FILES.items():
+            patterns = agents[filename]
+            if patterns is None:
+                self.log(f"   ⚠️ {filename:<22} missing: {description.lower()} sees all {len(files)} files")
+                ignored = []
+            else:
+                ignored = ignored_by[patterns]
+                self.log(f"   🛡️ {filename:<22} {len(files) - len(ignored)} visible, {len(ignored)} ignored")
+            ignored_set = set(ignored)
+            report["agents"][filename] = {"present": patterns is not None, "ignored": ignored}
+            if output_path:
+                report["agents"][filename]["visible"] = [path for path in files if path not in ignored_set]
+            for path in sensitive:
+                if path not in ignored_set:
+                    report["exposed_sensitive_files"].setdefault(path, []).append(filename)
+
+        exposed = report["exposed_sensitive_files"]
+        if exposed:
+            self.log(f"⚠️ {len(exposed)} possibly sensitive file(s) visible to AI agents:")
+            for path, filenames in exposed.items():
+                self.log(f"   - {path}  (not ignored by {', '.join(filenames)})")
+            self.log("Add them to paths.sensitive in config.json and run setup with --ignore-files.")
+        else:
+            self.log("✅ No possibly sensitive files are visible to AI agents.")
+
+        if output_path:
+            try:
+                with open(output_path, "w", encoding="utf-8") as f:
+                    json.dump(report, f, indent=2, ensure_ascii=False)
+                self.log(f"💾 Full per-agent file lists saved to: {output_path}")
+            except OSError as e:
+                self.log(f"❌ Failed to write audit report: {e}")
+                return False
+
+        self.log(f"⏱️ Audit took {time.perf_counter() - started:.3f}s")
+        return not exposed
+
+    def _expected_hash(self, source, target, templating):
+        """Return the hash a deployed file should have, reusing the manifest's source hash when possible"""
+        if templating:
+            rendered = self.renderer.render(source)
+            try:
+                return rendered.rendered_hash
+            finally:
+                rendered.close()
+        source_stat = self.snapshot.stat(source)
+        entry = self.manifest.get(self._manifest_key(target))
+        if entry and DeployManifest.stat_matches(entry, source_stat, "source_"):
+            return entry["source_hash"]
+        return self._hash_source(source, source_stat)
+
+    def get_audit_subtrees(self):
+        """Return {name: (target directory, {relative path: source path}, templating)} for every deployed folder"""
+        subtrees = {}
+        for name, source_directory, target_directory, templating in (
+            ("Templater", self.source_path / "Templater", self.vault_path / "Templater", False),
+            ("snippets", self.source_path / "CssSnippets", self.obsidian_path / "snippets", False),
+            (".gemini", self.source_path / ".gemini", self.vault_path / ".gemini", True),
+        ):
+            if self.snapshot.is_dir(source_directory):
+                subtrees[name] = (target_directory, {source.relative_to(source_directory).as_posix(): source for source in self.snapshot.walk_files(source_directory)}, templating)
+        return subtrees
+
+    def audit_drift(self):
+        """Compare what setup would deploy with what the vault holds, without writing to deployed files
+
+        Each deployed folder, the single deployed files, the ignore files and the managed Templater
+        settings are compared as Merkle trees; only subtrees whose root hashes differ are descended.
+        """
+        started = time.perf_counter()
+        index = MerkleIndex(self.vault_path, state_path(self.vault_path, self.AUDIT_CACHE_FILENAME))
+        self.manifest.load()
+
+        config_error = None
+        if not self.config_path.exists():
+            config_error = f"config.json not found in {self.vault_path}"
+        else:
+            self.settings.refresh()
+            if self.settings.errors:
+                config_error = "; ".join(self.settings.errors)
+            else:
+                self.config = self.settings.data
+
+        report = {"vault": str(self.vault_path), "source": str(self.source_path), "drifted": False, "subtrees": {}}
+
+        def compare(name, prefix, expected, actual, error=None):
+            expected_root, actual_root = merkle_tree(expected)[""], merkle_tree(actual)[""]
+            differences = [{"path": f"{prefix}{path}", "status": status} for path, status in merkle_diff(expected, actual)] if not error else []
+            if error:
+                status = "error"
+            elif not differences:
+                status = "clean"
+            elif all(difference["status"] == "extra" for difference in differences):
+                status = "extra"
+            else:
+                status = "drifted"
+            report["subtrees"][name] = {"status": status, "expected_root": expected_root, "actual_root": actual_root, "differences": differences}
+            if error:
+                report["subtrees"][name]["error"] = error
+            report["drifted"] = report["drifted"] or status in ("drifted", "error")
+
+        # Deployed folders: expected hashes come from the source (rendered for templated files)
+        for name, (target_directory, sources, templating) in self.get_audit_subtrees().items():
+            expected = {}
+            error = None
+            try:
+                for relative, source in sources.items():
+                    expected[relative] = self._expected_hash(source, target_directory / relative, templating)
+            except Exception as e:
+                error = str(e)
+            prefix = target_directory.relative_to(self.vault_path).as_posix() + "/"
+            compare(name, prefix, expected, index.scan(target_directory), error)
+
+        # Single deployed files
+        expected = {}
+        actual = {}
+        error = None
+        for target_name, source_name, templating in (("config.json", "config.json", True), ("gemini.sh", "gemini.sh", False), ("AGENTS.md", "AGENTS.md.example", False)):
+            source = self.source_path / source_name
+            if not self.snapshot.is_file(source):
+                continue
+            try:
+                expected[target_name] = self._expected_hash(source, self.vault_path / target_name, templating)
+            except Exception as e:
+                error = str(e)
+            actual_hash = index.file_hash(self.vault_path / target_name)
+            if actual_hash:
+                actual[target_name] = actual_hash
+        compare("agent-files", "", expected, actual, error)
+
+        # Generated files and settings depend on the vault's config.json
+        if config_error:
+            report["subtrees"]["ignore-files"] = report["subtrees"]["templater-data"] = {"status": "skipped", "error": config_error, "differences": []}
+        else:
+            expected = {filename: hash_bytes(content) for filename, content in self.render_ignore_files().items()}
+            actual = {}
+            for filename in expected:
+                actual_hash = index.file_hash(self.vault_path / filename)
+                if actual_hash:
+                    actual[filename] = actual_hash
+            compare("ignore-files", "", expected, actual)
+
+            error = None
+            existing_config = {}
+            try:
+                with open(self.templater_data_path, "r", encoding="utf-8") as f:
+                    existing_config = json.load(f)
+            except FileNotFoundError:
+                pass
+            except Exception as e:
+                error = f"unreadable data.json: {e}"
+            managed = self.build_templater_config(existing_config) if isinstance(existing_config, dict) else {}
+            expected = {key: hash_bytes(json.dumps(value, sort_keys=True).encode("utf-8")) for key, value in managed.items()}
+            actual = {key: hash_bytes(json.dumps(existing_config[key], sort_keys=True).encode("utf-8")) for key in managed if key in existing_config}
+            compare("templater-data", "data.json:", expected, actual, error)
+
+        index.save()
+        report["files_read"] = index.files_read
+        report["directories_listed"] = index.directories_listed
+        report["duration"] = round(time.perf_counter() - started, 6)
+
+        icons = {"clean": "✅", "extra": "➕", "drifted": "❌", "error": "❌", "skipped": "⏭️"}
+        self.log(f"🔍 Drift audit of {self.vault_path}:")
+        for name, subtree in report["subtrees"].items():
+            root = f" ({subtree['actual_root'][:12]})" if subtree.get("actual_root") else ""
+            detail = subtree.get("error") or (f"{len(subtree['differences'])} difference(s)" if subtree["differences"] else "")
+            self.log(f"   {icons[subtree['status']]} {name:<15} {subtree['status']}{root}" + (f": {detail}" if detail else ""))
+            for difference in subtree["differences"]:
+                self.emit({"event": "drift", "vault": str(self.vault_path), "subtree": name, **difference, "message": f"      {difference['status']:<8} {difference['path']}"})
+        self.log(f"⏱️ Audit took {report['duration']:.3f}s ({report['files_read']} file(s) read, {report['directories_listed']} folder(s) listed)")
+        return report
+
+    def get_note_directories(self):
+        """Return the configured note and clipping folders that exist, without folders nested in another one"""
+        directories = []
+        for directory, _ in self.expand_directories(self.config["paths"].get("note_directories", []) + self.config["paths"].get("clipping_directories", [])):
+            if not self.snapshot.is_dir(self.vault_path / directory):
+                self.log(f"⚠️ Note folder not found: {directory}")
+                continue
+            directories.append(Path(directory).as_posix().strip("/"))
+        # Sorted by path segments, a folder's subfolders directly follow it
+        directories.sort(key=lambda directory: directory.split("/"))
+        outermost = []
+        for directory in directories:
+            if not outermost or not directory.startswith(outermost[-1] + "/"):
+                outermost.append(directory)
+        return outermost
+
+    def iter_note_files(self, directories):
+        """Yield the vault-relative path of every .md note under directories in sorted order, one listing at a time"""
+        for directory in directories:
+            pending = [directory]
+            while pending:
+                relative_directory = pending.pop()
+                try:
+                    with os.scandir(self.vault_path / relative_directory) as entries:
+                        listing = sorted((entry.name, entry.is_dir(follow_symlinks=False)) for entry in entries if not entry.name.startswith("."))
+                except OSError as e:
+                    self.log(f"⚠️ Cannot list {relative_directory}: {e}")
+                    continue
+                subdirectories = []
+                for name, is_dir in listing:
+                    if is_dir:
+                        subdirectories.append(f"{relative_directory}/{name}")
+                    elif name.endswith(".md"):
+                        yield f"{relative_directory}/{name}"
+                pending.extend(reversed(subdirectories))
 
-    def _load_source_config(self):
-        """Load configuration from source config.json file"""
+    def normalize_notes(self, dry_run=False, sync_titles=False, workers=None):
+        """Apply the parseFile.js H1 rules to every note in the note and clipping folders, writing only changed notes
+
+        Notes are streamed from the folder walk to a process pool in batches with a bounded number of
+        batches in flight, so memory does not grow with the size of the vault.
+        """
+        started = time.perf_counter()
+        self.config = self.load_config()
+        directories = self.get_note_directories()
+        if not directories:
+            self.log("⚠️ No note folders to normalize (paths.note_directories, paths.clipping_directories)")
+            return True
+
+        workers = max(1, workers or os.cpu_count() or 1)
+        self.log(f"🧹 {'Checking' if dry_run else 'Normalizing'} notes in {', '.join(directories)} ({workers} worker(s))...")
+
+        counts = {"unchanged": 0, "changed": 0, "failed": 0}
+        paths = self.iter_note_files(directories)
+        tasks = ((str(self.vault_path), batch, sync_titles, dry_run) for batch in iter(lambda: list(itertools.islice(paths, NORMALIZE_BATCH_SIZE)), []))
+
+        def report(results):
+            for result in results:
+                counts[result["outcome"]] += 1
+                self.emit({"event": "operation", "phase": "normalize", "path": result["path"], "bytes": result["bytes"], "outcome": result["outcome"], "duration": result["duration"], "time": time.time()})
+                if result["outcome"] == "failed":
+                    self.log(f"❌ Failed: {result['path']} ({result['error']})")
+                elif result["outcome"] == "changed":
+                    if dry_run:
+                        self.log(result["diff"].rstrip("\n"))
+                    else:
+                        self.log(f"✅ Normalized: {result['path']} ({result['reason']})")
+
+        if workers == 1:
+            for task in tasks:
+                report(_normalize_note_batch(task))
+        else:
+            # Results are reported in walk order; at most workers * NORMALIZE_QUEUE_DEPTH batches are pending
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                pending = deque()
+                for task in tasks:
+                    pending.append(executor.submit(_normalize_note_batch, task))
+                    if len(pending) >= workers * NORMALIZE_QUEUE_DEPTH:
+                        report(pending.popleft().result())
+                while pending:
+                    report(pending.popleft().result())
+
+        total = sum(counts.values())
+        verb = "would change" if dry_run else "changed"
+        self.log(f"📊 Normalize summary: {total} notes, {counts['changed']} {verb}, {counts['unchanged']} unchanged, {counts['failed']} failed")
+        self.log(f"⏱️ Normalize took {time.perf_counter() - started:.3f}s")
+        return counts["failed"] == 0
+
+    def iter_vault_files(self, extensions):
+        """Yield (vault-relative path, stat) for every file with one of extensions outside dot folders"""
+        pending = [""]
+        while pending:
+            relative_directory = pending.pop()
+            try:
+                with os.scandir(self.vault_path / relative_directory) as entries:
+                    for entry in entries:
+                        if entry.name.startswith("."):
+                            continue
+                        relative = f"{relative_directory}/{entry.name}" if relative_directory else entry.name
+                        if entry.is_dir(follow_symlinks=False):
+                            pending.append(relative)
+                        elif os.path.splitext(entry.name)[1].lower() in extensions and entry.is_file(follow_symlinks=False):
+                            yield relative, entry.stat(follow_symlinks=False)
+            except OSError as e:
+                self.log(f"⚠️ Cannot list {relative_directory or self.vault_path}: {e}")
+
+    def update_index(self):
+        """Open the vault index and bring it up to date with the note folders, returning the VaultIndex"""
+        started = time.perf_counter()
+        self.config = self.load_config()
+        index = VaultIndex(state_path(self.vault_path, VaultIndex.FILENAME))
         try:
-            with open(self.source_config_path, "r", encoding="utf-8") as f:
-                return json.load(f)
-        except Exception:
-            return {}
+            stats = index.update(self.vault_path, self.iter_note_files(self.get_note_directories()), ((path, stat_result.st_size) for path, stat_result in self.iter_vault_files(IMAGE_EXTENSIONS)))
+        except BaseException:
+            index.close()
+            raise
+        duration = time.perf_counter() - started
+        message = f"🗂️ Indexed {stats['notes']} notes in {duration:.3f}s ({stats['parsed']} parsed, {stats['removed']} removed, {stats['failed']} failed)"
+        self.emit({"event": "index", "vault": str(self.vault_path), **stats, "duration": duration, "message": message})
+        return index
 
-    def _get_config_value(self, path, default=None):
-        """Get configuration value, trying loaded config first, then source config"""
-        keys = path.split(".")
+    def query_index(self, query, update=True):
+        """Answer a query against the vault index: tags, tag:NAME, links:NAME, key:NAME, search:TEXT or orphans
 
-        # Try loaded config first
-        if self.config:
-            value = self.config
-            for key in keys:
-                if isinstance(value, dict) and key in value:
-                    value = value[key]
+        With update=False the index is queried as it is, e.g. right after a locked update_index().
+        """
+        kind, _, argument = query.partition(":")
+        if kind not in ("tags", "tag", "links", "key", "search", "orphans"):
+            self.log(f"❌ Unknown query: {query} (use tags, tag:NAME, links:NAME, key:NAME, search:TEXT or orphans)")
+            return False
+        with self.update_index() if update else VaultIndex(state_path(self.vault_path, VaultIndex.FILENAME)) as index:
+            try:
+                if kind == "tags":
+                    rows = [f"{tag}\t{count}" for tag, count in index.tags()]
+                elif kind == "tag":
+                    rows = index.notes_with_tag(argument)
+                elif kind == "links":
+                    rows = [f"{path}\t{'embed' if embed else 'link'}" for path, embed in index.backlinks(argument)]
+                elif kind == "key":
+                    rows = [f"{path}\t{value}" for path, value in index.notes_with_property(argument)]
+                elif kind == "search":
+                    rows = [f"{path}\t{' '.join(snippet.split())}" if snippet else path for path, snippet in index.search(argument)]
                 else:
-                    value = None
-                    break
-            if value is not None:
-                return value
-
-        # Fallback to source config
-        source_config = self._load_source_config()
-        value = source_config
-        for key in keys:
-            if isinstance(value, dict) and key in value:
-                value = value[key]
+                    rows = index.orphaned_attachments()
+            except sqlite3.OperationalError as e:
+                self.log(f"❌ Invalid query {query!r}: {e}")
+                return False
+        for row in rows:
+            self.emit({"event": "result", "query": query, "value": row, "message": row})
+        self.log(f"📊 {len(rows)} result(s)")
+        return True
+
+    def collect_vault_tags(self):
+        """Return the sorted tags used by the notes in the note folders, like metadataCache.getTags(), from the vault index"""
+        with self.update_index() as index:
+            return sorted(tag for tag, _ in index.tags())
+
+    def index_attachments(self):
+        """Map each file name in the vault (outside dot folders) to its vault-relative paths, for resolving image links"""
+        index = {}
+        for root, dirs, files in os.walk(self.vault_path):
+            dirs[:] = sorted(d for d in dirs if not d.startswith("."))
+            relative_root = Path(root).relative_to(self.vault_path)
+            for name in files:
+                index.setdefault(name, []).append((relative_root / name).as_posix())
+        return index
+
+    def resolve_link(self, link, note_path, attachments):
+        """Resolve a wikilink target to a vault-relative path like getFirstLinkpathDest: an exact path, else the closest file of that name"""
+        if (self.vault_path / link).is_file():
+            return Path(link).as_posix()
+        candidates = attachments.get(Path(link).name, [])
+        note_folder = Path(note_path).parent.as_posix()
+        for candidate in candidates:
+            if Path(candidate).parent.as_posix() == note_folder:
+                return candidate
+        return candidates[0] if candidates else None
+
+    def rewrite_links(self, text, note_path, attachments, targets, names):
+        """Point the wikilinks and Markdown links of a note that resolve to a key of targets at its value
+
+        Links keep their style: a bare file name becomes names[new path], a path becomes the new vault
+        path (or, for a Markdown link relative to the note, the new relative path). Returns the new text
+        and the old target of every rewritten link.
+        """
+        note_folder = posixpath.dirname(note_path)
+        rewritten = []
+
+        def relink(match):
+            link = match.group(2).strip()
+            target = self.resolve_link(link, note_path, attachments) if link else None
+            if target not in targets:
+                return match.group(0)
+            rewritten.append(target)
+            return match.group(1) + (targets[target] if "/" in link else names[targets[target]]) + match.group(3)
+
+        def relink_markdown(match):
+            link = markdown_link_target(match.group(2))
+            if not link:
+                return match.group(0)
+            # Markdown links may be relative to the note, a vault path or a bare file name
+            note_relative = posixpath.normpath(posixpath.join(note_folder, link))
+            if not note_relative.startswith("../") and (self.vault_path / note_relative).is_file():
+                target = note_relative
             else:
-                return default
-        return value
+                target = self.resolve_link(link, note_path, attachments)
+            if target not in targets:
+                return match.group(0)
+            rewritten.append(target)
+            if "/" not in link:
+                new_link = names[targets[target]]
+            elif target == note_relative:
+                new_link = posixpath.relpath(targets[target], note_folder or ".")
+            else:
+                new_link = targets[target]
+            raw = match.group(2)
+            bracketed = raw.startswith("<") and raw.endswith(">")
+            fragment = raw[raw.index("#") : len(raw) - bracketed] if "#" in raw else ""
+            new_target = f"<{new_link}{fragment}>" if bracketed else urllib.parse.quote(new_link, safe="/") + fragment
+            return match.group(0)[: match.start(2) - match.start()] + new_target + match.group(0)[match.end(2) - match.start() :]
 
-    def copy_file(self, source_path, target_path, backup_relative_path=None, templating=False, relative_path=None):
-        """Copy a file from source to target with automatic backup, overwrite handling, and logging"""
-        source = Path(str(source_path))
-        target = Path(str(target_path))
-        display_path = relative_path if relative_path else target.name
+        return MARKDOWN_LINK_PATTERN.sub(relink_markdown, ATTACHMENT_LINK_PATTERN.sub(relink, text)), rewritten
 
-        if not source.exists():
-            print(f"❌ Source file not found: {source}")
-            return False
+    async def _run_ai_note(self, runner, relative, jobs, tags, attachments, renames, pending_renames):
+        """Run the selected jobs for one note, returning its result with the frontmatter values to set"""
+        path = self.vault_path / relative
+        before = path.stat()
+        frontmatter, title, content = parse_note(path.read_text(encoding="utf-8"))
+        result = {"path": relative, "values": {}, "links": [], "stat": (before.st_mtime_ns, before.st_size)}
 
-        # Check if target exists and handle overwrite logic
-        file_existed = target.exists()
+        if "summarize" in jobs and content:
+            result["values"]["summary"] = (await runner.generate("gemini", SUMMARIZE_PROMPT.format(text=content))).strip()
 
-        if file_existed and not self.overwrite_existing_files:
-            print(f"⚠️ Skipped (already exists): {display_path}")
-            return True  # Return True as this is expected behavior, not an error
+        if "tags" in jobs and tags and (title or content):
+            response_format = {"type": "array", "description": "The suggested tags.", "items": {"type": "string", "enum": tags}}
+            prompt = SUGGEST_TAGS_PROMPT.format(tags=",".join(tags), content=assemble_note("", title, content))
+            existing = get_frontmatter_list(frontmatter, "tags")
+            merged = [tag for tag in dict.fromkeys(existing + list(await runner.generate("gemini", prompt, response_format))) if tag]
+            if merged != existing:
+                result["values"]["tags"] = merged
 
-        try:
-            # Create parent directories if they don't exist
-            target.parent.mkdir(parents=True, exist_ok=True)
+        if "rename-images" in jobs:
+            for link in dict.fromkeys(IMAGE_LINK_PATTERN.findall(content)):
+                if not PASTED_IMAGE_PATTERN.search(link):
+                    continue
+                image = self.resolve_link(link, relative, attachments)
+                if image is None:
+                    continue
+                # Notes embedding the same image share one request
+                if image not in pending_renames:
+                    pending_renames[image] = asyncio.ensure_future(self._name_image(runner, image))
+                name = await pending_renames[image]
+                if name:
+                    renames.setdefault(image, image.replace("Pasted image ", name + "_", 1))
+                    result["links"].append(image)
 
-            # Create backup if backup path is provided, backup is enabled, and file exists
-            if backup_relative_path and file_existed:
-                self.create_backup(target, backup_relative_path)
+        # Drop values the frontmatter already has, so re-runs served from the cache rewrite nothing
+        result["values"] = {key: value for key, value in result["values"].items() if set_frontmatter_values(frontmatter, {key: value}) != frontmatter}
+        return result
 
-            with open(source, "r", encoding="utf-8") as f:
-                text = f.read()
+    async def _name_image(self, runner, image):
+        """Ask Ollama for a file name for an image, sanitized like renameImages.js; None if it gave no usable name"""
+        data = await asyncio.get_running_loop().run_in_executor(runner.executor, (self.vault_path / image).read_bytes)
+        response_format = {"type": "string", "description": "The filename for the image."}
+        name = await runner.generate("ollama", RENAME_IMAGE_PROMPT, response_format, [base64.b64encode(data).decode("ascii")], [hash_bytes(data)])
+        name = re.sub(r"\s+", "_", re.sub(r"[\"*?!,'`]", "", str(name or "").strip())).lower()
+        return name.strip("./\\") or None
 
-            # Apply template substitution only if templating is enabled
-            if templating:
-                text = string.Template(text).substitute(os.environ)
+    async def _run_ai_batch(self, runner, directories, jobs, tags, attachments):
+        """Stream notes from the folder walk through a bounded queue to as many workers as the concurrency limit"""
+        queue = asyncio.Queue(maxsize=runner.concurrency * 2)
+        results, renames, pending_renames = [], {}, {}
 
-            with open(target, "w", encoding="utf-8") as f:
-                f.write(text)
+        async def worker():
+            while (relative := await queue.get()) is not None:
+                started = time.perf_counter()
+                try:
+                    result = await self._run_ai_note(runner, relative, jobs, tags, attachments, renames, pending_renames)
+                    result["outcome"] = "changed" if result["values"] or result["links"] else "unchanged"
+                except Exception as e:
+                    result = {"path": relative, "outcome": "failed", "error": str(e)}
+                    self.log(f"❌ Failed: {relative} ({e})")
+                result["duration"] = time.perf_counter() - started
+                results.append(result)
 
-            # Log success based on whether file existed before
-            action = "Updated" if file_existed else "Copied"
-            print(f"✅ {action}: {display_path}")
+        workers = [asyncio.ensure_future(worker()) for _ in range(runner.concurrency)]
+        for relative in self.iter_note_files(directories):
+            await queue.put(relative)
+        for _ in workers:
+            await queue.put(None)
+        await asyncio.gather(*workers)
+        results.sort(key=lambda result: result["path"])
+        return results, renames
+
+    def run_ai_jobs(self, jobs, dry_run=False):
+        """Run summarize, tags and rename-images over every note in the note and clipping folders
+
+        Requests go out concurrently under the ai.batch limits and are cached in the vault by content
+        hash, model and prompt, so unchanged notes cost nothing on the next run. Results are written
+        back together at the end: image renames first, then every note edit, including the links to
+        renamed images anywhere in the vault, in one transaction.
+        """
+        started = time.perf_counter()
+        if not self.recover_transaction():
+            return False
+        self.config = self.load_config()
+        settings = {**AI_DEFAULTS, **self.config.get("ai", {})}
+        batch = {**AI_BATCH_DEFAULTS, **settings.pop("batch", {})}
+        if {"summarize", "tags"} & set(jobs) and not settings.get("gemini_api_key"):
+            self.log("❌ ai.gemini_api_key is required for the summarize and tags jobs")
+            return False
+        directories = self.get_note_directories()
+        if not directories:
+            self.log("⚠️ No note folders to process (paths.note_directories, paths.clipping_directories)")
             return True
 
-        except Exception as e:
-            print(f"❌ Failed to copy: {display_path} ({e})")
+        tags = self.collect_vault_tags() if "tags" in jobs else []
+        attachments = self.index_attachments() if "rename-images" in jobs else {}
+        self.log(f"🤖 Running {', '.join(jobs)} on notes in {', '.join(directories)} (concurrency {batch['concurrency']}, {batch['requests_per_second']} request(s)/s)...")
+
+        cache = AIResponseCache(state_path(self.vault_path, AI_CACHE_DIRNAME))
+        runner = AIBatchRunner(AIClient(settings), cache, **batch)
+        try:
+            results, renames = asyncio.run(self._run_ai_batch(runner, directories, jobs, tags, attachments))
+        finally:
+            runner.close()
+
+        for result in results:
+            self.emit({"event": "operation", "phase": "ai", "path": result["path"], "bytes": 0, "outcome": result["outcome"], "duration": result["duration"], "time": time.time()})
+            for key, value in result.get("values", {}).items():
+                self.log(f"{'🔍' if dry_run else '✅'} {result['path']}: {key} = {json.dumps(value, ensure_ascii=False)[:120]}")
+        for old, new in renames.items():
+            self.log(f"{'🔍' if dry_run else '🖼️'} Rename {old} -> {new}")
+
+        changed = [result for result in results if result["outcome"] == "changed"]
+        failed = sum(result["outcome"] == "failed" for result in results)
+        if not dry_run and changed:
+            failed += self.write_ai_results(changed, renames)
+
+        verb = "would change" if dry_run else "changed"
+        self.log(f"📊 AI summary: {len(results)} notes, {len(changed)} {verb}, {failed} failed, {len(renames)} image rename(s)")
+        self.log(f"🌐 Requests: {runner.stats['requests']} sent, {runner.stats['retries']} retried, {runner.stats['failed']} failed, {cache.hits} cache hit(s), {cache.misses} miss(es)")
+        self.log(f"⏱️ AI jobs took {time.perf_counter() - started:.3f}s")
+        return failed == 0
+
+    def write_ai_results(self, changed, renames):
+        """Rename images, then rewrite the changed notes and every note linking to a renamed image in one transaction
+
+        Like renameImages.js, which renames through Obsidian, links to a renamed image are updated in
+        every note of the vault. An image is not renamed if a note linking to it cannot be rewritten.
+        Returns the number of failed notes.
+        """
+        attachments = self.index_attachments()
+        pending = {}
+        for old, new in renames.items():
+            if (self.vault_path / new).exists():
+                self.log(f"⚠️ Not renaming {old}: {new} already exists")
+            else:
+                pending[old] = new
+        names = {}
+        for new in pending.values():
+            name = new.rsplit("/", 1)[-1]
+            names[new] = new if attachments.get(name) else name
+
+        # Read every note that may change, and hold back the images linked from notes that cannot be rewritten
+        results = {result["path"]: result for result in changed}
+        notes = []
+        blocked = set()
+        failed = 0
+        for relative, stat_result in self.iter_vault_files({".md"}):
+            result = results.pop(relative, None)
+            if result is None and not pending:
+                continue
+            try:
+                text = (self.vault_path / relative).read_text(encoding="utf-8")
+                linked = self.rewrite_links(text, relative, attachments, pending, names)[1]
+                # Never overwrite an edit made (e.g. in Obsidian) since the note was read
+                if result is not None and (stat_result.st_mtime_ns, stat_result.st_size) != result["stat"]:
+                    blocked.update(linked)
+                    raise OSError("modified while the AI jobs ran")
+            except (OSError, UnicodeDecodeError) as e:
+                if result is None:
+                    self.log(f"⚠️ Cannot check {relative} for links to renamed images ({e})")
+                    continue
+                failed += 1
+                blocked.update(result["links"])
+                self.log(f"❌ Failed: {relative} ({e})")
+                continue
+            if linked or result is not None:
+                notes.append((relative, stat_result, text, result))
+        for relative, result in results.items():
+            failed += 1
+            blocked.update(result["links"])
+            self.log(f"❌ Failed: {relative} (no longer in the vault)")
+
+        renamed = {}
+        for old, new in pending.items():
+            if old in blocked:
+                self.log(f"⚠️ Not renaming {old}: a note linking to it could not be rewritten")
+            else:
+                renamed[old] = new
+
+        writes = []
+        for relative, stat_result, text, result in notes:
+            new_text = self.rewrite_links(text, relative, attachments, renamed, names)[0]
+            if result is not None and result["values"]:
+                frontmatter = parse_note(new_text)[0]
+                block = set_frontmatter_values(frontmatter, result["values"])
+                new_text = block + new_text[len(frontmatter) :] if frontmatter else block + "\n" + new_text
+            if new_text != text:
+                writes.append((relative, stat_result, new_text))
+
+        done = {}
+        self.transaction = VaultTransaction(self.vault_path, self.snapshot)
+        try:
+            for old, new in renamed.items():
+                os.rename(self.vault_path / old, self.vault_path / new)
+                done[old] = new
+            for relative, stat_result, text in writes:
+                path = self.vault_path / relative
+                current = path.stat()
+                if (current.st_mtime_ns, current.st_size) != (stat_result.st_mtime_ns, stat_result.st_size):
+                    raise OSError(f"{relative} was modified while the results were written")
+                self.write_file(path, text.encode("utf-8"), stat.S_IMODE(stat_result.st_mode))
+            if not self.commit_transaction():
+                failed += len(writes)
+        except OSError as e:
+            failed += len(writes)
+            self.log(f"❌ Nothing was written: {e}")
+        finally:
+            transaction, self.transaction = self.transaction, None
+            if transaction.state != "committed":
+                transaction.rollback()
+                # Put the images back so the untouched notes still resolve their links
+                for old, new in done.items():
+                    os.rename(self.vault_path / new, self.vault_path / old)
+        return failed
+
+    def dedup_attachments(self, mode="report", dry_run=False):
+        """Find identical attachments across the vault and, unless mode is "report", point every link at one copy
+
+        mode "relink" only rewrites links, "hardlink" also turns each duplicate into a hard link to the
+        canonical copy, and "remove" deletes the duplicates. The canonical copy of a group is the one
+        with a real name rather than a "Pasted image" timestamp, then the one with the shortest path.
+        """
+        started = time.perf_counter()
+        if mode != "report" and not self.recover_transaction():
             return False
+        files = dict(self.iter_vault_files(ATTACHMENT_EXTENSIONS))
+        scanner = DuplicateScanner(self.vault_path, state_path(self.vault_path, self.DEDUP_CACHE_FILENAME))
+        groups = scanner.scan(files.items(), key=lambda path: (bool(PASTED_IMAGE_PATTERN.search(path)), len(path), path))
+        stats = scanner.stats
+        self.log(f"🔎 Scanned {stats['files']} attachments: {stats['candidates']} share a size, {stats['ends_hashed']} end-hashed, {stats['fully_hashed']} fully hashed, {stats['cached']} hash(es) from cache")
 
-    def create_backup(self, source_path, relative_path=None):
-        """Create a backup of a file maintaining directory structure"""
-        if not self.backup_existing_config:
+        duplicates = {}
+        for group in groups:
+            canonical = group[0]
+            size = files[canonical].st_size
+            self.log(f"🗃️ {canonical} ({size:,} bytes, {len(group) - 1} duplicate(s))")
+            for path in group:
+                if path != canonical:
+                    duplicates[path] = canonical
+                    self.log(f"   = {path}")
+        wasted = sum(files[path].st_size for path in duplicates)
+        self.log(f"📊 {len(groups)} group(s) of identical attachments, {len(duplicates)} duplicate(s) using {wasted:,} bytes")
+
+        failed = 0
+        if mode != "report" and duplicates:
+            failed += self.relink_attachments(duplicates, removing=mode == "remove", dry_run=dry_run)
+            if mode in ("hardlink", "remove") and failed == 0:
+                failed += self.consolidate_duplicates(duplicates, files, mode, dry_run)
+        self.log(f"⏱️ Duplicate scan took {time.perf_counter() - started:.3f}s")
+        return failed == 0
+
+    def relink_attachments(self, duplicates, removing=False, dry_run=False):
+        """Point every wikilink and Markdown link to a duplicate at its canonical copy, in every note of the vault, in one transaction
+
+        Returns the number of notes that could not be rewritten. When removing, a note that cannot be
+        read counts too, since it may still link to a duplicate.
+        """
+        attachments = self.index_attachments()
+        names = {}
+        for path in set(duplicates.values()):
+            name = path.rsplit("/", 1)[-1]
+            # Link by name unless another file (that will still exist) has the same name
+            others = [other for other in attachments.get(name, []) if other != path and not (removing and other in duplicates)]
+            names[path] = path if others else name
+
+        failed = 0
+        relinked = 0
+        self.transaction = None if dry_run else VaultTransaction(self.vault_path, self.snapshot)
+        try:
+            for relative, stat_result in self.iter_vault_files({".md"}):
+                path = self.vault_path / relative
+                try:
+                    text = path.read_text(encoding="utf-8")
+                except (OSError, UnicodeDecodeError) as e:
+                    if removing:
+                        failed += 1
+                        self.log(f"❌ Cannot check the links in {relative} ({e})")
+                    continue
+                new_text, rewritten = self.rewrite_links(text, relative, attachments, duplicates, names)
+                if not rewritten:
+                    continue
+                relinked += 1
+                self.log(f"{'🔍' if dry_run else '🔗'} {relative}: {len(rewritten)} link(s)")
+                if dry_run:
+                    continue
+                try:
+                    # Never overwrite an edit made (e.g. in Obsidian) since the note was read
+                    if (path.stat().st_mtime_ns, path.stat().st_size) != (stat_result.st_mtime_ns, stat_result.st_size):
+                        raise OSError("modified during the scan")
+                    self.write_file(path, new_text.encode("utf-8"), stat.S_IMODE(stat_result.st_mode))
+                except OSError as e:
+                    failed += 1
+                    self.log(f"❌ Failed: {relative} ({e})")
+            if self.transaction is not None and failed == 0 and not self.commit_transaction():
+                failed = relinked
+        finally:
+            transaction, self.transaction = self.transaction, None
+            if transaction is not None and transaction.state != "committed":
+                transaction.rollback()
+        self.log(f"📊 {relinked} note(s) {'would be ' if dry_run else ''}relinked")
+        return failed
+
+    def consolidate_duplicates(self, duplicates, files, mode, dry_run=False):
+        """Delete each duplicate, or replace it with a hard link to its canonical copy; returns the number that failed"""
+        failed = 0
+        for path, canonical in duplicates.items():
+            self.log(f"{'🔍' if dry_run else '🗑️' if mode == 'remove' else '🔗'} {'Remove' if mode == 'remove' else 'Hard link'} {path}" + ("" if mode == "remove" else f" -> {canonical}"))
+            if dry_run:
+                continue
+            target = self.vault_path / path
+            try:
+                current = target.stat()
+                if (current.st_mtime_ns, current.st_size) != (files[path].st_mtime_ns, files[path].st_size):
+                    raise OSError("modified during the scan")
+                if mode == "remove":
+                    target.unlink()
+                else:
+                    temp_path = target.with_name(f".{target.name}.{os.getpid()}.link")
+                    os.link(self.vault_path / canonical, temp_path)
+                    try:
+                        os.replace(temp_path, target)
+                    except OSError:
+                        temp_path.unlink()
+                        raise
+            except OSError as e:
+                failed += 1
+                self.log(f"❌ Failed: {path} ({e})")
+        return failed
+
+    def run_exclusive(self, kind, work, *options):
+        """Run work() holding the vault lock; a run that queued behind an identical one is merged into it (see VaultRunQueue)
+
+        Runs are identical when kind, options, the setup options and the values of the template variables
+        the source uses match; the rest of the environment is ignored, so runs from different shells merge.
+        """
+        used = set()
+        for source in self.get_templated_sources():
+            try:
+                used.update(self.renderer.variables(source))
+            except Exception:
+                continue  # The run itself reports unreadable or invalid templates
+        variables = {name: self.renderer.context[name] for name in sorted(used) if name in self.renderer.context}
+        signature = [kind, options, str(self.source_path), self.backup_existing_config, str(self.backup_directory), self.overwrite_existing_files, self.force, self.backup_keep, self.backup_format, variables]
+        queue = VaultRunQueue(self.vault_path, hash_bytes(json.dumps(signature, sort_keys=True, default=str).encode("utf-8")))
+
+        def acquired(queue):
+            event = {"event": "lock", "vault": str(self.vault_path), "kind": kind, "wait": queue.wait, "coalesced": queue.coalesced, "merged": queue.merged}
+            # Text output only mentions the lock when another run held it up
+            if queue.coalesced:
+                event["message"] = f"🔁 An identical {kind} run finished while this one waited {queue.wait:.3f}s for the vault lock; nothing left to do"
+            elif queue.merged or queue.wait >= LOCK_WAIT_REPORT_THRESHOLD:
+                event["message"] = f"🔐 Vault lock acquired after {queue.wait:.3f}s" + (f"; this run also covers {queue.merged} identical queued run(s)" if queue.merged else "")
+            self.emit(event)
+
+        return queue.run(work, acquired)
+
+    def run_setup(self, copy_files=False, configure_only=False, ignore_files_only=False):
+        """Run the setup process based on options, holding the vault lock"""
+        return self.run_exclusive("setup", lambda: self._run_transaction(copy_files, configure_only, ignore_files_only), copy_files, configure_only, ignore_files_only)
+
+    def _run_transaction(self, copy_files, configure_only, ignore_files_only):
+        """Run the setup as one transaction: the vault gets every write or none"""
+        if not self.recover_transaction():
             return False
+        self.transaction = VaultTransaction(self.vault_path, self.snapshot)
+        try:
+            return self._run_setup(copy_files, configure_only, ignore_files_only)
+        finally:
+            transaction, self.transaction = self.transaction, None
+            self.settings.redirect(self.config_path, None)
+            if transaction.state == "committed":
+                self.commit_backups(transaction.id)
+            else:
+                transaction.rollback()
+                self.backups.discard()
+                if transaction.staged:
+                    self.log(f"↩️ Rolled back {len(transaction.staged)} staged write(s); the vault was left unchanged")
 
-        source = Path(source_path)
-        if not source.exists():
+    def recover_transaction(self):
+        """Roll back (or finish) a transaction an earlier run left behind when it was killed mid-commit"""
+        try:
+            recovered = VaultTransaction.recover(self.vault_path)
+        except Exception as e:
+            self.log(f"❌ Cannot recover the interrupted run recorded in {self.vault_path / STATE_DIRNAME / VaultTransaction.JOURNAL_FILENAME}: {e}")
             return False
+        if recovered:
+            run_id, outcome = recovered
+            self.log(f"♻️ Interrupted run {run_id} found in the journal: {outcome}")
+        return True
 
-        # Create backup directory if it doesn't exist
-        self.backup_directory.mkdir(parents=True, exist_ok=True)
+    def commit_transaction(self):
+        """Rename every staged write into place in one burst"""
+        with self.operation("transaction", "commit") as event:
+            try:
+                event["files"] = self.transaction.commit()
+            except Exception as e:
+                event["outcome"] = "failed"
+                self.log(f"❌ Commit failed and was rolled back: {e}")
+                return False
+        if event["files"]:
+            self.log(f"🔒 Committed {event['files']} file(s) in {event['duration'] * 1000:.1f}ms")
+        return True
 
-        # Use relative path if provided, otherwise use filename
-        if relative_path:
-            backup_path = self.backup_directory / relative_path
+    def _run_setup(self, copy_files, configure_only, ignore_files_only):
+        # Determine what operations to perform
+        if ignore_files_only:
+            do_copy = False
+            do_configure = False
+            do_ignore = True
         else:
-            backup_path = self.backup_directory / source.name
+            do_copy = copy_files or (not copy_files and not configure_only)  # Copy if --copy or default
+            do_configure = configure_only or (not copy_files and not configure_only)  # Configure if --configure or default
+            do_ignore = do_configure  # Create ignore files as part of configuration
+
+        self.log("🔧 Starting Obsidian Setup...")
+        self.log(f"📁 Vault path: {self.vault_path}")
+        if do_copy:
+            self.log(f"📂 Source path: {self.source_path}")
+        self.log()
+
+        # Build the task graph: copy parts are independent, configuration waits for the copied config.json
+        # (and the Templater commands it registers), and ignore files only need the configuration
+        graph = TaskGraph()
+        if do_copy:
+            if not self.prepare_copy():
+                return False
+            for name, title, function in self.get_copy_tasks():
+                graph.add(name, title, function)
 
+        if do_configure or do_ignore:
+            graph.add("load-config", "Loading configuration", self._load_config_task, depends_on=["copy-config"] if do_copy else [])
+
+        if do_configure:
+            graph.add("check-plugins", "Checking required plugins", self.check_required_plugins, depends_on=["load-config"])
+            graph.add("templater-config", "Configuring Templater plugin", self.setup_templater_config, depends_on=["check-plugins"] + (["copy-templater"] if do_copy else []))
+
+        if do_ignore:
+            graph.add("ignore-files", "Creating AI agent ignore files", self.create_ignore_files, depends_on=["load-config"])
+
+        step = 1
+
+        def emit(title, events):
+            nonlocal step
+            has_messages = any("message" in event for event in events)
+            if has_messages:
+                self.log(f"{step}️⃣ {title}...")
+                step += 1
+            for event in events:
+                self.emit(event)
+            if has_messages:
+                self.log()
+
+        try:
+            success = graph.run(self._run_buffered, emit)
+        finally:
+            if do_copy:
+                self.finish_copy()
+                self.log()
+
+        for line in graph.report():
+            self.log(line)
+        self.log()
+        for event in self.events.phase_report():
+            self.emit(event)
+        self.log()
+
+        if not success or not self.commit_transaction():
+            return False
+
+        self.log(f"🔍 Filesystem calls: {self.snapshot.summary()}")
+        self.log("🎉 Setup completed successfully!")
+        if do_configure:
+            self.log("💡 Please restart Obsidian to apply the changes.")
+        return True
+
+    def _load_config_task(self):
+        """Load config.json (after it has been copied) for the configuration tasks"""
+        self.config = self.load_config()
+        return bool(self.config)
+
+    def _run_buffered(self, function):
+        """Run function with its events buffered, returning (succeeded, events)
+
+        When profiling, the call is profiled too, since before Python 3.12 cProfile only sees the thread it runs in."""
+        self._log_buffer.events = []
+        profiler = cProfile.Profile() if self.profiles is not None and not profiler_active() else None
         try:
-            # Create parent directories for the backup file
-            backup_path.parent.mkdir(parents=True, exist_ok=True)
+            if profiler:
+                try:
+                    profiler.enable()
+                except ValueError:
+                    # Another profiler took over meanwhile; it already sees this thread
+                    profiler = None
+            try:
+                succeeded = bool(function())
+            except SystemExit:
+                succeeded = False
+            except Exception as e:
+                self.log(f"❌ Unexpected error occurred: {e}")
+                succeeded = False
+            return succeeded, self._log_buffer.events
+        finally:
+            if profiler:
+                profiler.disable()
+                with self._stats_lock:
+                    self.profiles.append(profiler)
+            self._log_buffer.events = None
+
+    def get_deploy_target(self, source):
+        """Return (target, backup relative path, templating) for a source path, or None if it is not deployed"""
+        relative = os.path.relpath(source, self.source_path.resolve())
+        if relative == os.curdir or relative.startswith(os.pardir):
+            return None
+        parts = Path(relative).parts
+        if relative == "config.json":
+            return self.config_path, "config.json", True
+        if relative == "gemini.sh":
+            return self.vault_path / "gemini.sh", "gemini.sh", False
+        if relative == "AGENTS.md.example":
+            return self.vault_path / "AGENTS.md", "AGENTS.md", False
+        if parts[0] == "Templater":
+            return self.vault_path / relative, Path(relative), False
+        if parts[0] == "CssSnippets":
+            return self.obsidian_path.joinpath("snippets", *parts[1:]), Path(relative), False
+        if parts[0] == ".gemini":
+            return self.vault_path / relative, Path(relative), True
+        return None
+
+    def redeploy(self, changed_paths):
+        """Redeploy changed source paths into the vault through copy_file (used by watch mode)"""
+        started = time.perf_counter()
+        self.deploy_stats = {"copied": 0, "updated": 0, "unchanged": 0, "removed": 0}
+
+        for path in changed_paths:
+            self.snapshot.invalidate(path)
+        sources = set()
+        for path in changed_paths:
+            if self.snapshot.is_dir(path):
+                sources.update(self.snapshot.walk_files(path))
+            else:
+                sources.add(Path(path))
 
-            if source.is_file():
-                shutil.copy2(source, backup_path)
+        touched_targets = []
+        failed = 0
+        for source in sorted(sources):
+            deploy_target = self.get_deploy_target(source)
+            if deploy_target is None:
+                continue
+            target, backup_relative_path, templating = deploy_target
+            self.snapshot.invalidate(target)
+            if self.snapshot.is_file(source):
+                succeeded = self.copy_file(source, target, backup_relative_path=backup_relative_path, templating=templating, relative_path=self._manifest_key(target))
             else:
-                if backup_path.exists():
-                    shutil.rmtree(backup_path)
-                shutil.copytree(source, backup_path)
+                succeeded = self._remove_deployed(target, backup_relative_path)
+            touched_targets.append(target)
+            failed += not succeeded
 
-            print(f"📋 Backed up to: {backup_path}")
+        if not touched_targets:
             return True
-        except Exception as e:
-            print(f"⚠️ Failed to backup {source}: {e}")
+
+        # New or deleted commands change the hotkey list, which is the only part of data.json updated here
+        if self.config:
+            commands_path = self.vault_path / self.config["paths"]["commands_folder"]
+            if any(target.parent == commands_path for target in touched_targets):
+                failed += not self.update_command_hotkeys()
+            if self.config_path in touched_targets:
+                self.log("💡 config.json changed; run setup again to apply configuration changes.")
+
+        self.manifest.save()
+        self.commit_backups()
+        stats = self.deploy_stats
+        elapsed = (time.perf_counter() - started) * 1000
+        self.log(f"⚡ Redeployed in {elapsed:.0f} ms: {stats['copied']} copied, {stats['updated']} updated, {stats['unchanged']} unchanged, {stats['removed']} removed" + (f", {failed} failed" if failed else ""))
+        return failed == 0
+
+    def _remove_deployed(self, target, backup_relative_path):
+        """Remove the files deployed from a deleted source path, keeping any that were modified in the vault"""
+        target_key = self._manifest_key(target)
+        success = True
+        for key in self.manifest.keys_under(target_key):
+            path = self.vault_path / key
+            with self.operation("remove", key) as event:
+                entry = self.manifest.get(key)
+                if not self.snapshot.is_file(path):
+                    self.manifest.remove(key)
+                    event["outcome"] = "missing"
+                    continue
+                if not DeployManifest.stat_matches(entry, self.snapshot.stat(path)):
+                    self.log(f"⚠️ Kept (modified in vault): {key}")
+                    event["outcome"] = "kept"
+                    continue
+                try:
+                    self.create_backup(path, Path(backup_relative_path) / key[len(target_key) :].lstrip("/"), entry.get("rendered_hash", entry.get("source_hash")))
+                    os.unlink(path)
+                    self.snapshot.invalidate(path)
+                    self.manifest.remove(key)
+                    self._count_deploy("removed")
+                    event["outcome"] = "removed"
+                    self.log(f"🗑️ Removed: {key}")
+                except OSError as e:
+                    event["outcome"] = "failed"
+                    self.log(f"❌ Failed to remove: {key} ({e})")
+                    success = False
+        return success
+
+    def update_command_hotkeys(self):
+        """Regenerate enabled_templates_hotkeys in the Templater data.json, leaving other settings alone"""
+        with self.operation("templater-config", self.templater_data_path) as event:
+            try:
+                with open(self.templater_data_path, "r", encoding="utf-8") as f:
+                    templater_config = json.load(f)
+            except FileNotFoundError:
+                self.log("⚠️ Templater configuration not found; run setup without --copy to create it.")
+                event["outcome"] = "skipped"
+                return True
+            except Exception as e:
+                self.log(f"❌ Error reading Templater configuration: {e}")
+                event["outcome"] = "failed"
+                return False
+
+            command_templates = self.get_command_templates()
+            if self._get_config_value("templater.preserve_user_entries", False):
+                command_templates = self._preserve_user_hotkeys(templater_config.get("enabled_templates_hotkeys"), command_templates)
+            if templater_config.get("enabled_templates_hotkeys") == command_templates:
+                event["outcome"] = "unchanged"
+                return True
+
+            try:
+                self.create_backup(self.templater_data_path, "data.json")
+                templater_config["enabled_templates_hotkeys"] = command_templates
+                data = json.dumps(templater_config, indent=2, ensure_ascii=False).encode("utf-8")
+                write_file_atomic(self.templater_data_path, data, self.snapshot.stat(self.templater_data_path).st_mode & 0o7777, fsync=True)
+                self.snapshot.record(self.templater_data_path)
+                event["bytes"] = len(data)
+                event["outcome"] = "updated"
+                self.log(f"⌨️ Updated template hotkeys: {len(command_templates)} command(s)")
+                return True
+            except Exception as e:
+                event["outcome"] = "failed"
+                self.log(f"❌ Error updating template hotkeys: {e}")
+                return False
+
+    def watch(self, debounce=0.05, backend="auto", poll_interval=0.5):
+        """Watch the source tree and redeploy changed files until interrupted"""
+        try:
+            watcher = create_source_watcher(self.source_path, backend, poll_interval)
+        except OSError as e:
+            self.log(f"❌ Cannot watch {self.source_path}: {e}")
             return False
 
-    def _copy_directory_contents(self, source_dir, target_dir, backup_prefix=None):
-        """Copy directory contents recursively, creating directories as needed and only overwriting files if specified"""
-        source = Path(source_dir)
-        target = Path(target_dir)
+        self.log(f"👀 Watching {self.source_path} for changes ({watcher.name}). Press Ctrl+C to stop.")
+        try:
+            while True:
+                changed = watcher.changes(debounce)
+                if changed:
+                    self.run_exclusive("redeploy", lambda: self.redeploy(changed), sorted(map(str, changed)))
+        except KeyboardInterrupt:
+            self.log("\n👋 Stopped watching.")
+            return True
+        finally:
+            watcher.close()
+
+
+class PreparedSource:
+    """Source tree scanned, hashed and compiled once, then shared with every vault of a fleet run
+
+    Templated files are not rendered here because their output depends on each vault's VAULT_PATH,
+    but their compiled form is, so each vault only substitutes variables.
+    """
+
+    DIRECTORIES = ("Templater", "CssSnippets", ".gemini")
+    FILES = ("config.json", "gemini.sh", "AGENTS.md.example")
+
+    def __init__(self, source_path, renderer):
+        self.source_path = Path(source_path).resolve()
+        snapshot = FileSystemSnapshot()
+        self.listings = snapshot.export(self.source_path, recursive=False)
+
+        deploy_files = [self.source_path / name for name in self.FILES if snapshot.is_file(self.source_path / name)]
+        for directory in self.DIRECTORIES:
+            if snapshot.is_dir(self.source_path / directory):
+                self.listings.update(snapshot.export(self.source_path / directory))
+                deploy_files.extend(snapshot.walk_files(self.source_path / directory))
+
+        self.hashes = {}
+        for path in deploy_files:
+            stat_result = snapshot.stat(path)
+            self.hashes[os.path.abspath(path)] = (stat_result.st_size, stat_result.st_mtime_ns, hash_file(path))
+
+        # Compile templated sources; missing variables are reported per vault later
+        templated = [self.source_path / "config.json"]
+        if snapshot.is_dir(self.source_path / ".gemini"):
+            templated.extend(snapshot.walk_files(self.source_path / ".gemini"))
+        for path in templated:
+            try:
+                renderer.missing_variables(path)
+            except Exception:
+                pass
+        self.compiled = renderer.export()
+
+        self.json_cache = {}
+        config_path = str(self.source_path / "config.json")
+        try:
+            self.json_cache[config_path] = (file_signature(config_path), load_json_cached(config_path))
+        except Exception:
+            pass
+
+        self.file_count = len(deploy_files)
+        self.syscalls = snapshot.summary()
 
-        if not source.exists():
-            print(f"❌ Source directory not found: {source}")
-            return False
 
-        # Create target directory if it doesn't exist
-        target.mkdir(parents=True, exist_ok=True)
+class _BundleStat:
+    """stat-like record for a bundle member, carrying the mode, size and mtime its source file had when bundled"""
 
-        # Determine backup prefix based on source directory name if not provided
-        if backup_prefix is None:
-            backup_prefix = source.name
+    __slots__ = ("st_mode", "st_size", "st_mtime_ns")
 
-        try:
-            success_count = 0
-            total_count = 0
+    def __init__(self, st_mode, st_size=0, st_mtime_ns=0):
+        self.st_mode = st_mode
+        self.st_size = st_size
+        self.st_mtime_ns = st_mtime_ns
 
-            for item in source.rglob("*"):
-                if item.is_file():
-                    total_count += 1
-                    # Calculate relative path from source
-                    relative_path = item.relative_to(source)
-                    target_file = target / relative_path
+    @property
+    def st_mtime(self):
+        return self.st_mtime_ns / 1e9
 
-                    # Generate backup path maintaining directory structure
-                    backup_relative_path = Path(backup_prefix) / relative_path
 
-                    # Copy file (copy_file handles all logic internally)
-                    if self.copy_file(item, target_file, backup_relative_path=backup_relative_path, relative_path=relative_path):
-                        success_count += 1
+class SourceBundle:
+    """Source tree packed into one zip with an embedded manifest and precompiled templates
 
-            print(f"✅ Processed {backup_prefix} folder: {success_count}/{total_count} files processed successfully")
-            return success_count == total_count
+    The manifest records every file's size, mtime and hash, so deploys compare against it instead of
+    rehashing the source. Members are stored uncompressed and read straight out of a read-only memory
+    map of the zip, without extracting it; processes applying the same bundle share its pages.
+    Bundle members are addressed as paths below the bundle file, as if it were the source directory.
+    """
 
-        except Exception as e:
-            print(f"❌ Error copying directory contents: {e}")
-            return False
+    FORMAT = "obsidian-setup-bundle"
+    VERSION = 1
+    MANIFEST_NAME = "bundle.json"
+    MEMBER_PREFIX = "source/"
 
-    def copy_files_to_vault(self):
-        """Copy config.json, Templater folder, and CssSnippets to the target vault"""
-        print("📁 Copying files to target vault...")
+    # Zip local file header: signature, 22 bytes of fixed fields, then file name and extra field lengths
+    LOCAL_HEADER = struct.Struct("<4s22xHH")
+    LOCAL_HEADER_SIGNATURE = b"PK\x03\x04"
 
-        # Check if source files exist
-        if not self.source_config_path.exists():
-            print(f"❌ Source config.json not found: {self.source_config_path}")
-            return False
+    def __init__(self, path):
+        self.path = Path(path).resolve()
+        self.root = self.path
+        self.members = {}
+        with open(self.path, "rb") as f:
+            try:
+                with zipfile.ZipFile(f) as archive:
+                    infos = archive.infolist()
+                self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except (zipfile.BadZipFile, ValueError) as e:
+                raise ValueError(f"{self.path} is not a source bundle: {e}") from None
 
-        source_templater_path = self.source_path / "Templater"
-        if not source_templater_path.exists():
-            print(f"❌ Source Templater folder not found: {source_templater_path}")
-            return False
+        for info in infos:
+            if info.compress_type not in (zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED):
+                raise ValueError(f"{info.filename}: unsupported compression method {info.compress_type}")
+            signature, name_length, extra_length = self.LOCAL_HEADER.unpack_from(self._map, info.header_offset)
+            if signature != self.LOCAL_HEADER_SIGNATURE:
+                raise ValueError(f"{info.filename}: bad local header")
+            offset = info.header_offset + self.LOCAL_HEADER.size + name_length + extra_length
+            self.members[info.filename] = (offset, info.compress_size, info.file_size, info.compress_type, info.CRC)
 
         try:
-            # Handle config.json
-            if not self.copy_file(self.source_config_path, self.config_path, backup_relative_path="config.json", templating=True, relative_path="config.json"):
-                return False
+            manifest = json.loads(bytes(self._read_member(self.MANIFEST_NAME)))
+        except KeyError:
+            raise ValueError(f"{self.path} has no {self.MANIFEST_NAME}") from None
+        if manifest.get("format") != self.FORMAT or manifest.get("version") != self.VERSION:
+            raise ValueError(f"{self.path}: unsupported bundle format {manifest.get('format')} version {manifest.get('version')}")
+        self.files = manifest["files"]
+        self.templates = manifest.get("templates", {})
+        self.created = manifest.get("created")
 
-            # Handle Templater folder - copy files individually
-            target_templater_path = self.vault_path / "Templater"
-            if not self._copy_directory_contents(source_templater_path, target_templater_path, "Templater"):
-                return False
-            print()
-
-            # Handle CssSnippets folder
-            source_css_snippets_path = self.source_path / "CssSnippets"
-            if source_css_snippets_path.exists():
-                target_snippets_path = self.obsidian_path / "snippets"
-                if not self._copy_directory_contents(source_css_snippets_path, target_snippets_path, "CssSnippets"):
-                    return False
-            else:
-                print(f"⚠️ Source CssSnippets folder not found: {source_css_snippets_path}")
-
-            # Handle .gemini folder (with template substitution)
-            source_gemini_path = self.source_path / ".gemini"
-            if source_gemini_path.exists():
-                target_gemini_path = self.vault_path / ".gemini"
-                target_gemini_path.mkdir(parents=True, exist_ok=True)
-
-                # Copy .gemini files individually with template substitution
-                for item in source_gemini_path.rglob("*"):
-                    if item.is_file():
-                        relative_path = item.relative_to(source_gemini_path)
-                        target_file = target_gemini_path / relative_path
-                        backup_relative_path = Path(".gemini") / relative_path
-
-                        if not self.copy_file(item, target_file, backup_relative_path=backup_relative_path, templating=True, relative_path=f".gemini/{relative_path}"):
-                            return False
-            else:
-                print(f"⚠️ Source .gemini folder not found: {source_gemini_path}")
-
-            # Handle gemini.sh file
-            source_gemini_sh = self.source_path / "gemini.sh"
-            if source_gemini_sh.exists():
-                target_gemini_sh = self.vault_path / "gemini.sh"
-                if not self.copy_file(source_gemini_sh, target_gemini_sh, backup_relative_path="gemini.sh", relative_path="gemini.sh"):
-                    return False
-            else:
-                print(f"⚠️ Source gemini.sh file not found: {source_gemini_sh}")
-
-            # Handle AGENTS.md.example file (copy as AGENTS.md)
-            source_agents_example = self.source_path / "AGENTS.md.example"
-            if source_agents_example.exists():
-                target_agents = self.vault_path / "AGENTS.md"
-                if not self.copy_file(source_agents_example, target_agents, backup_relative_path="AGENTS.md", relative_path="AGENTS.md"):
-                    return False
-            else:
-                print(f"⚠️ Source AGENTS.md.example file not found: {source_agents_example}")
+    def _read_member(self, name):
+        offset, compressed_size, size, method, crc = self.members[name]
+        data = memoryview(self._map)[offset : offset + compressed_size]
+        if method == zipfile.ZIP_DEFLATED:
+            data = zlib.decompress(data, -zlib.MAX_WBITS)
+        if len(data) != size or zlib.crc32(data) != crc:
+            raise ValueError(f"corrupt bundle member: {name}")
+        return data
 
-            return True
+    def relative(self, path):
+        """Return the source-relative posix path of a path below the bundle"""
+        return Path(os.path.relpath(path, self.root)).as_posix()
 
-        except Exception as e:
-            print(f"❌ Error copying files: {e}")
-            return False
+    def read(self, path):
+        """Return a source file's bytes; stored members are a zero-copy view of the memory map"""
+        relative = self.relative(path)
+        try:
+            return self._read_member(self.MEMBER_PREFIX + relative)
+        except KeyError:
+            raise FileNotFoundError(errno.ENOENT, "Not in source bundle", str(path)) from None
 
-    def create_folder_templates(self):
-        """Create folder templates configuration based on note directories"""
-        note_dirs = self.config["paths"].get("note_directories", [])
-        daily_dirs = self.config["paths"].get("daily_note_directories", [])
-        new_note_template = self.config["paths"].get("new_note_template")
-        daily_note_template = self.config["paths"].get("daily_note_template")
+    def config(self):
+        """Return the source config.json, parsed"""
+        return json.loads(bytes(self.read(self.root / "config.json")))
 
-        # If no templates are configured, return empty list
-        if not new_note_template and not daily_note_template:
-            print("⚠️ No note templates configured, skipping folder template setup")
-            return []
+    def listings(self):
+        """Return {directory: {name: entry}} listings of the bundled source tree for FileSystemSnapshot.preload"""
+        root = str(self.root)
+        listings = {root: {}}
+        for relative, info in self.files.items():
+            path = root
+            parts = relative.split("/")
+            for name in parts[:-1]:
+                child = os.path.join(path, name)
+                if child not in listings:
+                    listings[path][name] = _StatEntry(child, _BundleStat(stat.S_IFDIR | 0o755))
+                    listings[child] = {}
+                path = child
+            child = os.path.join(path, parts[-1])
+            listings[path][parts[-1]] = _StatEntry(child, _BundleStat(stat.S_IFREG | info["mode"], info["size"], info["mtime_ns"]))
+        return listings
 
-        folder_templates = []
-        processed_dirs = set()
+    def hashes(self):
+        """Return the source hash cache ({path: (size, mtime_ns, hash)}) recorded when the bundle was built"""
+        return {os.path.join(str(self.root), *relative.split("/")): (info["size"], info["mtime_ns"], info["hash"]) for relative, info in self.files.items()}
 
-        # Process daily note directories first (they have priority for daily_note_template)
-        for daily_dir in daily_dirs:
-            if daily_note_template:
-                folder_templates.append({"folder": daily_dir, "template": daily_note_template})
-                processed_dirs.add(daily_dir)
-            else:
-                print(f"⚠️ No daily note template configured for daily directory: {daily_dir}")
+    def compiled_templates(self):
+        """Return the precompiled templates, keyed by source content hash like TemplateRenderer's cache"""
+        return {content_hash: CompiledTemplate.from_segments(segments) for content_hash, segments in self.templates.items()}
 
-        # Process remaining note directories with new_note_template
-        for note_dir in note_dirs:
-            if note_dir not in processed_dirs:
-                if new_note_template:
-                    folder_templates.append({"folder": note_dir, "template": new_note_template})
-                    processed_dirs.add(note_dir)
-                else:
-                    print(f"⚠️ No new note template configured for directory: {note_dir}")
+    @classmethod
+    def build(cls, source_path, output_path):
+        """Pack the deployable source tree into a bundle, returning its manifest"""
+        source_path = Path(source_path).resolve()
+        snapshot = FileSystemSnapshot()
+        if not snapshot.is_file(source_path / "config.json"):
+            raise FileNotFoundError(f"Source config.json not found: {source_path / 'config.json'}")
+        if not snapshot.is_dir(source_path / "Templater"):
+            raise FileNotFoundError(f"Source Templater folder not found: {source_path / 'Templater'}")
 
-        return folder_templates
+        sources = [source_path / name for name in PreparedSource.FILES if snapshot.is_file(source_path / name)]
+        for directory in PreparedSource.DIRECTORIES:
+            if snapshot.is_dir(source_path / directory):
+                sources.extend(snapshot.walk_files(source_path / directory))
+        sources.sort(key=lambda path: path.relative_to(source_path).as_posix())
 
-    def setup_templater_config(self):
-        """Configure Templater plugin settings"""
-        # Create .obsidian/plugins/templater-obsidian directory if it doesn't exist
-        self.templater_data_path.parent.mkdir(parents=True, exist_ok=True)
+        # Parse the source config now so a broken one fails the build, not every vault it is applied to
+        with open(source_path / "config.json", "r", encoding="utf-8") as f:
+            json.load(f)
 
-        existing_config = {}
-        config_exists = self.templater_data_path.exists()
+        manifest = {"format": cls.FORMAT, "version": cls.VERSION, "created": time.strftime("%Y-%m-%dT%H:%M:%S%z"), "files": {}, "templates": {}}
 
-        if not config_exists:
-            print(f"📝 Templater configuration file not found. Creating new one: {self.templater_data_path}")
-        else:
-            print(f"📝 Found existing Templater configuration: {self.templater_data_path}")
+        def write(fd):
+            with open(fd, "wb", closefd=False) as f, zipfile.ZipFile(f, "w", zipfile.ZIP_STORED) as archive:
+                for path in sources:
+                    relative = path.relative_to(source_path).as_posix()
+                    source_stat = snapshot.stat(path)
+                    info = zipfile.ZipInfo.from_file(path, cls.MEMBER_PREFIX + relative)
+                    info.compress_type = zipfile.ZIP_STORED
+                    digest = hashlib.sha256()
+                    with open(path, "rb") as src, archive.open(info, "w", force_zip64=source_stat.st_size >= zipfile.ZIP64_LIMIT) as dst:
+                        while chunk := src.read(COPY_CHUNK_SIZE):
+                            digest.update(chunk)
+                            dst.write(chunk)
+                    content_hash = digest.hexdigest()
+                    templated = relative == "config.json" or relative.startswith(".gemini/")
+                    manifest["files"][relative] = {"size": source_stat.st_size, "mtime_ns": source_stat.st_mtime_ns, "mode": stat.S_IMODE(source_stat.st_mode), "hash": content_hash, "templated": templated}
+                    if templated and source_stat.st_size <= TEMPLATE_STREAM_THRESHOLD:
+                        try:
+                            compiled = CompiledTemplate(path.read_text(encoding="utf-8"))
+                        except ValueError as e:
+                            raise ValueError(f"{relative}: {e}") from None
+                        manifest["templates"][content_hash] = compiled.segments
+                archive.writestr(cls.MANIFEST_NAME, json.dumps(manifest, indent=2, sort_keys=True))
 
-        try:
-            # Read existing configuration if it exists
-            if config_exists:
-                with open(self.templater_data_path, "r", encoding="utf-8") as f:
-                    existing_config = json.load(f)
+        _replace_atomic(output_path, write)
+        return manifest
 
-                # Create backup using unified backup system
-                self.create_backup(self.templater_data_path, "data.json")
-            else:
-                existing_config = {}
 
-            # Get command template files for hotkey registration
-            command_templates = self.get_command_templates()
+@lru_cache(maxsize=4)
+def open_source_bundle(path):
+    """Open a source bundle once per process, so every vault of a fleet worker shares its memory map"""
+    return SourceBundle(path)
 
-            # Create folder templates dynamically
-            folder_templates = self.create_folder_templates()
-
-            # Create templater configuration
-            templater_config = {
-                "templates_folder": self.config["paths"]["templates_folder"],
-                "trigger_on_file_creation": True,  # Always enable
-                "user_scripts_folder": self.config["paths"]["user_scripts_folder"],
-                "enable_folder_templates": True,
-                "folder_templates": folder_templates,
-                "enable_file_templates": False,
-                "file_templates": [{"regex": ".*", "template": ""}],
-                "enabled_templates_hotkeys": command_templates,
-                "startup_templates": [self.config["paths"]["startup_template"]],
-            }
 
-            # Merge with existing config (preserve any additional settings)
-            existing_config.update(templater_config)
+def build_source_bundle(source_path, output_path):
+    """Build a source bundle and print what went into it"""
+    started = time.perf_counter()
+    try:
+        manifest = SourceBundle.build(source_path, output_path)
+    except Exception as e:
+        print(f"❌ Failed to build source bundle: {e}")
+        return False
+    total = sum(info["size"] for info in manifest["files"].values())
+    print(f"📦 Built source bundle: {output_path}")
+    print(f"   {len(manifest['files'])} file(s), {total} bytes, {len(manifest['templates'])} precompiled template(s)")
+    print(f"⏱️ Build took {time.perf_counter() - started:.3f}s")
+    return True
 
-            # Save updated configuration
-            with open(self.templater_data_path, "w", encoding="utf-8") as f:
-                json.dump(existing_config, f, indent=2, ensure_ascii=False)
 
-            action = "created" if not config_exists else "updated"
-            print(f"✅ Templater configuration {action} successfully:")
-            print(f"   - Templates folder: {existing_config['templates_folder']}")
-            print(f"   - User scripts folder: {existing_config['user_scripts_folder']}")
-            print(f"   - Folder templates: {len(existing_config['folder_templates'])} folders")
-            print(f"   - Enabled template hotkeys: {len(existing_config['enabled_templates_hotkeys'])} templates")
-            print(f"   - Startup templates: {len(existing_config['startup_templates'])} template(s)")
-            print(f"   - File creation trigger: {'Enabled' if existing_config['trigger_on_file_creation'] else 'Disabled'}")
+_fleet_prepared_source = None
 
-            return True
 
+def _init_fleet_worker(prepared):
+    global _fleet_prepared_source
+    _fleet_prepared_source = prepared
+
+
+def _run_fleet_vault(task):
+    """Set up one vault inside a fleet worker process, capturing its output"""
+    vault, setup_options, run_options, context = task
+    output = io.StringIO()
+    started = time.perf_counter()
+    with contextlib.redirect_stdout(output):
+        try:
+            setup_options = dict(setup_options)
+            events = EventStream(setup_options.pop("log_format", "text"))
+            setup = ObsidianSetup(vault_path=vault, template_context=MappingProxyType(context), events=events, **setup_options)
+            if _fleet_prepared_source is not None:
+                setup.use_prepared_source(_fleet_prepared_source)
+            success = setup.run_setup(**run_options)
+        except SystemExit:
+            success = False
         except Exception as e:
-            print(f"❌ Error configuring Templater: {e}")
-            return False
+            print(f"❌ Unexpected error occurred: {e}")
+            success = False
+    return {"vault": vault, "success": success, "duration": time.perf_counter() - started, "output": output.getvalue()}
 
-    def create_ignore_files(self):
-        """Create ignore files for various AI coding agents"""
-        sensitive_patterns = self.config.get("paths", {}).get("sensitive", [])
 
-        if not sensitive_patterns:
-            print("⚠️ No sensitive patterns found in config.json paths.sensitive")
-            return True
+def read_vaults_file(path):
+    """Read vault paths from a file: one per line, blank lines and # comments ignored, relative to the file"""
+    path = Path(path)
+    vaults = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if line and not line.startswith("#"):
+                vaults.append((path.parent / Path(line).expanduser()).resolve())
+    return vaults
 
-        # Define ignore files to create
-        ignore_files = {
-            ".cursorignore": "Ignore file for Cursor AI agent",
-            ".cursorindexingignore": "Ignore file for Cursor indexing only",
-            ".codeiumignore": "Ignore file for Codeium/Windsurf agent",
-            ".geminiignore": "Ignore file for Gemini CLI",
-            ".aiexclude": "Ignore file for Gemini Code Assist",
-            ".aiderignore": "Ignore file for Aider agent",
-            ".aiignore": "Universal AI agent ignore file (standard)",
-        }
 
-        print("📝 Creating AI agent ignore files...")
+def run_fleet(vault_paths, source_path, setup_options, run_options, template_context, overrides, workers=None):
+    """Set up many vaults from one source: prepare the source once, then fan out over a process pool"""
+    events = EventStream(setup_options.get("log_format", "text"))
 
-        content = "# This file was automatically generated by obsidian-setup tool.\n\n" + "\n".join(sensitive_patterns) + "\n"
+    def log(message="", **fields):
+        events.write({"event": "log", **fields, "message": message})
 
-        success_count = 0
-        total_count = len(ignore_files)
+    workers = max(1, min(workers or os.cpu_count() or 1, len(vault_paths)))
+    log(f"🚚 Fleet setup: {len(vault_paths)} vaults, {workers} worker(s)", event="fleet", vaults=len(vault_paths), workers=workers)
+    if setup_options.get("source_bundle"):
+        # A bundle is already scanned, hashed and compiled; each worker maps it once instead
+        prepared = None
+        log(f"📦 Source bundle: {setup_options['source_bundle']}")
+    else:
+        log(f"📂 Source path: {source_path}")
+        prepared = PreparedSource(source_path, TemplateRenderer(template_context))
+        log(f"📦 Prepared {prepared.file_count} source files ({prepared.syscalls})")
+    log()
 
-        # Create each ignore file
-        for filename, description in ignore_files.items():
-            ignore_file_path = self.vault_path / filename
+    tasks = []
+    for vault in vault_paths:
+        context = dict(template_context)
+        context["VAULT_PATH"] = str(vault)
+        context.update(overrides)
+        tasks.append((str(vault), setup_options, run_options, context))
 
-            try:
-                # Check if file already exists
-                file_existed = ignore_file_path.exists()
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_fleet_worker, initargs=(prepared,)) as executor:
+        results = list(executor.map(_run_fleet_vault, tasks))
 
-                if file_existed and not self.overwrite_existing_files:
-                    print(f"⚠️ Skipped (already exists): {filename}")
-                    success_count += 1
-                    continue
+    # Show the full log only for vaults that failed (already one JSON event per line with --log-format json)
+    for result in results:
+        if not result["success"]:
+            log(f"──── ❌ {result['vault']} ────")
+            sys.stdout.write(result["output"].rstrip() + "\n")
+            log()
 
-                # Create backup if file exists and backup is enabled
-                if file_existed and self.backup_existing_config:
-                    self.create_backup(ignore_file_path, filename)
+    width = max(len("Vault"), *(len(result["vault"]) for result in results))
+    log("📋 Fleet summary:")
+    log(f"   {'Vault':<{width}}  Result     Time")
+    for result in results:
+        status = "✅ OK    " if result["success"] else "❌ FAILED"
+        log(f"   {result['vault']:<{width}}  {status}  {result['duration']:.2f}s", event="fleet-vault", vault=result["vault"], success=result["success"], duration=result["duration"])
 
-                # Write ignore file
-                with open(ignore_file_path, "w", encoding="utf-8") as f:
-                    f.write(content)
+    succeeded = sum(1 for result in results if result["success"])
+    icon = "🎉" if succeeded == len(results) else "❌"
+    log(f"{icon} {succeeded}/{len(results)} vaults set up successfully", event="fleet-summary", succeeded=succeeded, vaults=len(results))
+    return succeeded == len(results)
 
-                action = "Updated" if file_existed else "Created"
-                print(f"✅ {action}: {filename} ({description})")
-                success_count += 1
 
-            except Exception as e:
-                print(f"❌ Failed to create {filename}: {e}")
+def run_audit(vault_paths, setup_options, template_context, overrides, output_path=None, log_format="text"):
+    """Audit vaults for drift from the source, then compare their subtree root hashes with each other"""
+    events = EventStream(log_format)
 
-        print(f"✅ AI ignore files: {success_count}/{total_count} files processed successfully")
-        return success_count == total_count
+    def log(message=""):
+        events.write({"event": "log", "message": message})
 
-    def run_setup(self, copy_files=False, configure_only=False, ignore_files_only=False):
-        """Run the setup process based on options"""
-        # Determine what operations to perform
-        if ignore_files_only:
-            do_copy = False
-            do_configure = False
-            do_ignore = True
-        else:
-            do_copy = copy_files or (not copy_files and not configure_only)  # Copy if --copy or default
-            do_configure = configure_only or (not copy_files and not configure_only)  # Configure if --configure or default
-            do_ignore = do_configure  # Create ignore files as part of configuration
+    reports = []
+    source_hashes = {}
+    for vault in vault_paths:
+        context = dict(template_context)
+        context["VAULT_PATH"] = str(vault)
+        context.update(overrides)
+        setup = ObsidianSetup(vault_path=vault, template_context=MappingProxyType(context), events=events, **setup_options)
+        source_hashes.update(setup.source_hashes)
+        setup.source_hashes = source_hashes  # hash each source file once for all vaults
+        reports.append(setup.audit_drift())
+        log()
 
-        print("🔧 Starting Obsidian Setup...")
-        print(f"📁 Vault path: {self.vault_path}")
-        if do_copy:
-            print(f"📂 Source path: {self.source_path}")
-        print()
+    if len(reports) > 1:
+        log("🌳 Subtree roots across vaults:")
+        for name in reports[0]["subtrees"]:
+            roots = {}
+            for report in reports:
+                root = report["subtrees"].get(name, {}).get("actual_root")
+                roots.setdefault(root, []).append(report["vault"])
+            if len(roots) == 1:
+                log(f"   ✅ {name:<15} identical in all {len(reports)} vaults")
+            else:
+                versions = ", ".join(f"{(root or 'none')[:12]}: {len(vaults)} vault(s)" for root, vaults in sorted(roots.items(), key=lambda item: -len(item[1])))
+                log(f"   ⚠️ {name:<15} {len(roots)} versions ({versions})")
 
-        step = 1
+    drifted = [report["vault"] for report in reports if report["drifted"]]
+    if output_path:
+        try:
+            with open(output_path, "w", encoding="utf-8") as f:
+                json.dump({"created": time.strftime("%Y-%m-%d %H:%M:%S"), "drifted": drifted, "vaults": reports}, f, indent=2, ensure_ascii=False)
+            log(f"💾 Drift report saved to: {output_path}")
+        except OSError as e:
+            log(f"❌ Failed to write drift report: {e}")
+            return False
 
-        # 1. Copy files if needed
-        if do_copy:
-            print(f"{step}️⃣ Copying files to vault...")
-            if not self.copy_files_to_vault():
-                return False
-            print()
-            step += 1
+    if drifted:
+        log(f"❌ {len(drifted)}/{len(reports)} vault(s) drifted from the source")
+    else:
+        log(f"✅ {len(reports)} vault(s) match the source")
+    return not drifted
 
-        # 2. Configure plugins if needed
-        if do_configure:
-            # Load config after potential copying
-            if not self.config:
-                self.config = self.load_config()
-                if not self.config:
-                    return False
-
-            # Check required plugins
-            print(f"{step}️⃣ Checking required plugins...")
-            if not self.check_required_plugins():
-                return False
-            print()
-            step += 1
 
-            # Configure Templater
-            print(f"{step}️⃣ Configuring Templater plugin...")
-            if not self.setup_templater_config():
-                return False
-            print()
-            step += 1
+def profiler_active():
+    """Return True if a profiler already covers every thread
 
-        # 3. Create AI ignore files if needed
-        if do_ignore:
-            # Load config if not already loaded
-            if not self.config:
-                self.config = self.load_config()
-                if not self.config:
-                    return False
-
-            print(f"{step}️⃣ Creating AI agent ignore files...")
-            if not self.create_ignore_files():
-                return False
-            print()
+    From Python 3.12 cProfile runs on sys.monitoring, which is interpreter-wide and allows one profiler at a time.
+    """
+    monitoring = getattr(sys, "monitoring", None)
+    return monitoring is not None and monitoring.get_tool(monitoring.PROFILER_ID) is not None
 
-        print("🎉 Setup completed successfully!")
-        if do_configure:
-            print("💡 Please restart Obsidian to apply the changes.")
-        return True
+
+def run_profiled(setup, run_options, limit=25):
+    """Run setup under cProfile (including its worker threads) and print a summary to stderr"""
+    setup.profiles = []
+    profiler = cProfile.Profile()
+    try:
+        return profiler.runcall(setup.run_setup, **run_options)
+    finally:
+        stats = pstats.Stats(profiler, stream=sys.stderr)
+        for thread_profile in setup.profiles:
+            stats.add(thread_profile)
+        print(f"\n🔬 Profile (top {limit} by cumulative time):", file=sys.stderr)
+        stats.sort_stats("cumulative").print_stats(limit)
 
 
 def main():
@@ -552,15 +5496,49 @@ Examples:
   python setup.py --ignore-files /path/to/vault  # Create AI agent ignore files only
   python setup.py --no-backup              # Copy and configure without creating backups
   python setup.py --backup-dir my-backup   # Create backups in custom directory
+  python setup.py --list-backups           # List backup snapshots of the vault
+  python setup.py --restore latest         # Restore files from the latest backup snapshot
+  python setup.py --backup-format archive  # Write each run's backups into one compressed archive
+  python setup.py --log-format json        # Write structured events as JSON lines
+  python setup.py --profile                # Profile the run and print the slowest functions
   python setup.py --no-overwrite           # Skip existing files instead of overwriting
+  python setup.py --force                  # Rewrite files even if the deploy manifest says they are unchanged
+  python setup.py --jobs 8 /path/to/vault  # Copy folder contents with 8 parallel workers
+  python setup.py --set GEMINI_API_KEY=...  # Override a template variable for this run
+  python setup.py /vault/a /vault/b        # Set up several vaults in parallel
+  python setup.py --vaults-file vaults.txt --workers 4  # Set up every vault listed in a file
+  python setup.py --watch /path/to/vault   # Set up, then redeploy source changes as they happen
+  python setup.py /path/to/vault --check-ignore Secret/a.md Notes/b.md  # Check paths against paths.sensitive
+  python setup.py --audit-sensitive /path/to/vault  # List what each AI agent can see in the vault
+  python setup.py --list-plugins --obsidian-version 1.5.12  # List installed plugins and check minAppVersion
+  python setup.py --audit /vault/a /vault/b --audit-output drift.json  # Report drift from the source
+  python setup.py --normalize-notes --dry-run /path/to/vault  # Show the H1 fixes normalizing notes would make
+  python setup.py --ai-jobs summarize,tags /path/to/vault  # Summarize and tag every note with Gemini
+  python setup.py --query tag:project /path/to/vault  # List notes tagged #project from the vault index
+  python setup.py --dedup-attachments remove --dry-run /path/to/vault  # Show which duplicate attachments would be removed
+  python setup.py --build-bundle source.zip  # Pack the source tree into one pre-rendered bundle
+  python setup.py --source-bundle source.zip /vault/a /vault/b  # Set up vaults from a bundle
         """,
     )
 
     parser.add_argument(
-        "vault_path",
-        nargs="?",
+        "vault_paths",
+        nargs="*",
+        metavar="vault_path",
+        help="Path to the Obsidian vault directory (default: current directory). Pass several to set up a fleet of vaults",
+    )
+
+    parser.add_argument(
+        "--vaults-file",
+        default=None,
+        help="Read vault paths from a file (one per line, # comments allowed) and set them all up",
+    )
+
+    parser.add_argument(
+        "--workers",
+        type=int,
         default=None,
-        help="Path to the Obsidian vault directory (default: current directory)",
+        help="Number of worker processes when setting up several vaults or normalizing notes (default: CPU count)",
     )
 
     parser.add_argument(
@@ -592,8 +5570,132 @@ Examples:
 
     parser.add_argument(
         "--backup-dir",
-        default=".obsidian-setup-backup",
-        help="Directory name for backups (default: .obsidian-setup-backup)",
+        default=DEFAULT_BACKUP_DIRECTORY,
+        help=f"Directory name for backups (default: {DEFAULT_BACKUP_DIRECTORY})",
+    )
+
+    parser.add_argument(
+        "--backup-keep",
+        type=int,
+        default=20,
+        help="Number of backup snapshots to keep; older ones are pruned (default: 20)",
+    )
+
+    parser.add_argument(
+        "--backup-format",
+        choices=["store", "archive"],
+        default="store",
+        help="Backup backend: 'store' keeps deduplicated objects, 'archive' writes one compressed tar per run (default: store)",
+    )
+
+    parser.add_argument(
+        "--list-backups",
+        action="store_true",
+        help="List backup snapshots of the vault and exit",
+    )
+
+    parser.add_argument(
+        "--restore",
+        metavar="SNAPSHOT",
+        default=None,
+        help="Restore files from a backup snapshot (id, id prefix or 'latest') that differ from the vault, then exit",
+    )
+
+    parser.add_argument(
+        "--list-plugins",
+        action="store_true",
+        help="List the vault's installed plugins and their versions, then exit",
+    )
+
+    parser.add_argument(
+        "--obsidian-version",
+        default=None,
+        help="Obsidian app version, used to check plugins' minAppVersion (e.g. 1.5.12)",
+    )
+
+    parser.add_argument(
+        "--check-ignore",
+        nargs="+",
+        metavar="PATH",
+        default=None,
+        help="Check whether vault-relative paths are ignored by paths.sensitive (put the vault path before this flag), then exit",
+    )
+
+    parser.add_argument(
+        "--audit-sensitive",
+        action="store_true",
+        help="Report which vault files each AI agent ignore file hides or exposes, then exit",
+    )
+
+    parser.add_argument(
+        "--audit",
+        action="store_true",
+        help="Report deployed files and Templater settings that drifted from the source (read-only), then exit",
+    )
+
+    parser.add_argument(
+        "--audit-output",
+        default=None,
+        help="Save the --audit drift report, or every agent's ignored and visible files for --audit-sensitive, to this JSON file",
+    )
+
+    parser.add_argument(
+        "--normalize-notes",
+        action="store_true",
+        help="Give every note in paths.note_directories and clipping_directories an H1 title (the parseFile.js rules), then exit",
+    )
+
+    parser.add_argument(
+        "--ai-jobs",
+        metavar="JOBS",
+        default=None,
+        help=f"Run comma-separated AI jobs ({', '.join(AI_JOBS)}) on every note in the note and clipping folders, then exit",
+    )
+
+    parser.add_argument(
+        "--index",
+        action="store_true",
+        help=f"Build or update the vault's SQLite index of tags, links, properties and text ({STATE_DIRNAME}/{VaultIndex.FILENAME}), then exit",
+    )
+
+    parser.add_argument(
+        "--query",
+        metavar="QUERY",
+        default=None,
+        help="Update the vault index and query it: tags, tag:NAME, links:NAME, key:NAME, search:TEXT or orphans (images no note in the note folders links to)",
+    )
+
+    parser.add_argument(
+        "--dedup-attachments",
+        choices=["report", "relink", "hardlink", "remove"],
+        default=None,
+        help="Find identical attachments across the vault and report them; relink, hardlink or remove also point every link at one copy and consolidate the rest, then exit",
+    )
+
+    parser.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="With --normalize-notes, print a diff of each change instead of writing it; with --ai-jobs, print the results (responses are still fetched and cached); with --dedup-attachments, print the links and files it would change",
+    )
+
+    parser.add_argument(
+        "--sync-h1",
+        action="store_true",
+        help="With --normalize-notes, also set each H1 to the note's file name (like the Sync H1 Title command)",
+    )
+
+    parser.add_argument(
+        "--build-bundle",
+        metavar="OUT",
+        default=None,
+        help="Pack the source tree (current directory) into a single zip with a manifest and precompiled templates, then exit",
+    )
+
+    parser.add_argument(
+        "--source-bundle",
+        metavar="BUNDLE",
+        default=None,
+        help="Read the source from a bundle made with --build-bundle instead of the current directory",
     )
 
     parser.add_argument(
@@ -602,61 +5704,277 @@ Examples:
         help="Do not overwrite existing files (skip them instead)",
     )
 
+    parser.add_argument(
+        "--force",
+        action="store_true",
+        help="Ignore the deploy manifest and rewrite every file, even if unchanged",
+    )
+
+    parser.add_argument(
+        "--jobs",
+        "-j",
+        type=int,
+        default=1,
+        help="Number of parallel workers used to copy folder contents (default: 1)",
+    )
+
+    parser.add_argument(
+        "--watch",
+        action="store_true",
+        help="After setup, watch the source tree and redeploy changed files until interrupted",
+    )
+
+    parser.add_argument(
+        "--watch-debounce",
+        type=int,
+        default=50,
+        metavar="MS",
+        help="Wait until the source tree has been quiet this many milliseconds before redeploying (default: 50)",
+    )
+
+    parser.add_argument(
+        "--watch-backend",
+        choices=["auto", "inotify", "polling"],
+        default="auto",
+        help="How to watch for changes: inotify on Linux, polling elsewhere (default: auto)",
+    )
+
+    parser.add_argument(
+        "--log-format",
+        choices=["text", "json"],
+        default="text",
+        help="Output format: human-readable text or one JSON event per line (default: text)",
+    )
+
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="Profile a setup run on a single vault with cProfile and print the slowest functions to stderr at the end",
+    )
+
+    parser.add_argument(
+        "--env-file",
+        default=None,
+        help="Load template variables from this .env file (default: .env in the source directory, if present)",
+    )
+
+    parser.add_argument(
+        "--set",
+        dest="overrides",
+        action="append",
+        default=[],
+        metavar="KEY=VALUE",
+        help="Set a template variable, overriding the environment and .env file (can be repeated)",
+    )
+
     args = parser.parse_args()
+    events = EventStream(args.log_format)
 
-    # Determine vault path from arguments
-    vault_path = args.vault_path
+    def fail(message, event="error"):
+        """Report why the run cannot go on (as an event of its own with --log-format json) and exit"""
+        events.write({"event": event, "message": message})
+        sys.exit(1)
+
+    # Determine vault paths from arguments
+    vault_paths = [Path(vault_path).resolve() for vault_path in args.vault_paths]
+    if args.vaults_file:
+        try:
+            vault_paths.extend(read_vaults_file(args.vaults_file))
+        except Exception as e:
+            fail(f"❌ Error reading vaults file: {e}")
+        if not vault_paths:
+            fail(f"❌ No vault paths found in: {args.vaults_file}")
+    vault_paths = list(dict.fromkeys(vault_paths))
 
-    if vault_path:
-        vault_path = Path(vault_path).resolve()
+    for vault_path in vault_paths:
         if not vault_path.exists():
-            print(f"❌ Vault path does not exist: {vault_path}")
-            sys.exit(1)
+            fail(f"❌ Vault path does not exist: {vault_path}")
         if not vault_path.is_dir():
-            print(f"❌ Vault path is not a directory: {vault_path}")
-            sys.exit(1)
+            fail(f"❌ Vault path is not a directory: {vault_path}")
+
+    fleet_mode = len(vault_paths) > 1 or bool(args.vaults_file)
+    vault_path = vault_paths[0] if vault_paths else None
 
     # Validate options
-    option_count = sum([args.copy, args.configure, args.ignore_files])
-    if option_count > 1:
-        print("❌ Cannot use multiple operation flags together. Use one or neither (for both copy and configure).")
-        sys.exit(1)
+    if args.jobs < 1:
+        fail("❌ --jobs must be at least 1.")
+
+    if args.backup_keep < 1:
+        fail("❌ --backup-keep must be at least 1.")
+
+    # Commands other than setup and the vaults each takes ("one", "any" or "none"); a run does one of them
+    commands = {
+        "--audit": (args.audit, "any"),
+        "--list-backups": (args.list_backups, "one"),
+        "--restore": (args.restore, "one"),
+        "--list-plugins": (args.list_plugins, "one"),
+        "--check-ignore": (args.check_ignore, "one"),
+        "--audit-sensitive": (args.audit_sensitive, "one"),
+        "--normalize-notes": (args.normalize_notes, "one"),
+        "--ai-jobs": (args.ai_jobs, "one"),
+        "--index/--query": (args.index or args.query, "one"),
+        "--dedup-attachments": (args.dedup_attachments, "one"),
+        "--build-bundle": (args.build_bundle, "none"),
+    }
+    setup_flags = {"--copy": args.copy, "--configure": args.configure, "--ignore-files": args.ignore_files, "--watch": args.watch}
+    chosen = [flag for flag, (selected, _) in commands.items() if selected]
+    if len(chosen) > 1 or (chosen and any(setup_flags.values())):
+        combined = chosen + [flag for flag, selected in setup_flags.items() if selected]
+        fail(f"❌ {', '.join(combined)} cannot be combined; run one command at a time.")
+    if chosen:
+        vaults = commands[chosen[0]][1]
+        if vaults == "one" and fleet_mode:
+            fail(f"❌ {chosen[0]} works on a single vault.")
+        if vaults == "none" and (vault_paths or args.vaults_file or args.source_bundle):
+            fail(f"❌ {chosen[0]} packs the source tree and cannot be combined with vault paths or --source-bundle.")
+
+    if args.watch and (fleet_mode or args.configure or args.ignore_files):
+        fail("❌ --watch redeploys source files to a single vault and cannot be combined with --configure, --ignore-files or several vaults.")
+
+    ai_jobs = []
+    if args.ai_jobs:
+        ai_jobs = list(dict.fromkeys(job.strip() for job in args.ai_jobs.split(",") if job.strip()))
+        unknown = [job for job in ai_jobs if job not in AI_JOBS]
+        if unknown or not ai_jobs:
+            fail(f"❌ Unknown AI job(s): {', '.join(unknown) or repr(args.ai_jobs)}. Choose from {', '.join(AI_JOBS)}.")
+
+    if args.sync_h1 and not args.normalize_notes:
+        fail("❌ --sync-h1 is only used with --normalize-notes.")
+
+    if args.dry_run and not (args.normalize_notes or args.ai_jobs or args.dedup_attachments):
+        fail("❌ --dry-run is only used with --normalize-notes, --ai-jobs or --dedup-attachments.")
+
+    if args.source_bundle and args.watch:
+        fail("❌ --watch watches a source directory and cannot be used with --source-bundle.")
+
+    if args.watch_debounce < 0:
+        fail("❌ --watch-debounce cannot be negative.")
+
+    if args.workers is not None and args.workers < 1:
+        fail("❌ --workers must be at least 1.")
+
+    if sum([args.copy, args.configure, args.ignore_files]) > 1:
+        fail("❌ Cannot use multiple operation flags together. Use one or neither (for both copy and configure).")
+
+    # Commands that only read or edit the vault (and its backups) do not need the source files
+    vault_only = any([args.list_backups, args.restore, args.list_plugins, args.check_ignore, args.audit_sensitive, args.normalize_notes, ai_jobs, args.dedup_attachments, args.index, args.query])
+
+    if args.profile and (fleet_mode or chosen):
+        fail("❌ --profile profiles a setup run on a single vault and cannot be combined with several vaults or other commands.")
 
     # Determine source path (current directory by default)
     source_path = Path.cwd()
 
+    if args.build_bundle:
+        sys.exit(0 if build_source_bundle(source_path, Path(args.build_bundle).resolve()) else 1)
+
+    source_bundle = None
+    if args.source_bundle:
+        source_bundle = str(Path(args.source_bundle).resolve())
+        try:
+            open_source_bundle(source_bundle)
+        except (OSError, ValueError) as e:
+            fail(f"❌ Cannot open source bundle: {e}")
+
     # If copying to a different vault, ensure we have source files
-    if (args.copy or (not args.copy and not args.configure and not args.ignore_files)) and vault_path and vault_path != source_path:
+    if not source_bundle and not vault_only and (args.copy or (not args.copy and not args.configure and not args.ignore_files)) and any(path != source_path for path in vault_paths):
         if not (source_path / "config.json").exists():
-            print(f"❌ Source config.json not found in: {source_path}")
-            sys.exit(1)
+            fail(f"❌ Source config.json not found in: {source_path}")
         if not (source_path / "Templater").exists():
-            print(f"❌ Source Templater folder not found in: {source_path}")
-            sys.exit(1)
+            fail(f"❌ Source Templater folder not found in: {source_path}")
         if not (source_path / ".gemini").exists():
-            print(f"❌ Source .gemini folder not found in: {source_path}")
-            sys.exit(1)
+            fail(f"❌ Source .gemini folder not found in: {source_path}")
         if not (source_path / "gemini.sh").exists():
-            print(f"❌ Source gemini.sh file not found in: {source_path}")
-            sys.exit(1)
+            fail(f"❌ Source gemini.sh file not found in: {source_path}")
         if not (source_path / "AGENTS.md.example").exists():
-            print(f"❌ Source AGENTS.md.example file not found in: {source_path}")
-            sys.exit(1)
+            fail(f"❌ Source AGENTS.md.example file not found in: {source_path}")
 
-    setup = ObsidianSetup(vault_path=vault_path, source_path=source_path, backup_existing_config=not args.no_backup, backup_directory=args.backup_dir, overwrite_existing_files=not args.no_overwrite)
+    # Build the template variable context once: environment, then .env file, then --set overrides
+    overrides = {}
+    for override in args.overrides:
+        key, separator, value = override.partition("=")
+        if not separator or not key:
+            fail(f"❌ Invalid --set value (expected KEY=VALUE): {override}")
+        overrides[key] = value
+
+    env_file = Path(args.env_file) if args.env_file else source_path / ".env"
+    if args.env_file and not env_file.is_file():
+        fail(f"❌ Env file not found: {env_file}")
 
     # Set VAULT_PATH environment variable for template substitution
-    os.environ["VAULT_PATH"] = str(setup.vault_path)
+    os.environ["VAULT_PATH"] = str(vault_path or Path.cwd())
+
+    try:
+        template_context = build_template_context(env_file if env_file.is_file() else None, overrides)
+    except Exception as e:
+        fail(f"❌ Error loading template variables: {e}")
+
+    setup_options = {
+        "source_path": source_path,
+        "backup_existing_config": not args.no_backup,
+        "backup_directory": args.backup_dir,
+        "overwrite_existing_files": not args.no_overwrite,
+        "force": args.force,
+        "jobs": args.jobs,
+        "backup_keep": args.backup_keep,
+        "backup_format": args.backup_format,
+        "obsidian_version": args.obsidian_version,
+        "source_bundle": source_bundle,
+    }
+    run_options = {"copy_files": args.copy, "configure_only": args.configure, "ignore_files_only": args.ignore_files}
 
     try:
-        success = setup.run_setup(copy_files=args.copy, configure_only=args.configure, ignore_files_only=args.ignore_files)
+        if args.audit:
+            success = run_audit(vault_paths or [Path.cwd()], setup_options, template_context, overrides, args.audit_output, args.log_format)
+        elif args.list_backups or args.restore:
+            setup = ObsidianSetup(vault_path=vault_path, template_context=template_context, events=events, **setup_options)
+            success = setup.list_backups() if args.list_backups else setup.run_exclusive("restore", lambda: setup.restore_backup(args.restore), args.restore)
+        elif args.list_plugins:
+            setup = ObsidianSetup(vault_path=vault_path, template_context=template_context, events=events, **setup_options)
+            success = setup.list_plugins()
+        elif args.normalize_notes:
+            setup = ObsidianSetup(vault_path=vault_path, template_context=template_context, events=events, **setup_options)
+            if args.dry_run:
+                success = setup.normalize_notes(True, args.sync_h1, args.workers)
+            else:
+                success = setup.run_exclusive("normalize", lambda: setup.normalize_notes(False, args.sync_h1, args.workers), args.sync_h1)
+        elif ai_jobs:
+            setup = ObsidianSetup(vault_path=vault_path, template_context=template_context, events=events, **setup_options)
+            if args.dry_run:
+                success = setup.run_ai_jobs(ai_jobs, True)
+            else:
+                success = setup.run_exclusive("ai", lambda: setup.run_ai_jobs(ai_jobs), ai_jobs)
+        elif args.dedup_attachments:
+            setup = ObsidianSetup(vault_path=vault_path, template_context=template_context, events=events, **setup_options)
+            if args.dry_run or args.dedup_attachments == "report":
+                success = setup.dedup_attachments(args.dedup_attachments, args.dry_run)
+            else:
+                success = setup.run_exclusive("dedup", lambda: setup.dedup_attachments(args.dedup_attachments), args.dedup_attachments)
+        elif args.index or args.query:
+            setup = ObsidianSetup(vault_path=vault_path, template_context=template_context, events=events, **setup_options)
+            # The update holds the vault lock (and merges with identical queued updates); the query only reads
+            success = setup.run_exclusive("index", lambda: setup.update_index().close() or True)
+            if success and args.query:
+                success = setup.query_index(args.query, update=False)
+        elif args.check_ignore or args.audit_sensitive:
+            setup = ObsidianSetup(vault_path=vault_path, template_context=template_context, events=events, **setup_options)
+            success = setup.check_ignore(args.check_ignore) if args.check_ignore else setup.audit_sensitive(args.audit_output)
+        elif fleet_mode:
+            setup_options["log_format"] = args.log_format
+            success = run_fleet(vault_paths, source_path, setup_options, run_options, template_context, overrides, workers=args.workers)
+        else:
+            setup = ObsidianSetup(vault_path=vault_path, template_context=template_context, events=events, **setup_options)
+            if args.profile:
+                success = run_profiled(setup, run_options)
+            else:
+                success = setup.run_setup(**run_options)
+            if success and args.watch:
+                success = setup.watch(args.watch_debounce / 1000, args.watch_backend)
         sys.exit(0 if success else 1)
     except KeyboardInterrupt:
-        print("\n⚠️ Setup interrupted by user.")
-        sys.exit(1)
+        fail("⚠️ Setup interrupted by user.", event="interrupted")
     except Exception as e:
-        print(f"❌ Unexpected error occurred: {e}")
-        sys.exit(1)
+        fail(f"❌ Unexpected error occurred: {e}")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,128 @@
+"""Tests for the --ai-jobs batch runner against a stub Gemini server (stdlib only)
+
+Run with: python -m unittest discover tests
+"""
+
+import asyncio
+import contextlib
+import http.server
+import io
+import json
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from pathlib import Path
+from unittest import mock
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+import setup as obsidian_setup  # noqa: E402
+
+
+class StubGeminiHandler(http.server.BaseHTTPRequestHandler):
+    """Answers generateContent calls, first failing with the (status, headers) queued in server.failures"""
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        self.server.requests.append(body)
+        if self.server.failures:
+            status, headers = self.server.failures.pop(0)
+            self.send_response(status)
+            for name, value in headers.items():
+                self.send_header(name, value)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        prompt = body["contents"][0]["parts"][0]["text"]
+        data = json.dumps({"candidates": [{"content": {"parts": [{"text": f"Summary of {len(prompt)} characters."}]}}]}).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+class AIJobsTestCase(unittest.TestCase):
+    def setUp(self):
+        self.server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), StubGeminiHandler)
+        self.server.requests = []
+        self.server.failures = []
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.settings = {**obsidian_setup.AI_DEFAULTS, "gemini_api_key": "test", "gemini_endpoint": f"http://127.0.0.1:{self.server.server_address[1]}/v1beta"}
+
+        temp = tempfile.TemporaryDirectory()
+        self.addCleanup(temp.cleanup)
+        self.temp_path = Path(temp.name)
+
+        # Keep the exponential backoff short; Retry-After is still honoured as sent
+        patcher = mock.patch.object(obsidian_setup, "AI_BACKOFF_BASE", 0.01)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def generate(self, prompt, max_retries=3):
+        """Run one generate call on a fresh runner; returns (response, runner stats, cache)"""
+        cache = obsidian_setup.AIResponseCache(self.temp_path / "cache")
+        runner = obsidian_setup.AIBatchRunner(obsidian_setup.AIClient(self.settings), cache, concurrency=2, requests_per_second=100, max_retries=max_retries, timeout=5)
+        try:
+            return asyncio.run(runner.generate("gemini", prompt)), runner.stats, cache
+        finally:
+            runner.close()
+
+    def test_retries_rate_limits_and_server_errors(self):
+        self.server.failures = [(429, {"Retry-After": "1"}), (503, {})]
+        started = time.perf_counter()
+        response, stats, _ = self.generate("Summarize this.")
+        self.assertEqual(response, "Summary of 15 characters.")
+        self.assertEqual(len(self.server.requests), 3)
+        self.assertEqual(stats, {"requests": 3, "retries": 2, "failed": 0})
+        self.assertGreaterEqual(time.perf_counter() - started, 1.0, "Retry-After was not honoured")
+
+    def test_gives_up_after_max_retries(self):
+        self.server.failures = [(503, {})] * 3
+        with self.assertRaisesRegex(RuntimeError, "gave up after 3 attempts"):
+            self.generate("Summarize this.", max_retries=2)
+        self.assertEqual(len(self.server.requests), 3)
+
+    def test_rerun_is_served_from_cache(self):
+        first, _, first_cache = self.generate("Summarize this.")
+        second, stats, cache = self.generate("Summarize this.")
+        self.assertEqual(second, first)
+        self.assertEqual((first_cache.misses, cache.hits), (1, 1))
+        self.assertEqual(stats["requests"], 0)
+        self.assertEqual(len(self.server.requests), 1)
+
+    def test_run_ai_jobs_rewrites_nothing_on_rerun(self):
+        vault = self.temp_path / "vault"
+        (vault / "Notes").mkdir(parents=True)
+        config = {"paths": {"note_directories": ["Notes"], "clipping_directories": []}, "ai": {**self.settings, "batch": {"concurrency": 2, "requests_per_second": 100, "max_retries": 3}}}
+        (vault / "config.json").write_text(json.dumps(config), encoding="utf-8")
+        for index in range(3):
+            (vault / "Notes" / f"note{index}.md").write_text(f"# Note {index}\n\nSome text about topic {index}.\n", encoding="utf-8")
+        self.server.failures = [(429, {"Retry-After": "0"}), (502, {})]
+
+        def run():
+            setup = obsidian_setup.ObsidianSetup(vault_path=vault, source_path=ROOT)
+            with contextlib.redirect_stdout(io.StringIO()):
+                return setup.run_ai_jobs(["summarize"])
+
+        self.assertTrue(run())
+        self.assertEqual(len(self.server.requests), 5)
+        notes = {path.name: path.read_text(encoding="utf-8") for path in (vault / "Notes").iterdir()}
+        for name, text in notes.items():
+            self.assertTrue(text.startswith("---\nsummary: "), name)
+
+        self.assertTrue(run())
+        self.assertEqual(len(self.server.requests), 5, "the re-run sent requests instead of using the cache")
+        self.assertEqual({path.name: path.read_text(encoding="utf-8") for path in (vault / "Notes").iterdir()}, notes)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,143 @@
+"""Tests for the backup stores: BackupStore (objects and snapshots), ArchiveBackupStore and BackupCatalog
+
+Run with: python -m unittest discover tests
+"""
+
+import contextlib
+import io
+import os
+import sys
+import tarfile
+import tempfile
+import unittest
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+import setup as obsidian_setup  # noqa: E402
+
+
+class BackupTestCase(unittest.TestCase):
+    def setUp(self):
+        temp = tempfile.TemporaryDirectory()
+        self.addCleanup(temp.cleanup)
+        self.temp_path = Path(temp.name)
+        self.vault = self.temp_path / "vault"
+        self.vault.mkdir()
+        self.root = self.temp_path / "backup"
+
+    def back_up(self, store, files):
+        """Back up {vault-relative path: text} in one snapshot and return its id"""
+        for relative, text in files.items():
+            path = self.vault / relative
+            path.parent.mkdir(parents=True, exist_ok=True)
+            path.write_text(text, encoding="utf-8")
+            store.add(path, relative)
+        return store.commit(self.vault)
+
+    def restore(self, store, reference, relative):
+        """Extract one file of a snapshot and return its text"""
+        snapshot = store.find_snapshot(reference)
+        self.assertIsNotNone(snapshot, reference)
+        self.assertTrue(store.has(snapshot, relative))
+        target = self.temp_path / "restored"
+        store.extract(snapshot, relative, target)
+        return target.read_text(encoding="utf-8")
+
+    def objects(self):
+        return sorted(path.name for path in (self.root / "objects").rglob("*") if path.is_file())
+
+
+class BackupStoreTestCase(BackupTestCase):
+    def test_contents_are_stored_once_and_every_version_restores(self):
+        store = obsidian_setup.BackupStore(self.root)
+        first = self.back_up(store, {"config.json": "v1", "Templater/a.md": "same"})
+        second = self.back_up(store, {"config.json": "v2", "Templater/a.md": "same"})
+        self.assertEqual(len(self.objects()), 3)
+        self.assertEqual(self.restore(store, first, "config.json"), "v1")
+        self.assertEqual(self.restore(store, second, "config.json"), "v2")
+        self.assertEqual(self.restore(store, "latest", "Templater/a.md"), "same")
+        self.assertIsNone(store.commit(self.vault), "an empty run must not write a snapshot")
+
+    def test_prune_keeps_the_newest_snapshots_and_their_objects(self):
+        store = obsidian_setup.BackupStore(self.root)
+        ids = [self.back_up(store, {"config.json": f"v{index}", "shared.md": "same"}) for index in range(3)]
+        self.assertEqual(store.prune(2), (1, 1))
+        self.assertEqual([snapshot["id"] for snapshot in store.list_snapshots()], ids[1:])
+        self.assertIsNone(store.find_snapshot(ids[0]))
+        self.assertEqual(self.restore(store, ids[1], "config.json"), "v1")
+        self.assertEqual(self.restore(store, ids[1], "shared.md"), "same")
+        self.assertEqual(store.prune(2), (0, 0))
+
+    def test_prune_keeps_every_object_while_a_manifest_is_unreadable(self):
+        store = obsidian_setup.BackupStore(self.root)
+        ids = [self.back_up(store, {"config.json": f"v{index}"}) for index in range(3)]
+        (self.root / "snapshots" / f"{ids[2]}.json").write_text("{not json", encoding="utf-8")
+        with contextlib.redirect_stderr(io.StringIO()):
+            removed = store.prune(1)
+        self.assertEqual(removed, (1, 0))
+        self.assertEqual(len(self.objects()), 3)
+
+    def test_discard_drops_the_pending_snapshot(self):
+        store = obsidian_setup.BackupStore(self.root)
+        (self.vault / "a.md").write_text("a", encoding="utf-8")
+        store.add(self.vault / "a.md", "a.md")
+        store.discard()
+        self.assertIsNone(store.commit(self.vault))
+        self.assertEqual(store.collect_garbage(), 1)
+
+
+class ArchiveBackupStoreTestCase(BackupTestCase):
+    def test_single_members_are_extracted_from_the_archive(self):
+        store = obsidian_setup.ArchiveBackupStore(self.root)
+        big = "".join(f"line {index}\n" for index in range(50000))
+        snapshot_id = self.back_up(store, {"config.json": "v1", "Templater/big.md": big, "empty.md": ""})
+        self.assertEqual(self.restore(store, snapshot_id, "Templater/big.md"), big)
+        self.assertEqual(self.restore(store, snapshot_id, "config.json"), "v1")
+        self.assertEqual(self.restore(store, snapshot_id, "empty.md"), "")
+
+    def test_archive_is_a_valid_tar_gz(self):
+        store = obsidian_setup.ArchiveBackupStore(self.root)
+        snapshot_id = self.back_up(store, {"a.md": "a", "b/c.md": "c"})
+        with tarfile.open(store.archive_path(snapshot_id), "r:gz") as tar:
+            self.assertEqual(sorted(tar.getnames()), ["a.md", "b/c.md"])
+            self.assertEqual(tar.extractfile("b/c.md").read(), b"c")
+
+    def test_prune_rotates_generations(self):
+        store = obsidian_setup.ArchiveBackupStore(self.root)
+        ids = [self.back_up(store, {"config.json": f"v{index}"}) for index in range(3)]
+        self.assertEqual(store.prune(1), (2, 0))
+        self.assertEqual(sorted(os.listdir(self.root / "archives")), [f"{ids[2]}.index.json", f"{ids[2]}.tar.gz"])
+        self.assertEqual(self.restore(store, "latest", "config.json"), "v2")
+
+    def test_discard_removes_the_unfinished_archive(self):
+        store = obsidian_setup.ArchiveBackupStore(self.root)
+        (self.vault / "a.md").write_text("a", encoding="utf-8")
+        store.add(self.vault / "a.md", "a.md")
+        store.discard()
+        self.assertIsNone(store.commit(self.vault))
+        self.assertEqual(os.listdir(self.root / "archives"), [])
+
+
+class BackupCatalogTestCase(BackupTestCase):
+    def test_lists_restores_and_prunes_both_formats(self):
+        store_id = self.back_up(obsidian_setup.BackupCatalog(self.root, "store"), {"config.json": "from store"})
+        archive_id = self.back_up(obsidian_setup.BackupCatalog(self.root, "archive"), {"config.json": "from archive"})
+        newest_id = self.back_up(obsidian_setup.BackupCatalog(self.root, "store"), {"config.json": "newest"})
+        self.assertEqual(len({store_id, archive_id, newest_id}), 3, "snapshot ids must be unique across formats")
+
+        catalog = obsidian_setup.BackupCatalog(self.root, "store")
+        self.assertEqual([(snapshot["id"], snapshot["format"]) for snapshot in catalog.list_snapshots()], [(store_id, "store"), (archive_id, "archive"), (newest_id, "store")])
+        self.assertEqual(self.restore(catalog, store_id, "config.json"), "from store")
+        self.assertEqual(self.restore(catalog, archive_id, "config.json"), "from archive")
+
+        self.assertEqual(catalog.prune(2), (1, 1))
+        self.assertEqual([snapshot["id"] for snapshot in catalog.list_snapshots()], [archive_id, newest_id])
+        self.assertEqual(self.restore(catalog, "latest", "config.json"), "newest")
+        self.assertEqual(catalog.prune(1), (1, 0))
+        self.assertFalse(any((self.root / "archives").iterdir()))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,111 @@
+"""Tests for --dedup-attachments: DuplicateScanner, the choice of the copy that is kept, and relinking
+
+Run with: python -m unittest discover tests
+"""
+
+import contextlib
+import io
+import os
+import sys
+import tempfile
+import unittest
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+import setup as obsidian_setup  # noqa: E402
+
+PNG = b"\x89PNG\r\n\x1a\n" + bytes(range(256)) * 4
+
+
+class DedupTestCase(unittest.TestCase):
+    def setUp(self):
+        temp = tempfile.TemporaryDirectory()
+        self.addCleanup(temp.cleanup)
+        self.vault = Path(temp.name)
+
+    def write(self, relative, data):
+        path = self.vault / relative
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(data if isinstance(data, bytes) else data.encode("utf-8"))
+        return path
+
+    def scan(self, paths):
+        scanner = obsidian_setup.DuplicateScanner(self.vault, self.vault / "dedup.json", jobs=2)
+        return scanner.scan([(path, os.stat(self.vault / path)) for path in paths]), scanner.stats
+
+    def dedup(self, mode):
+        setup = obsidian_setup.ObsidianSetup(vault_path=self.vault, source_path=ROOT)
+        with contextlib.redirect_stdout(io.StringIO()):
+            return setup.dedup_attachments(mode)
+
+    def test_scanner_groups_identical_files_only(self):
+        self.write("a.png", PNG)
+        self.write("sub/b.png", PNG)
+        self.write("c.png", PNG[:-1] + b"x")  # same size, different last byte
+        self.write("d.png", PNG + b"tail")
+        self.write("empty1.png", b"")
+        self.write("empty2.png", b"")
+        groups, stats = self.scan(["a.png", "sub/b.png", "c.png", "d.png", "empty1.png", "empty2.png"])
+        self.assertEqual(groups, [["a.png", "sub/b.png"]])
+        self.assertEqual(stats["candidates"], 3)
+
+    def test_large_files_are_hashed_in_full_and_cached(self):
+        size = 2 * obsidian_setup.DEDUP_BLOCK_SIZE + 10
+        same = os.urandom(size)
+        middle = bytearray(same)
+        middle[size // 2] ^= 0xFF  # differs only outside the first and last block
+        self.write("one.bin", same)
+        self.write("two.bin", same)
+        self.write("three.bin", bytes(middle))
+        groups, stats = self.scan(["one.bin", "two.bin", "three.bin"])
+        self.assertEqual(groups, [["one.bin", "two.bin"]])
+        self.assertEqual(stats["fully_hashed"], 3)
+
+        groups, stats = self.scan(["one.bin", "two.bin", "three.bin"])
+        self.assertEqual(groups, [["one.bin", "two.bin"]])
+        self.assertEqual((stats["ends_hashed"], stats["fully_hashed"], stats["cached"]), (0, 0, 6))
+
+    def test_hard_links_count_as_one_file(self):
+        self.write("a.png", PNG)
+        os.link(self.vault / "a.png", self.vault / "b.png")
+        groups, _ = self.scan(["a.png", "b.png"])
+        self.assertEqual(groups, [])
+
+    def test_relink_keeps_the_named_copy_with_the_shortest_path(self):
+        self.write("Attachments/Pasted image 20240101120000.png", PNG)
+        self.write("Attachments/Deep/Folder/figure.png", PNG)
+        self.write("Attachments/diagram.png", PNG)
+        self.write("Notes/a.md", "![[Pasted image 20240101120000.png]]\n![[figure.png|300]]\n")
+        self.write("Notes/b.md", "![alt](../Attachments/Pasted%20image%2020240101120000.png)\n")
+        self.write("Notes/c.md", "No links here.\n")
+
+        self.assertTrue(self.dedup("relink"))
+        self.assertEqual((self.vault / "Notes/a.md").read_text(encoding="utf-8"), "![[diagram.png]]\n![[diagram.png|300]]\n")
+        self.assertEqual((self.vault / "Notes/b.md").read_text(encoding="utf-8"), "![alt](../Attachments/diagram.png)\n")
+        self.assertEqual((self.vault / "Notes/c.md").read_text(encoding="utf-8"), "No links here.\n")
+        # relink leaves the duplicates in place
+        self.assertTrue((self.vault / "Attachments/Pasted image 20240101120000.png").exists())
+
+    def test_remove_deletes_duplicates_after_relinking(self):
+        self.write("Attachments/Pasted image 20240101120000.png", PNG)
+        self.write("Attachments/photo.png", PNG)
+        self.write("Notes/a.md", "![[Pasted image 20240101120000.png]]\n")
+
+        self.assertTrue(self.dedup("remove"))
+        self.assertEqual((self.vault / "Notes/a.md").read_text(encoding="utf-8"), "![[photo.png]]\n")
+        self.assertFalse((self.vault / "Attachments/Pasted image 20240101120000.png").exists())
+        self.assertTrue((self.vault / "Attachments/photo.png").exists())
+
+    def test_hardlink_replaces_duplicates_with_links_to_the_kept_copy(self):
+        self.write("Attachments/photo.png", PNG)
+        self.write("Other/photo-copy.png", PNG)
+
+        self.assertTrue(self.dedup("hardlink"))
+        kept, duplicate = os.stat(self.vault / "Attachments/photo.png"), os.stat(self.vault / "Other/photo-copy.png")
+        self.assertEqual((kept.st_dev, kept.st_ino), (duplicate.st_dev, duplicate.st_ino))
+
+
+if __name__ == "__main__":
+    unittest.main()
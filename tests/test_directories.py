@@ -0,0 +1,75 @@
+"""Tests for expand_directory_entries, which expands the folder globs of paths.note_directories
+
+Run with: python -m unittest discover tests
+"""
+
+import sys
+import unittest
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+import setup as obsidian_setup  # noqa: E402
+
+DIRECTORIES = [
+    "Daily",
+    "Projects",
+    "Projects/Alpha",
+    "Projects/Alpha/Notes",
+    "Projects/Beta",
+    "Projects/Beta/Notes",
+    "Projects/Beta/Notes/Old",
+    "Archive",
+    "Archive/2023",
+    "Archive/2023/Notes",
+    "Notes",
+    "[draft]",
+]
+
+
+def expand(entries, directories=DIRECTORIES):
+    return obsidian_setup.expand_directory_entries(entries, directories)
+
+
+class ExpandDirectoryEntriesTestCase(unittest.TestCase):
+    def test_literal_entries_are_kept_even_if_missing(self):
+        self.assertEqual(expand(["Daily", "Inbox/"]), [("Daily", 0), ("Inbox", 1)])
+
+    def test_single_level_wildcards(self):
+        self.assertEqual(expand(["Projects/*/Notes"]), [("Projects/Alpha/Notes", 0), ("Projects/Beta/Notes", 0)])
+        self.assertEqual(expand(["Projects/?eta"]), [("Projects/Beta", 0)])
+        self.assertEqual(expand(["Projects/[A]*"]), [("Projects/Alpha", 0)])
+        self.assertEqual(expand(["Projects/[!A]*"]), [("Projects/Beta", 0)])
+
+    def test_double_star_matches_any_number_of_folders(self):
+        self.assertEqual(expand(["**/Notes"]), [("Archive/2023/Notes", 0), ("Notes", 0), ("Projects/Alpha/Notes", 0), ("Projects/Beta/Notes", 0)])
+        self.assertEqual(expand(["Projects/**"]), [("Projects", 0), ("Projects/Alpha", 0), ("Projects/Alpha/Notes", 0), ("Projects/Beta", 0), ("Projects/Beta/Notes", 0), ("Projects/Beta/Notes/Old", 0)])
+
+    def test_literal_entry_beats_any_glob(self):
+        self.assertEqual(expand(["**/Notes", "Projects/Beta/Notes"]), [("Archive/2023/Notes", 0), ("Notes", 0), ("Projects/Alpha/Notes", 0), ("Projects/Beta/Notes", 1)])
+
+    def test_more_specific_glob_wins(self):
+        # More literal folder names first, then more literal characters
+        result = dict(expand(["**/Notes", "Projects/*/Notes", "Projects/B*/Notes"]))
+        self.assertEqual(result, {"Archive/2023/Notes": 0, "Notes": 0, "Projects/Alpha/Notes": 1, "Projects/Beta/Notes": 2})
+
+    def test_ties_go_to_the_earlier_entry(self):
+        self.assertEqual(expand(["Projects/A*", "Projects/*a"]), [("Projects/Alpha", 0), ("Projects/Beta", 1)])
+
+    def test_results_are_grouped_by_entry_in_config_order(self):
+        self.assertEqual(expand(["Archive/*", "Daily", "Projects/*"]), [("Archive/2023", 0), ("Daily", 1), ("Projects/Alpha", 2), ("Projects/Beta", 2)])
+
+    def test_bracket_class_matches_a_literal_bracket(self):
+        self.assertEqual(expand(["[[]draft]"]), [("[draft]", 0)])
+
+    def test_directories_are_only_read_for_globs(self):
+        def directories():
+            raise AssertionError("directories were listed for literal entries")
+            yield
+
+        self.assertEqual(expand(["Daily", "Notes"], directories()), [("Daily", 0), ("Notes", 1)])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,118 @@
+"""Tests for IgnoreMatcher against gitignore semantics, cross-checked with git check-ignore where git is installed
+
+Run with: python -m unittest discover tests
+"""
+
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+import setup as obsidian_setup  # noqa: E402
+
+PATTERNS = [
+    "# comment",
+    "*.log",
+    "!keep.log",
+    "logs/",
+    "!logs/important.log",
+    "build/",
+    "/root-only.md",
+    "Private/**/secret.md",
+    "Drafts/*",
+    "!Drafts/ready.md",
+    "\\!bang.md",
+    "trailing.md   ",
+    "[Tt]mp?/",
+    "notes/**",
+]
+
+# (path, is a directory, ignored)
+CASES = [
+    ("debug.log", False, True),
+    ("deep/dir/debug.log", False, True),
+    ("keep.log", False, False),
+    ("deep/keep.log", False, False),
+    # git never looks inside an ignored directory, so a negation cannot re-include its files
+    ("logs/important.log", False, True),
+    ("logs/a.md", False, True),
+    ("logs", True, True),
+    # Directory-only patterns match directories (and what is inside them), not files of that name
+    ("build", True, True),
+    ("build", False, False),
+    ("build/out.js", False, True),
+    ("src/build/out.js", False, True),
+    ("root-only.md", False, True),
+    ("sub/root-only.md", False, False),
+    ("Private/secret.md", False, True),
+    ("Private/a/b/secret.md", False, True),
+    ("Private/a/other.md", False, False),
+    ("Drafts/wip.md", False, True),
+    ("Drafts/ready.md", False, False),
+    ("Drafts/sub/ready.md", False, True),
+    ("!bang.md", False, True),
+    ("bang.md", False, False),
+    ("trailing.md", False, True),
+    ("tmp1/x.md", False, True),
+    ("Tmp2/x.md", False, True),
+    ("tmp/x.md", False, False),
+    ("notes/a/b.md", False, True),
+    ("notes", True, False),
+    ("readme.md", False, False),
+]
+
+
+class IgnoreMatcherTestCase(unittest.TestCase):
+    def setUp(self):
+        self.matcher = obsidian_setup.IgnoreMatcher(PATTERNS)
+
+    def test_gitignore_rules(self):
+        for path, is_dir, ignored in CASES:
+            with self.subTest(path=path, is_dir=is_dir):
+                rule = self.matcher.match(path, is_dir)
+                self.assertEqual(rule is not None and not rule["negated"], ignored, rule)
+
+    def test_match_reports_the_deciding_rule(self):
+        self.assertEqual(self.matcher.match("deep/keep.log")["pattern"], "!keep.log")
+        self.assertEqual(self.matcher.match("logs/important.log")["pattern"], "logs/")
+        self.assertEqual(self.matcher.match("./Drafts/wip.md")["pattern"], "Drafts/*")
+        self.assertIsNone(self.matcher.match("readme.md"))
+
+    def test_filter_ignored_agrees_with_match(self):
+        files = [path for path, is_dir, _ in CASES if not is_dir]
+        expected = [path for path, is_dir, ignored in CASES if not is_dir and ignored]
+        self.assertEqual(self.matcher.filter_ignored(files), expected)
+
+    @unittest.skipUnless(shutil.which("git"), "git is not installed")
+    def test_agrees_with_git_check_ignore(self):
+        with tempfile.TemporaryDirectory() as temp:
+            repo = Path(temp)
+            subprocess.run(["git", "init", "-q", str(repo)], check=True)
+            (repo / ".gitignore").write_text("\n".join(PATTERNS) + "\n", encoding="utf-8")
+            paths = []
+            for path, is_dir, _ in CASES:
+                if (repo / path).exists() and (repo / path).is_dir() != is_dir:
+                    continue  # a name cannot be a file and a directory in one tree
+                if is_dir:
+                    (repo / path).mkdir(parents=True, exist_ok=True)
+                else:
+                    (repo / path).parent.mkdir(parents=True, exist_ok=True)
+                    (repo / path).touch()
+                paths.append((path, is_dir))
+
+            result = subprocess.run(["git", "check-ignore", "--no-index", "--stdin"], cwd=repo, input="\n".join(path for path, _ in paths) + "\n", capture_output=True, text=True)
+            self.assertIn(result.returncode, (0, 1), result.stderr)
+            ignored_by_git = set(result.stdout.splitlines())
+            for path, is_dir in paths:
+                with self.subTest(path=path, is_dir=is_dir):
+                    rule = self.matcher.match(path, is_dir)
+                    self.assertEqual(rule is not None and not rule["negated"], path in ignored_by_git)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,66 @@
+"""Tests for merkle_diff, the tree comparison behind --audit
+
+Run with: python -m unittest discover tests
+"""
+
+import sys
+import unittest
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+import setup as obsidian_setup  # noqa: E402
+
+TREE = {
+    "config.json": "c1",
+    "Templater/New Note.md": "n1",
+    "Templater/Scripts/parseFile.js": "p1",
+    "Templater/Scripts/renameImages.js": "r1",
+    "snippets/a.css": "a1",
+}
+
+
+class MerkleDiffTestCase(unittest.TestCase):
+    def test_identical_trees_have_no_differences(self):
+        self.assertEqual(obsidian_setup.merkle_diff(TREE, dict(TREE)), [])
+        self.assertEqual(obsidian_setup.merkle_diff({}, {}), [])
+
+    def test_reports_missing_modified_and_extra_files(self):
+        actual = dict(TREE)
+        del actual["Templater/Scripts/renameImages.js"]
+        actual["Templater/Scripts/parseFile.js"] = "p2"
+        actual["snippets/b.css"] = "b1"
+        self.assertEqual(
+            obsidian_setup.merkle_diff(TREE, actual),
+            [("Templater/Scripts/parseFile.js", "modified"), ("Templater/Scripts/renameImages.js", "missing"), ("snippets/b.css", "extra")],
+        )
+
+    def test_whole_missing_and_extra_directories(self):
+        actual = {path: digest for path, digest in TREE.items() if not path.startswith("Templater/")}
+        actual["Other/deep/x.md"] = "x1"
+        self.assertEqual(
+            obsidian_setup.merkle_diff(TREE, actual),
+            [("Other/deep/x.md", "extra"), ("Templater/New Note.md", "missing"), ("Templater/Scripts/parseFile.js", "missing"), ("Templater/Scripts/renameImages.js", "missing")],
+        )
+
+    def test_file_replaced_by_a_directory(self):
+        actual = dict(TREE)
+        del actual["config.json"]
+        actual["config.json/inner.json"] = "c1"
+        self.assertEqual(obsidian_setup.merkle_diff(TREE, actual), [("config.json", "missing"), ("config.json/inner.json", "extra")])
+
+    def test_a_moved_file_is_not_unchanged(self):
+        # Same content under another name changes the parent's hash even though the set of hashes is equal
+        actual = dict(TREE)
+        actual["snippets/renamed.css"] = actual.pop("snippets/a.css")
+        self.assertEqual(obsidian_setup.merkle_diff(TREE, actual), [("snippets/a.css", "missing"), ("snippets/renamed.css", "extra")])
+
+    def test_merkle_tree_root_changes_with_any_file(self):
+        root = obsidian_setup.merkle_tree(TREE)[""]
+        self.assertEqual(obsidian_setup.merkle_tree(dict(reversed(list(TREE.items()))))[""], root)
+        self.assertNotEqual(obsidian_setup.merkle_tree({**TREE, "snippets/a.css": "a2"})[""], root)
+
+
+if __name__ == "__main__":
+    unittest.main()
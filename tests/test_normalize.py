@@ -0,0 +1,79 @@
+"""Tests for the --normalize-notes rules, which mirror FileParser.parse and reassemble() in parseFile.js
+
+Run with: python -m unittest discover tests
+"""
+
+import contextlib
+import io
+import sys
+import tempfile
+import unittest
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+import setup as obsidian_setup  # noqa: E402
+
+
+class NormalizeNoteTestCase(unittest.TestCase):
+    def test_adds_a_missing_h1_from_the_file_name(self):
+        # Like the script, the content of a note without an H1 is trimmed
+        self.assertEqual(obsidian_setup.normalize_note("Some text.\n", "My Note"), ("# My Note\n\nSome text.", "added H1"))
+        self.assertEqual(obsidian_setup.normalize_note("", "Empty"), ("# Empty\n", "added H1"))
+
+    def test_frontmatter_is_kept_byte_for_byte(self):
+        text = "---\ntags: [a,  b]\nalias:   x\n---\nBody\n"
+        new_text, reason = obsidian_setup.normalize_note(text, "Note")
+        self.assertEqual(new_text, "---\ntags: [a,  b]\nalias:   x\n---\n\n# Note\n\nBody")
+        self.assertEqual(reason, "added H1")
+
+    def test_note_with_an_h1_is_left_alone(self):
+        for text in ("# Title\n\nBody\n", "---\na: 1\n---\n\n# Other title\nBody", "\n\n#   Spaced   \n\nBody\n"):
+            with self.subTest(text=text):
+                self.assertEqual(obsidian_setup.normalize_note(text, "Note"), (None, None))
+
+    def test_sync_title_rewrites_an_h1_that_differs_from_the_file_name(self):
+        self.assertEqual(obsidian_setup.normalize_note("# Old\n\nBody\n", "New", sync_title=True), ("# New\n\nBody\n", "synced H1 with file name"))
+        self.assertEqual(obsidian_setup.normalize_note("# Same\n\nBody\n", "Same", sync_title=True), (None, None))
+
+    def test_h2_is_not_a_title(self):
+        self.assertEqual(obsidian_setup.normalize_note("## Section\n", "Note"), ("# Note\n\n## Section", "added H1"))
+
+    def test_parse_note_splits_frontmatter_title_and_content(self):
+        self.assertEqual(obsidian_setup.parse_note("---\na: 1\n---\n# T\n\nBody\n"), ("---\na: 1\n---", "T", "Body\n"))
+        self.assertEqual(obsidian_setup.parse_note("  Body  \n"), ("", "", "Body"))
+        # JavaScript's "." stops at U+2028, so the title does too
+        self.assertEqual(obsidian_setup.parse_note("# A\u2028B")[1], "A")
+
+    def test_normalize_is_idempotent(self):
+        for text in ("Body\n", "---\na: 1\n---\nBody", "\n\nBody\n\n"):
+            with self.subTest(text=text):
+                new_text, _ = obsidian_setup.normalize_note(text, "Note")
+                self.assertEqual(obsidian_setup.normalize_note(new_text, "Note"), (None, None))
+
+
+class NormalizeNotesTestCase(unittest.TestCase):
+    def test_rewrites_notes_in_the_note_folders_only(self):
+        with tempfile.TemporaryDirectory() as temp:
+            vault = Path(temp)
+            (vault / "Notes").mkdir()
+            (vault / "Elsewhere").mkdir()
+            (vault / "config.json").write_text('{"paths": {"note_directories": ["Notes"], "clipping_directories": []}}', encoding="utf-8")
+            (vault / "Notes" / "Plain.md").write_text("Text\n", encoding="utf-8")
+            (vault / "Notes" / "Titled.md").write_text("# Titled\n\nText\n", encoding="utf-8")
+            (vault / "Elsewhere" / "Other.md").write_text("Text\n", encoding="utf-8")
+
+            setup = obsidian_setup.ObsidianSetup(vault_path=vault, source_path=ROOT)
+            with contextlib.redirect_stdout(io.StringIO()):
+                self.assertTrue(setup.normalize_notes(dry_run=True, workers=1))
+                self.assertEqual((vault / "Notes" / "Plain.md").read_text(encoding="utf-8"), "Text\n")
+                self.assertTrue(setup.normalize_notes(workers=1))
+
+            self.assertEqual((vault / "Notes" / "Plain.md").read_text(encoding="utf-8"), "# Plain\n\nText")
+            self.assertEqual((vault / "Notes" / "Titled.md").read_text(encoding="utf-8"), "# Titled\n\nText\n")
+            self.assertEqual((vault / "Elsewhere" / "Other.md").read_text(encoding="utf-8"), "Text\n")
+
+
+if __name__ == "__main__":
+    unittest.main()
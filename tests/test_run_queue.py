@@ -0,0 +1,116 @@
+"""Tests for VaultRunQueue: runs against one vault take turns, and identical queued runs are merged
+
+Run with: python -m unittest discover tests
+"""
+
+import json
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from pathlib import Path
+from types import SimpleNamespace
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+import setup as obsidian_setup  # noqa: E402
+
+
+@unittest.skipIf(obsidian_setup.fcntl is None, "runs are only locked where fcntl is available")
+class VaultRunQueueTestCase(unittest.TestCase):
+    def setUp(self):
+        temp = tempfile.TemporaryDirectory()
+        self.addCleanup(temp.cleanup)
+        self.vault = Path(temp.name)
+        self.ran = []
+        self.ran_lock = threading.Lock()
+
+    def work(self, name, result=True, release=None):
+        """Return work() that records it ran, optionally waiting for release first"""
+
+        def run():
+            if release is not None:
+                release.wait(10)
+            with self.ran_lock:
+                self.ran.append(name)
+            return result
+
+        return run
+
+    def start(self, name, signature="setup", result=True, release=None):
+        """Run a queue in a thread; returns its thread, queue, results and an event set once it holds the lock"""
+        run = SimpleNamespace(queue=obsidian_setup.VaultRunQueue(self.vault, signature), results=[], acquired=threading.Event())
+        run.thread = threading.Thread(target=lambda: run.results.append(run.queue.run(self.work(name, result, release), lambda queue: run.acquired.set())))
+        run.thread.start()
+        self.addCleanup(run.thread.join, 10)
+        return run
+
+    def hold_lock(self, name, **options):
+        """Start a run that holds the vault lock until the returned event is set"""
+        release = threading.Event()
+        run = self.start(name, release=release, **options)
+        self.assertTrue(run.acquired.wait(10))
+        return run, release
+
+    def wait_for_tickets(self, signature, issued):
+        """Wait until runs of signature have taken issued tickets (the later ones are then blocked on the lock)"""
+        deadline = time.monotonic() + 10
+        while time.monotonic() < deadline:
+            try:
+                with open(self.vault / obsidian_setup.STATE_DIRNAME / obsidian_setup.VaultRunQueue.QUEUE_FILENAME, "r", encoding="utf-8") as f:
+                    if json.load(f).get(signature, {}).get("issued") == issued:
+                        return
+            except (FileNotFoundError, ValueError):
+                pass
+            time.sleep(0.01)
+        self.fail(f"runs did not queue up: expected {issued} tickets")
+
+    def test_identical_runs_queued_behind_a_run_are_merged_into_one(self):
+        first, release = self.hold_lock("first")
+        queued = [self.start(name) for name in ("second", "third")]
+        self.wait_for_tickets("setup", 3)
+        release.set()
+        for run in [first] + queued:
+            run.thread.join(10)
+
+        # One of the queued runs does the work for both; the other finds it done
+        self.assertEqual(len(self.ran), 2)
+        self.assertEqual(self.ran[0], "first")
+        self.assertEqual([run.results for run in queued], [[True], [True]])
+        self.assertEqual(sorted(run.queue.coalesced for run in queued), [False, True])
+        self.assertEqual(sorted(run.queue.merged for run in queued), [0, 1])
+        self.assertGreater(max(run.queue.wait for run in queued), 0)
+
+    def test_runs_with_different_signatures_are_not_merged(self):
+        first, release = self.hold_lock("first")
+        others = [self.start("other", signature="restore"), self.start("same")]
+        self.wait_for_tickets("restore", 1)
+        self.wait_for_tickets("setup", 2)
+        release.set()
+        for run in [first] + others:
+            run.thread.join(10)
+        self.assertEqual(sorted(self.ran), ["first", "other", "same"])
+
+    def test_a_failed_run_covers_nobody(self):
+        failing, release = self.hold_lock("failing", result=False)
+        queued = self.start("queued")
+        self.wait_for_tickets("setup", 2)
+        release.set()
+        failing.thread.join(10)
+        queued.thread.join(10)
+        self.assertEqual(self.ran, ["failing", "queued"])
+        self.assertEqual((failing.results, queued.results), ([False], [True]))
+        self.assertFalse(queued.queue.coalesced)
+
+    def test_runs_one_after_another_all_do_their_work(self):
+        for name in ("first", "second"):
+            queue = obsidian_setup.VaultRunQueue(self.vault, "setup")
+            self.assertTrue(queue.run(self.work(name)))
+            self.assertFalse(queue.coalesced)
+        self.assertEqual(self.ran, ["first", "second"])
+
+
+if __name__ == "__main__":
+    unittest.main()
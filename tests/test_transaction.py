@@ -0,0 +1,119 @@
+"""Tests for VaultTransaction: commit, rollback and recovery of a run interrupted mid-commit
+
+Run with: python -m unittest discover tests
+"""
+
+import os
+import sys
+import tempfile
+import unittest
+from pathlib import Path
+from unittest import mock
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+import setup as obsidian_setup  # noqa: E402
+
+
+class VaultTransactionTestCase(unittest.TestCase):
+    def setUp(self):
+        temp = tempfile.TemporaryDirectory()
+        self.addCleanup(temp.cleanup)
+        self.vault = Path(temp.name)
+        (self.vault / "a.md").write_text("old a", encoding="utf-8")
+        (self.vault / "b.md").write_text("old b", encoding="utf-8")
+
+    def stage_writes(self):
+        """Open a transaction that replaces a.md and b.md and creates c.md"""
+        transaction = obsidian_setup.VaultTransaction(self.vault, obsidian_setup.FileSystemSnapshot())
+        for name in ("a.md", "b.md", "c.md"):
+            transaction.stage(self.vault / name, lambda fd, name=name: os.write(fd, f"new {name[0]}".encode("utf-8")))
+        return transaction
+
+    def contents(self):
+        """Return {name: text} of the vault root, ignoring the state folder"""
+        return {path.name: path.read_text(encoding="utf-8") for path in self.vault.iterdir() if path.is_file()}
+
+    def test_staged_writes_are_invisible_until_commit(self):
+        transaction = self.stage_writes()
+        staged = transaction.staged_path(self.vault / "a.md")
+        self.assertEqual(Path(staged).read_text(encoding="utf-8"), "new a")
+        self.assertEqual((self.vault / "a.md").read_text(encoding="utf-8"), "old a")
+        self.assertFalse((self.vault / "c.md").exists())
+
+        self.assertEqual(transaction.commit(), 3)
+        self.assertEqual(self.contents(), {"a.md": "new a", "b.md": "new b", "c.md": "new c"})
+        self.assertEqual(transaction.state, "committed")
+        self.assertFalse(transaction.journal_path.exists())
+
+    def test_rollback_discards_staged_files(self):
+        transaction = self.stage_writes()
+        self.assertEqual(transaction.rollback(), 3)
+        self.assertEqual(self.contents(), {"a.md": "old a", "b.md": "old b"})
+        with self.assertRaises(RuntimeError):
+            transaction.stage(self.vault / "a.md", lambda fd: os.write(fd, b"late"))
+
+    def test_failed_commit_undoes_the_renames_already_made(self):
+        transaction = self.stage_writes()
+        real_replace = os.replace
+        calls = []
+
+        def replace(source, target):
+            calls.append(target)
+            if len(calls) == 2:
+                raise OSError("disk full")
+            return real_replace(source, target)
+
+        with mock.patch.object(obsidian_setup.os, "replace", replace):
+            with self.assertRaises(OSError):
+                transaction.commit()
+        self.assertEqual(transaction.state, "rolled back")
+        self.assertEqual(self.contents(), {"a.md": "old a", "b.md": "old b"})
+        self.assertFalse(transaction.journal_path.exists())
+
+    def crash_during_commit(self, patch_target, patch_name, after_calls):
+        """Commit in a forked child that dies (without any cleanup) on the given call, like a killed process"""
+        pid = os.fork()
+        if pid == 0:
+            try:
+                transaction = self.stage_writes()
+                original = getattr(patch_target, patch_name)
+                calls = []
+
+                def crash(*args, **kwargs):
+                    calls.append(args)
+                    if len(calls) > after_calls:
+                        os._exit(17)
+                    return original(*args, **kwargs)
+
+                setattr(patch_target, patch_name, crash)
+                transaction.commit()
+            finally:
+                os._exit(1)
+        _, status = os.waitpid(pid, 0)
+        self.assertEqual(os.waitstatus_to_exitcode(status), 17, "the child did not crash where expected")
+
+    @unittest.skipUnless(hasattr(os, "fork"), "needs fork")
+    def test_recover_rolls_back_a_commit_interrupted_midway(self):
+        self.crash_during_commit(obsidian_setup.os, "replace", after_calls=2)
+        self.assertEqual(self.contents()["a.md"], "new a")  # the crash left a half-committed vault
+        self.assertTrue((self.vault / obsidian_setup.STATE_DIRNAME / obsidian_setup.VaultTransaction.JOURNAL_FILENAME).exists())
+
+        _, outcome = obsidian_setup.VaultTransaction.recover(self.vault)
+        self.assertEqual(outcome, "rolled back")
+        self.assertEqual(self.contents(), {"a.md": "old a", "b.md": "old b"})
+        self.assertIsNone(obsidian_setup.VaultTransaction.recover(self.vault))
+
+    @unittest.skipUnless(hasattr(os, "fork"), "needs fork")
+    def test_recover_completes_a_commit_interrupted_after_its_last_rename(self):
+        self.crash_during_commit(obsidian_setup.VaultTransaction, "finish", after_calls=0)
+
+        _, outcome = obsidian_setup.VaultTransaction.recover(self.vault)
+        self.assertEqual(outcome, "completed")
+        self.assertEqual(self.contents(), {"a.md": "new a", "b.md": "new b", "c.md": "new c"})
+        self.assertIsNone(obsidian_setup.VaultTransaction.recover(self.vault))
+
+
+if __name__ == "__main__":
+    unittest.main()